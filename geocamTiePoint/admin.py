@@ -21,3 +21,4 @@ from geocamTiePoint import models
 admin.site.register(models.ImageData)
 admin.site.register(models.Overlay)
 admin.site.register(models.QuadTree)
+admin.site.register(models.ExportJob)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Reports encode time and bytes per tile for each registered tile
+encoder. Tiles are warped from the images given on the command line,
+or from a synthesized photo-like image if none are given, so the sample
+includes the partially transparent edge tiles of a real overlay.
+"""
+
+import time
+
+import numpy
+from PIL import Image
+
+from geocamTiePoint import quadTree
+
+# maps image pixels to spherical mercator meters near Houston, with a
+# slight rotation so that edge tiles are partially transparent
+DEFAULT_TRANSFORM = {
+    'type': 'projective',
+    'matrix': [[30.0, 4.0, -10600000.0],
+               [3.0, -30.0, 3500000.0],
+               [0.0, 0.0, 1.0]]
+}
+
+
+def synthesizeImage(width, height, seed=0, noise=12):
+    """
+    Returns an RGBA image with smooth gradients plus noise, which
+    compresses roughly like an aerial photo. Set noise=0 for smooth
+    images that compress well, e.g. for golden tiles.
+    """
+    rng = numpy.random.RandomState(seed)
+    yy, xx = numpy.mgrid[0:height, 0:width].astype('d')
+    bands = []
+    for i in xrange(3):
+        fx, fy = rng.uniform(0.002, 0.02, 2)
+        band = 128 + 80 * numpy.sin(fx * xx + i) * numpy.cos(fy * yy)
+        if noise:
+            band += rng.normal(0, noise, (height, width))
+        bands.append(numpy.clip(band, 0, 255))
+    bands.append(numpy.empty((height, width)))
+    bands[3].fill(255)
+    arr = numpy.dstack(bands).astype('uint8')
+    return Image.fromarray(arr, 'RGBA')
+
+
+def getSampleTiles(image, maxTiles):
+    """
+    Renders up to maxTiles warped tiles from the two highest zoom levels
+    of the image's quadtree.
+    """
+    gen = quadTree.WarpedQuadTreeGenerator(0, image, DEFAULT_TRANSFORM)
+    tiles = []
+    for zoom in (gen.maxZoom, gen.maxZoom - 1):
+        xmin, ymin, xmax, ymax = gen.getTileBounds(zoom).bounds
+        for x in xrange(xmin, xmax + 1):
+            for y in xrange(ymin, ymax + 1):
+                if len(tiles) >= maxTiles:
+                    return tiles
+                tiles.append(gen.generateTile(zoom, x, y))
+    return tiles
+
+
+def benchmarkEncoders(tiles, repeat):
+    results = []
+    for encoding in sorted(quadTree.TILE_ENCODERS.keys()):
+        encode = quadTree.TILE_ENCODERS[encoding]['encode']
+        numBytes = 0
+        startTime = time.time()
+        for _ in xrange(repeat):
+            for tile in tiles:
+                bits, _contentType = encode(tile)
+                numBytes += len(bits)
+        elapsed = time.time() - startTime
+        numEncoded = repeat * len(tiles)
+        results.append((encoding,
+                        1000.0 * elapsed / numEncoded,
+                        float(numBytes) / numEncoded))
+    return results
+
+
+def printResults(results):
+    baseline = dict((r[0], r) for r in results).get('png')
+    print '%-16s %10s %12s %10s' % ('encoding', 'ms/tile', 'bytes/tile', 'vs png')
+    for encoding, msPerTile, bytesPerTile in results:
+        if baseline:
+            ratio = '%.2f' % (bytesPerTile / baseline[2])
+        else:
+            ratio = '-'
+        print '%-16s %10.2f %12d %10s' % (encoding, msPerTile, bytesPerTile, ratio)
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: benchmarkTileEncoders.py [image1 image2 ...]')
+    parser.add_option('-n', '--maxTiles',
+                      type='int', default=64,
+                      help='Number of warped tiles to sample per image [%default]')
+    parser.add_option('-r', '--repeat',
+                      type='int', default=3,
+                      help='Number of times to encode each tile [%default]')
+    opts, args = parser.parse_args()
+    if args:
+        images = [Image.open(path).convert('RGBA') for path in args]
+    else:
+        images = [synthesizeImage(1024, 768)]
+
+    tiles = []
+    for image in images:
+        tiles += getSampleTiles(image, opts.maxTiles)
+    print 'encoding %d sample tiles %d times each' % (len(tiles), opts.repeat)
+    printResults(benchmarkEncoders(tiles, opts.repeat))
+
+
+if __name__ == '__main__':
+    main()
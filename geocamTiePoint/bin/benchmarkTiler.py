@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Reproducible tile generation benchmark that needs no data files. For
+each synthesized source image size, it renders the whole quadtree with
+the simple generator and with the warped generator under each transform
+type and warp engine, and reports tiles/sec, ms/tile per rendering
+stage (from tileProfiler) and peak RSS.
+
+It then renders a fixed set of sample tiles from a fixed source image
+and compares them against the golden tiles in goldenTiles/, so that
+renderer optimizations can be checked for correctness as well as
+speed. Run with --updateGolden after an intentional output change.
+Exits with status 1 if any tile differs from its golden image.
+
+Needs DJANGO_SETTINGS_MODULE, like the other scripts here.
+"""
+
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+import numpy
+from PIL import Image
+
+from geocamTiePoint import quadTree
+from geocamTiePoint.tileProfiler import profiler
+
+from benchmarkTileEncoders import synthesizeImage, DEFAULT_TRANSFORM
+
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'goldenTiles')
+GOLDEN_IMAGE_SIZE = (768, 512)
+GOLDEN_QUALITY = 'standard'
+
+# one case per transform type makeTransform() can build from a plain
+# dict (CameraModelTransform needs an ISS image record). all of them
+# map image pixels to spherical mercator meters near Houston.
+TRANSFORM_CASES = [
+    ('projective', DEFAULT_TRANSFORM),
+    ('perspective', {
+        'type': 'projective',
+        'matrix': [[30.0, 4.0, -10600000.0],
+                   [3.0, -30.0, 3500000.0],
+                   [2.0e-7, 1.0e-7, 1.0]]
+    }),
+    ('quadratic', {
+        'type': 'quadratic',
+        'matrix': [[3.0e-3, 1.0e-3, 30.0, 4.0, -10600000.0],
+                   [1.0e-3, -2.0e-3, 3.0, -30.0, 3500000.0],
+                   [0.0, 0.0, 0.0, 0.0, 1.0]]
+    }),
+    ('quadratic2', {
+        'type': 'quadratic2',
+        'matrix': [[30.0e-7, 4.0e-7, -1.06],
+                   [3.0e-7, -30.0e-7, 0.35],
+                   [0.0, 0.0, 1.0]],
+        'quadraticTerms': [0.002, 0.001, 0.0, 0.0]
+    }),
+]
+
+STAGES = ('transform', 'mesh', 'warp', 'resize', 'encode', 'write')
+
+
+class CountingWriter(object):
+    """
+    A writer class that discards the tiles passed to writeData() and
+    just counts them.
+    """
+
+    def __init__(self):
+        self.numTiles = 0
+        self.numBytes = 0
+
+    def writeData(self, path, data):
+        self.numTiles += 1
+        self.numBytes += len(data)
+
+
+def getQuadTreeId(name):
+    # unique per run, so that writeQuadTree() never gets its tiles from
+    # the tile cache
+    return 'benchmark-%s-%d-%s' % (name.replace('/', '-'), os.getpid(), time.time())
+
+
+def getCases(image, engines):
+    """
+    Returns a list of (name, generator) pairs covering every generator
+    type, transform type and warp engine. Warped case names are
+    <transform>/<engine>.
+    """
+    result = [('simple', quadTree.SimpleQuadTreeGenerator(getQuadTreeId('simple'), image))]
+    for name, transformDict in TRANSFORM_CASES:
+        for engine in engines:
+            caseName = '%s/%s' % (name, engine)
+            result.append((caseName,
+                           quadTree.WarpedQuadTreeGenerator(getQuadTreeId(caseName), image,
+                                                            transformDict, engine)))
+    return result
+
+
+def getPeakRssMb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def getStageMsPerTile(numTiles):
+    """
+    Returns a dict stage -> ms per tile from the profiler's stats,
+    summed over all zoom levels.
+    """
+    totals = {}
+    for stat in profiler.getSummary():
+        if 'meanMs' in stat:
+            totals[stat['stage']] = (totals.get(stat['stage'], 0.0)
+                                     + stat['meanMs'] * stat['count'])
+    return dict([(stage, total / max(numTiles, 1))
+                 for stage, total in totals.iteritems()])
+
+
+def benchmarkCase(name, gen, opts):
+    profiler.setControl(enabled=True, reset=True)
+    writer = CountingWriter()
+    startTime = time.time()
+    gen.writeQuadTree(writer, name, opts.quality, metatileSize=opts.metatileSize)
+    elapsed = time.time() - startTime
+    return {'case': name,
+            'numTiles': writer.numTiles,
+            'bytesPerTile': float(writer.numBytes) / max(writer.numTiles, 1),
+            'tilesPerSec': writer.numTiles / elapsed,
+            'stages': getStageMsPerTile(writer.numTiles),
+            'peakRssMb': getPeakRssMb()}
+
+
+def printResults(size, results):
+    print
+    print 'source image %dx%d' % size
+    print ('%-18s %6s %9s %10s' % ('case', 'tiles', 'tiles/s', 'bytes/tile')
+           + ''.join(['%10s' % stage for stage in STAGES])
+           + '%10s' % 'peakRssMb')
+    for r in results:
+        print ('%-18s %6d %9.1f %10d' % (r['case'], r['numTiles'], r['tilesPerSec'],
+                                         r['bytesPerTile'])
+               + ''.join([('%10.2f' % r['stages'][stage]) if stage in r['stages']
+                          else '%10s' % '-'
+                          for stage in STAGES])
+               + '%10.1f' % r['peakRssMb'])
+
+
+def getGoldenTileCoords(gen):
+    """
+    Returns the (zoom, x, y) tiles to check for a generator: a
+    downsampled tile, and at full resolution a tile from the middle of
+    the overlay plus tiles on its top and left edges, which are
+    partially transparent.
+    """
+    if isinstance(gen, quadTree.SimpleQuadTreeGenerator):
+        zoom0 = gen.maxZoom + quadTree.ZOOM_OFFSET
+        return [(quadTree.ZOOM_OFFSET, 0, 0),
+                (zoom0, 0, 0),
+                (zoom0, 1, 1),
+                # upsampled past the image resolution
+                (zoom0 + 1, 3, 2)]
+    result = []
+    for zoom in (gen.maxZoom - 3, gen.maxZoom):
+        xmin, ymin, xmax, ymax = gen.getTileBounds(zoom).bounds
+        cx, cy = (xmin + xmax) // 2, (ymin + ymax) // 2
+        result.append((zoom, cx, cy))
+        if zoom == gen.maxZoom:
+            result += [(zoom, cx, ymin), (zoom, xmin, cy)]
+    return result
+
+
+def getGoldenPath(name, zoom, x, y):
+    return os.path.join(GOLDEN_DIR, '%s-%s-%d-%d-%d.png'
+                        % (name.replace('/', '-'), GOLDEN_QUALITY, zoom, x, y))
+
+
+def getPremultiplied(image):
+    arr = numpy.asarray(image.convert('RGBA'), dtype='float32')
+    return numpy.dstack([arr[:, :, :3] * (arr[:, :, 3:] / 255.0), arr[:, :, 3]])
+
+
+def compareTiles(tile, golden, tolerance):
+    """
+    Returns the fraction of pixels where some channel differs by more
+    than @tolerance. Colors are compared premultiplied by alpha, so that
+    the color of (nearly) transparent pixels, which nobody sees, doesn't
+    count.
+    """
+    if tile.size != golden.size:
+        return 1.0
+    diff = numpy.abs(getPremultiplied(tile) - getPremultiplied(golden))
+    return float(numpy.count_nonzero(diff.max(axis=2) > tolerance)) / diff.shape[0] / diff.shape[1]
+
+
+def checkGoldenTiles(opts):
+    """
+    Renders the golden sample tiles and compares them with the stored
+    ones (or stores them with --updateGolden). Returns the number of
+    failures. Each warp engine has its own golden tiles; the tiles of
+    the other engines are also compared with the default engine's
+    golden tiles, for information.
+    """
+    image = synthesizeImage(GOLDEN_IMAGE_SIZE[0], GOLDEN_IMAGE_SIZE[1], noise=0)
+    engines = opts.engines.split(',')
+    if opts.updateGolden and not os.path.exists(GOLDEN_DIR):
+        os.makedirs(GOLDEN_DIR)
+
+    print
+    print 'golden tiles (tolerance %d, max bad pixels %.2f%%)' % (opts.tolerance,
+                                                                  100 * opts.maxBadPixels)
+    numFailed = 0
+    for name, gen in getCases(image, engines):
+        for zoom, x, y in getGoldenTileCoords(gen):
+            tile = gen.generateTile(zoom, x, y, GOLDEN_QUALITY)
+            path = getGoldenPath(name, zoom, x, y)
+            if opts.updateGolden:
+                tile.save(path, optimize=True)
+                status = 'updated'
+            elif not os.path.exists(path):
+                status = 'MISSING (run with --updateGolden)'
+                numFailed += 1
+            else:
+                badFraction = compareTiles(tile, Image.open(path), opts.tolerance)
+                if badFraction > opts.maxBadPixels:
+                    status = 'FAILED (%.2f%% bad pixels)' % (100 * badFraction)
+                    numFailed += 1
+                else:
+                    status = 'ok'
+            engine = getattr(gen, 'warpEngine', quadTree.DEFAULT_WARP_ENGINE)
+            defaultPath = getGoldenPath(name.replace(engine, quadTree.DEFAULT_WARP_ENGINE),
+                                        zoom, x, y)
+            if engine != quadTree.DEFAULT_WARP_ENGINE and os.path.exists(defaultPath):
+                status += ' (%.2f%% bad pixels vs %s)' % (100 * compareTiles(tile,
+                                                                             Image.open(defaultPath),
+                                                                             opts.tolerance),
+                                                          quadTree.DEFAULT_WARP_ENGINE)
+            print '%-18s %2d %6d %6d  %s' % (name, zoom, x, y, status)
+    return numFailed
+
+
+def parseSize(text):
+    width, height = text.split('x')
+    return int(width), int(height)
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser('usage: benchmarkTiler.py')
+    parser.add_option('-s', '--sizes',
+                      default='1024x768,2048x1536',
+                      help='Comma-separated source image sizes [%default]')
+    parser.add_option('-q', '--quality',
+                      default=quadTree.DEFAULT_QUALITY,
+                      help='Rendering quality profile [%default]')
+    parser.add_option('-m', '--metatileSize',
+                      type='int', default=1,
+                      help='Render warped tiles in N x N blocks [%default]')
+    parser.add_option('-e', '--engines',
+                      default=','.join(quadTree.WARP_ENGINES),
+                      help='Comma-separated warp engines to compare [%default]')
+    parser.add_option('-c', '--cases',
+                      help='Comma-separated subset of cases to run (simple, %s)'
+                      % ', '.join([name for name, _ in TRANSFORM_CASES]))
+    parser.add_option('--tolerance',
+                      type='int', default=4,
+                      help='Max channel difference for a pixel to match its golden tile [%default]')
+    parser.add_option('--maxBadPixels',
+                      type='float', default=0.001,
+                      help='Max fraction of mismatched pixels per tile [%default]')
+    parser.add_option('--updateGolden',
+                      action='store_true', default=False,
+                      help='Store the rendered sample tiles as the new golden tiles')
+    parser.add_option('--skipBenchmark',
+                      action='store_true', default=False,
+                      help='Only check the golden tiles')
+    opts, args = parser.parse_args()
+    if args:
+        parser.error('expected no arguments')
+
+    # keep the profiler's snapshots out of the app's data directory
+    profileDir = tempfile.mkdtemp(prefix='benchmarkTiler')
+    profiler.configure(profileDir)
+    try:
+        if not opts.skipBenchmark:
+            cases = opts.cases and opts.cases.split(',')
+            for size in [parseSize(s) for s in opts.sizes.split(',')]:
+                image = synthesizeImage(*size)
+                results = [benchmarkCase(name, gen, opts)
+                           for name, gen in getCases(image, opts.engines.split(','))
+                           if not cases or name.split('/')[0] in cases]
+                printResults(size, results)
+        numFailed = checkGoldenTiles(opts)
+    finally:
+        shutil.rmtree(profileDir, True)
+    if numFailed:
+        print '%d golden tiles failed' % numFailed
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
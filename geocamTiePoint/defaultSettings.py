@@ -54,6 +54,122 @@ GEOCAM_TIE_POINT_HANDLEBARS_DIR = [os.path.join('geocamTiePoint', 'templates', '
 # unaligned image.
 GEOCAM_TIE_POINT_ZOOM_LEVELS_PAST_OVERLAY_RESOLUTION = 2
 
+# rendering quality profile for warped tiles (see
+# quadTree.QUALITY_PROFILES). live map tiles use TILE_QUALITY unless the
+# request asks for another profile with ?quality=..., html exports use
+# EXPORT_TILE_QUALITY.
+GEOCAM_TIE_POINT_TILE_QUALITY = 'standard'
+GEOCAM_TIE_POINT_EXPORT_TILE_QUALITY = 'export'
+
+# warped tiles can be rendered in N x N blocks (one warp per block,
+# sliced into tiles), which shares the per-warp overhead and avoids
+# resampling seams between tiles. with METATILE_SIZE > 1, a tile cache
+# miss in getTile renders and caches the whole block, which makes that
+# first request slower. set to 1 to render tiles one at a time.
+GEOCAM_TIE_POINT_METATILE_SIZE = 1
+GEOCAM_TIE_POINT_EXPORT_METATILE_SIZE = 4
+
+# deepest zoom level written to html and mbtiles exports. overlays of
+# high-resolution images can otherwise reach zoom levels with millions
+# of tiles. None exports down to the image's full resolution.
+GEOCAM_TIE_POINT_EXPORT_MAX_ZOOM = None
+
+# overlayGenerateExport refuses exports whose estimate (see
+# exportEstimator and the estimateExport endpoint) exceeds either
+# limit. 0 disables a limit.
+GEOCAM_TIE_POINT_EXPORT_MAX_ESTIMATED_SECONDS = 0
+GEOCAM_TIE_POINT_EXPORT_MAX_ESTIMATED_BYTES = 0
+
+# exports are queued as ExportJobs and rendered by worker processes
+# ("./manage.py exportWorker", see exportQueue) instead of in the web
+# request. idle workers check the queue this often.
+GEOCAM_TIE_POINT_EXPORT_WORKER_POLL_SECONDS = 5
+
+# html and mbtiles export jobs save a checkpoint this often, so a job
+# whose worker dies resumes from there instead of starting over.
+GEOCAM_TIE_POINT_EXPORT_CHECKPOINT_SECONDS = 30
+
+# a running job whose worker hasn't checked in for this long is put
+# back in the queue, unless it has already been started MAX_ATTEMPTS
+# times (then it fails, in case it is what keeps killing workers).
+GEOCAM_TIE_POINT_EXPORT_STALE_JOB_SECONDS = 300
+GEOCAM_TIE_POINT_EXPORT_MAX_ATTEMPTS = 3
+
+# html and mbtiles exports estimated to take longer than SHARD_SECONDS
+# are split into shards of about that length, up to MAX_SHARDS, which
+# workers render in parallel and then merge. shards write to DATA_ROOT,
+# so workers on other hosts need it on a shared filesystem. 1 disables
+# sharding.
+GEOCAM_TIE_POINT_EXPORT_MAX_SHARDS = 1
+GEOCAM_TIE_POINT_EXPORT_SHARD_SECONDS = 300
+
+# progressive tile serving. when enabled, a tile cache miss immediately
+# returns a nearest-neighbor 'draft' tile that the client may cache for
+# only PREVIEW_TILE_MAX_AGE seconds, and renders the final tile in a
+# background thread so that later requests get it.
+GEOCAM_TIE_POINT_PROGRESSIVE_TILES = False
+GEOCAM_TIE_POINT_PREVIEW_TILE_MAX_AGE = 5  # seconds
+GEOCAM_TIE_POINT_NUM_RENDER_THREADS = 2
+
+# after an alignment change, render up to PREWARM_MAX_TILES tiles of
+# the new aligned quadtree in the background (lowest zoom levels first,
+# center outward), so the map is warm when the user looks at it. set to
+# 0 to disable.
+GEOCAM_TIE_POINT_PREWARM_MAX_TILES = 256
+GEOCAM_TIE_POINT_NUM_PREWARM_THREADS = 1
+
+# concurrent requests for the same uncached tile share one render. with
+# CROSS_PROCESS_TILE_LOCKS, renders are also coalesced across processes
+# through a lock in the django cache (needs a cache shared by all the
+# processes, e.g. memcached). a process waits at most TILE_LOCK_TIMEOUT
+# seconds for another one before rendering the tile itself.
+GEOCAM_TIE_POINT_CROSS_PROCESS_TILE_LOCKS = True
+GEOCAM_TIE_POINT_TILE_LOCK_TIMEOUT = 30  # seconds
+
+# engine that warps aligned tiles: 'pil' uses PIL's Image.transform()
+# with a QUAD or an adaptive MESH, 'numpy' resamples each pixel from its
+# exact source coordinates in numpy (see numpyWarp), which avoids mesh
+# approximation error. compare them with bin/benchmarkTiler.py --engines.
+GEOCAM_TIE_POINT_WARP_ENGINE = 'pil'
+
+# tile encodings (see quadTree.TILE_ENCODERS) that getTile serves,
+# in order of preference, to clients that explicitly list their content
+# type in the Accept header. everyone else gets the generator's default
+# (png for aligned tiles, jpeg for unaligned tiles). clients can also
+# pick an encoding with ?encoding=...
+GEOCAM_TIE_POINT_PREFERRED_TILE_ENCODINGS = ('webp',)
+
+# render tiles from an internally tiled, memory-mapped copy of each
+# source image under DATA_ROOT/geocamTiePoint/rasters/, so that a tile
+# only reads the pixels it needs instead of decoding the whole image.
+GEOCAM_TIE_POINT_TILED_SOURCE_RASTERS = True
+
+# byte-size cap for the persistent tile cache under
+# DATA_ROOT/geocamTiePoint/tiles/<quadTreeId>/. least recently used tiles
+# are evicted past the cap. set to 0 to disable the disk cache.
+GEOCAM_TIE_POINT_DISK_TILE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# memory cap for the downsampled levels that each worker keeps to serve
+# unaligned tiles; least recently used levels are dropped past the cap.
+GEOCAM_TIE_POINT_PYRAMID_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# render the whole unaligned tile pyramid into the disk tile cache in a
+# background thread when an image is imported, in the default and the
+# preferred tile encodings, so the editor never waits for it to be
+# built. needs the disk tile cache.
+GEOCAM_TIE_POINT_PERSIST_UNALIGNED_TILES = True
+
+# record per-stage tile rendering timings (see tileProfiler) under
+# DATA_ROOT/geocamTiePoint/profile/. this is only the initial state:
+# "./manage.py tileProfile --enable/--disable" toggles profiling in all
+# running processes. results: tileProfile.json or "./manage.py tileProfile".
+GEOCAM_TIE_POINT_TILE_PROFILING = False
+
+# gzip level for export tarballs that consist mostly of already
+# compressed tiles (html and kml exports). higher levels burn CPU for
+# almost no size reduction on png/jpeg payloads.
+GEOCAM_TIE_POINT_TILE_ARCHIVE_COMPRESS_LEVEL = 1
+
 # amount of time to retain records in the database and blob store
 # after they are marked as unused.
 GEOCAM_TIE_POINT_RETAIN_SECONDS = 3600
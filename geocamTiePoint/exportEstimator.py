@@ -0,0 +1,161 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Estimates the size and render time of an overlay export before it
+runs, so that huge exports can be refused or scheduled.
+
+Tiles are counted from the overlay footprint: at each zoom, only the
+tiles the warped image touches are 'covered'; the others in the tile
+bounds are empty and nearly free. Costs are per covered tile, learned
+from the last MAX_COST_SAMPLES finished exports of each type (which
+are recorded in a JSON file shared by all processes), with
+DEFAULT_EXPORT_COSTS until there are any.
+"""
+
+import os
+import time
+import fcntl
+
+from geocamTiePoint.tileProfiler import writeJsonAtomic, readJson
+
+# rough per-covered-tile costs for exports of each type before we have
+# timed any. html and mbtiles tiles are warped with the 3x supersampled
+# 'export' quality profile.
+DEFAULT_EXPORT_COSTS = {
+    'html': {'secondsPerTile': 0.08, 'bytesPerTile': 25000},
+    'mbtiles': {'secondsPerTile': 0.08, 'bytesPerTile': 25000},
+    'kml': {'secondsPerTile': 0.02, 'bytesPerTile': 20000},
+    'geotiff': {'secondsPerTile': 0.01, 'bytesPerTile': 100000},
+}
+
+MAX_COST_SAMPLES = 20
+
+
+def getZoomTileCounts(gen, zoom):
+    """
+    Returns (tiles, coveredTiles) at @zoom: the number of tiles in the
+    tile bounds, and how many of them the footprint touches.
+    """
+    xmin, ymin, xmax, ymax = gen.getTileBounds(zoom).bounds
+    tiles = (xmax - xmin + 1) * (ymax - ymin + 1)
+    coveredTiles = sum([rowXmax - rowXmin + 1
+                        for _y, rowXmin, rowXmax in gen.getFootprintTileRanges(zoom)])
+    return tiles, coveredTiles
+
+
+def countCoveredTiles(gen, maxZoom=None):
+    return sum([getZoomTileCounts(gen, zoom)[1]
+                for zoom in xrange(gen.getExportMaxZoom(maxZoom) + 1)])
+
+
+class FileLock(object):
+    """
+    Holds an exclusive lock on the file at @path (created if needed)
+    for the duration of a with block. POSIX locks also work between
+    hosts sharing the file over NFS.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lockFile = None
+
+    def __enter__(self):
+        try:
+            os.makedirs(os.path.dirname(self.path))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                raise
+        self.lockFile = open(self.path, 'a')
+        fcntl.lockf(self.lockFile, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        fcntl.lockf(self.lockFile, fcntl.LOCK_UN)
+        self.lockFile.close()
+        self.lockFile = None
+
+
+class ExportCostModel(object):
+    def __init__(self, path):
+        self.path = path
+
+    def getSamples(self):
+        return readJson(self.path) or {}
+
+    def record(self, exportType, coveredTiles, seconds, numBytes):
+        """
+        Adds a finished export to the samples for its type.
+        """
+        if not coveredTiles:
+            return
+        # so concurrent workers don't drop each other's samples
+        with FileLock(self.path + '.lock'):
+            samples = self.getSamples()
+            typeSamples = samples.get(exportType, [])
+            typeSamples.append({'coveredTiles': coveredTiles,
+                                'seconds': seconds,
+                                'bytes': numBytes,
+                                'timestamp': time.time()})
+            samples[exportType] = typeSamples[-MAX_COST_SAMPLES:]
+            writeJsonAtomic(self.path, samples)
+
+    def getCost(self, exportType):
+        """
+        Returns a dict with the expected secondsPerTile and bytesPerTile
+        for exports of @exportType, and the number of samples they are
+        averaged over (0 for the defaults). Raises ValueError for an
+        unknown type.
+        """
+        if exportType not in DEFAULT_EXPORT_COSTS:
+            raise ValueError('unknown export type %s, expected one of: %s'
+                             % (exportType, ', '.join(sorted(DEFAULT_EXPORT_COSTS.keys()))))
+        typeSamples = self.getSamples().get(exportType)
+        if not typeSamples:
+            result = dict(DEFAULT_EXPORT_COSTS[exportType])
+            result['samples'] = 0
+            return result
+        # weight the samples by size, so big exports dominate
+        coveredTiles = float(sum([s['coveredTiles'] for s in typeSamples]))
+        return {'secondsPerTile': sum([s['seconds'] for s in typeSamples]) / coveredTiles,
+                'bytesPerTile': sum([s['bytes'] for s in typeSamples]) / coveredTiles,
+                'samples': len(typeSamples)}
+
+    def estimate(self, gen, exportType, maxZoom=None):
+        """
+        Returns a JSON-friendly dict estimating the export of the
+        warped quadtree @gen as @exportType with its zoom capped at
+        @maxZoom: tile counts, bytes and seconds per zoom and in total.
+        """
+        cost = self.getCost(exportType)
+        exportMaxZoom = gen.getExportMaxZoom(maxZoom)
+        zooms = []
+        for zoom in xrange(exportMaxZoom + 1):
+            tiles, coveredTiles = getZoomTileCounts(gen, zoom)
+            zooms.append({'zoom': zoom,
+                          'tiles': tiles,
+                          'coveredTiles': coveredTiles,
+                          'bytes': int(coveredTiles * cost['bytesPerTile']),
+                          'seconds': coveredTiles * cost['secondsPerTile']})
+        return {'type': exportType,
+                'maxZoom': int(gen.maxZoom),
+                'exportMaxZoom': exportMaxZoom,
+                'zooms': zooms,
+                'tiles': sum([z['tiles'] for z in zooms]),
+                'coveredTiles': sum([z['coveredTiles'] for z in zooms]),
+                'bytes': sum([z['bytes'] for z in zooms]),
+                'seconds': sum([z['seconds'] for z in zooms]),
+                'cost': cost}
@@ -0,0 +1,373 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Database-backed queue of overlay exports (models.ExportJob). Web
+requests only enqueue jobs; worker processes ("./manage.py
+exportWorker") claim and render them, so an export never holds a web
+worker. Workers may run on any host that shares the database and
+DATA_ROOT.
+
+A running job writes its progress to its row at most every
+PROGRESS_UPDATE_SECONDS, and checks at the same time whether it has
+been canceled.
+
+Workers also touch the row every HEARTBEAT_SECONDS. If a worker dies,
+its job is put back in the queue once the heartbeat is
+GEOCAM_TIE_POINT_EXPORT_STALE_JOB_SECONDS old, and the next worker
+resumes it from the checkpoint in its work dir (see
+QuadTree.generateHtmlExport). A worker that is stopped with SIGTERM or
+SIGINT (e.g. during a deploy) requeues its job right away.
+
+Big html and mbtiles exports can be sharded (see getNumShards()): the
+tile columns are split into runs of about equal work, each queued as a
+shard job that renders a partial archive into its parent's work dir,
+so any number of workers can share the export. When the last shard is
+done, the parent job is queued and merges the parts.
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import signal
+import socket
+import logging
+import datetime
+import threading
+import traceback
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+
+from geocamTiePoint.models import ExportJob, EXPORT_PART_FILES
+
+PROGRESS_UPDATE_SECONDS = 2
+HEARTBEAT_SECONDS = 30
+
+# how many queued jobs a worker looks at per claim attempt, in case
+# other workers claim the first ones
+CLAIM_BATCH_SIZE = 10
+
+
+class ExportCanceled(Exception):
+    pass
+
+
+class WorkerStopping(Exception):
+    pass
+
+
+def getWorkerName():
+    return '%s-%s' % (socket.gethostname(), os.getpid())
+
+
+def getNumShards(exportType, estimatedSeconds):
+    """
+    Returns how many shards to split an export estimated to take
+    @estimatedSeconds into: enough for each to take about
+    GEOCAM_TIE_POINT_EXPORT_SHARD_SECONDS, up to
+    GEOCAM_TIE_POINT_EXPORT_MAX_SHARDS.
+    """
+    if exportType not in EXPORT_PART_FILES or not estimatedSeconds:
+        return 1
+    numShards = int(math.ceil(estimatedSeconds / settings.GEOCAM_TIE_POINT_EXPORT_SHARD_SECONDS))
+    return max(min(numShards, settings.GEOCAM_TIE_POINT_EXPORT_MAX_SHARDS), 1)
+
+
+def enqueueExport(overlay, exportType, priority=0, estimatedSeconds=None, numShards=1):
+    """
+    Returns a queued or running job for exporting @overlay as
+    @exportType, creating one if there isn't one already. With
+    @numShards > 1, a new html or mbtiles export is sharded.
+    """
+    pending = (ExportJob.objects
+               .filter(overlay=overlay, exportType=exportType, parent=None,
+                       status__in=('waiting', 'queued', 'running'))
+               .first())
+    if pending is not None:
+        if priority > pending.priority:
+            (ExportJob.objects.filter(Q(id=pending.id) | Q(parent=pending))
+             .update(priority=priority))
+            pending.priority = priority
+        return pending
+    if numShards > 1 and exportType in EXPORT_PART_FILES:
+        return enqueueShardedExport(overlay, exportType, priority, estimatedSeconds, numShards)
+    return ExportJob.objects.create(overlay=overlay,
+                                    exportType=exportType,
+                                    priority=priority,
+                                    estimatedSeconds=estimatedSeconds,
+                                    createdTime=datetime.datetime.utcnow())
+
+
+def enqueueShardedExport(overlay, exportType, priority, estimatedSeconds, numShards):
+    shards = overlay.getExportShards(numShards)
+    now = datetime.datetime.utcnow()
+    # workers must not finish the shards before they all exist
+    with transaction.atomic():
+        parent = ExportJob.objects.create(overlay=overlay,
+                                          exportType=exportType,
+                                          priority=priority,
+                                          status='waiting',
+                                          estimatedSeconds=estimatedSeconds,
+                                          createdTime=now,
+                                          numShards=len(shards))
+        for shardIndex, shardRanges in enumerate(shards):
+            ExportJob.objects.create(overlay=overlay,
+                                     exportType=exportType,
+                                     priority=priority,
+                                     estimatedSeconds=(estimatedSeconds / len(shards)
+                                                       if estimatedSeconds is not None
+                                                       else None),
+                                     createdTime=now,
+                                     parent=parent,
+                                     shardIndex=shardIndex,
+                                     shardRanges=json.dumps(shardRanges))
+    return parent
+
+
+def cancelJob(job):
+    """
+    Cancels a queued job, or a sharded export that is waiting for its
+    shards, at once. A running job stops at its next progress report.
+    """
+    now = datetime.datetime.utcnow()
+    if (ExportJob.objects.filter(id=job.id, status__in=('queued', 'waiting'))
+            .update(status='canceled', cancelRequested=True, endTime=now)):
+        removeWorkDir(job)
+        if job.numShards:
+            for shard in job.shards.all():
+                cancelJob(shard)
+        if job.parent_id is not None:
+            shardFinished(job, 'canceled')
+    (ExportJob.objects.filter(id=job.id, status='running')
+     .update(cancelRequested=True))
+
+
+def shardFinished(shard, status):
+    """
+    Queues the merge once the last shard of a sharded export is done.
+    If a shard fails or is canceled, so is the whole export.
+    """
+    now = datetime.datetime.utcnow()
+    waitingParent = ExportJob.objects.filter(id=shard.parent_id, status='waiting')
+    if status == 'done':
+        if not ExportJob.objects.filter(parent_id=shard.parent_id).exclude(status='done').exists():
+            waitingParent.update(status='queued', updateTime=now)
+    elif waitingParent.update(status=status, endTime=now, updateTime=now,
+                              error='shard %s was %s' % (shard.shardIndex, status)):
+        for sibling in ExportJob.objects.filter(parent_id=shard.parent_id):
+            cancelJob(sibling)
+        removeWorkDir(shard.parent)
+
+
+def claimNextJob(worker):
+    """
+    Marks the highest-priority queued job as running on @worker and
+    returns it, or returns None if there is nothing to do. The claim
+    only succeeds if the job is still queued, so concurrent workers
+    never run the same job.
+    """
+    for job in ExportJob.objects.filter(status='queued')[:CLAIM_BATCH_SIZE]:
+        now = datetime.datetime.utcnow()
+        claimed = (ExportJob.objects.filter(id=job.id, status='queued')
+                   .update(status='running', worker=worker,
+                           startTime=now, updateTime=now, progressTime=None,
+                           resumedTiles=0,
+                           attempts=F('attempts') + 1))
+        if claimed:
+            return ExportJob.objects.get(id=job.id)
+    return None
+
+
+def requeueStaleJobs():
+    """
+    Puts running jobs whose worker has stopped sending heartbeats back
+    in the queue. Jobs that were canceled, or have been started
+    GEOCAM_TIE_POINT_EXPORT_MAX_ATTEMPTS times already, are finished
+    instead.
+    """
+    now = datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(seconds=settings.GEOCAM_TIE_POINT_EXPORT_STALE_JOB_SECONDS)
+    for job in ExportJob.objects.filter(status='running', updateTime__lt=cutoff):
+        if job.cancelRequested:
+            status, error = 'canceled', ''
+        elif job.attempts >= settings.GEOCAM_TIE_POINT_EXPORT_MAX_ATTEMPTS:
+            status, error = 'failed', ('worker %s stopped responding, giving up after %d attempts'
+                                       % (job.worker, job.attempts))
+        else:
+            status, error = 'queued', ''
+        # only if no other worker got to it first
+        updated = (ExportJob.objects
+                   .filter(id=job.id, status='running', updateTime__lt=cutoff)
+                   .update(status=status, error=error, worker='', updateTime=now,
+                           endTime=None if status == 'queued' else now))
+        if updated:
+            logging.warning('exportQueue: worker %s stopped responding, %s is now %s',
+                            job.worker, job, status)
+            if status != 'queued':
+                removeWorkDir(job)
+                if job.parent_id is not None:
+                    shardFinished(job, status)
+
+
+def requeueJob(job):
+    """
+    Puts a job that its worker is abandoning back in the queue. That
+    doesn't count as an attempt.
+    """
+    (ExportJob.objects.filter(id=job.id, status='running')
+     .update(status='queued', worker='', attempts=F('attempts') - 1,
+             updateTime=datetime.datetime.utcnow()))
+
+
+def removeWorkDir(job):
+    shutil.rmtree(job.getWorkDir(), ignore_errors=True)
+
+
+class JobHeartbeat(threading.Thread):
+    """
+    Touches the job's updateTime every HEARTBEAT_SECONDS while it
+    runs, so requeueStaleJobs() can tell a long export that reports
+    no progress (kml, geotiff) from one whose worker has died.
+    """
+
+    def __init__(self, job):
+        super(JobHeartbeat, self).__init__(name='exportHeartbeat')
+        self.daemon = True
+        self.job = job
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.wait(HEARTBEAT_SECONDS):
+                try:
+                    (ExportJob.objects.filter(id=self.job.id, status='running')
+                     .update(updateTime=datetime.datetime.utcnow()))
+                except Exception:  # pylint: disable=W0703
+                    logging.exception('exportQueue: heartbeat failed for %s', self.job)
+        finally:
+            # the thread has its own database connection
+            connection.close()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class JobProgress(object):
+    """
+    A writeQuadTree() progress callback that records progress in the
+    job row and raises ExportCanceled once the job is canceled.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.lastUpdateTime = 0
+
+    def __call__(self, tilesSoFar, totalTiles, resumedTiles=0):
+        now = time.time()
+        if now - self.lastUpdateTime < PROGRESS_UPDATE_SECONDS and tilesSoFar < totalTiles:
+            return
+        self.lastUpdateTime = now
+        jobs = ExportJob.objects.filter(id=self.job.id)
+        utcNow = datetime.datetime.utcnow()
+        jobs.update(completedTiles=tilesSoFar, totalTiles=totalTiles,
+                    resumedTiles=resumedTiles, progressTime=utcNow, updateTime=utcNow)
+        if jobs.filter(cancelRequested=True).exists():
+            raise ExportCanceled('export job %s was canceled' % self.job.id)
+
+
+def finishJob(job, status, error=''):
+    now = datetime.datetime.utcnow()
+    (ExportJob.objects.filter(id=job.id)
+     .update(status=status, error=error, endTime=now, updateTime=now))
+    if job.parent_id is None:
+        removeWorkDir(job)
+    else:
+        # a finished shard's part stays for the merge, which cleans up
+        if status != 'done':
+            removeWorkDir(job)
+        shardFinished(job, status)
+
+
+def renderJob(job):
+    if job.parent_id is not None:
+        job.overlay.generateExportShard(job.exportType, job.getShardRanges(),
+                                        job.getWorkDir(), job.parent.createdTime,
+                                        JobProgress(job))
+    elif job.numShards:
+        partDirs = [shard.getWorkDir() for shard in job.shards.order_by('shardIndex')]
+        job.overlay.mergeExport(job.exportType, partDirs, job.createdTime)
+    else:
+        job.overlay.generateExport(job.exportType, JobProgress(job), job.getWorkDir())
+
+
+def runJob(job):
+    logging.info('exportQueue: running %s (attempt %d)', job, job.attempts)
+    heartbeat = JobHeartbeat(job)
+    heartbeat.start()
+    try:
+        renderJob(job)
+    except WorkerStopping:
+        # keep the work dir, so the next worker resumes the job
+        logging.info('exportQueue: worker stopping, requeueing %s', job)
+        requeueJob(job)
+        raise
+    except ExportCanceled:
+        logging.info('exportQueue: canceled %s', job)
+        finishJob(job, 'canceled')
+    except Exception:
+        logging.exception('exportQueue: failed %s', job)
+        finishJob(job, 'failed', traceback.format_exc())
+    else:
+        logging.info('exportQueue: finished %s', job)
+        finishJob(job, 'done')
+    finally:
+        heartbeat.stop()
+
+
+def stopWorker(signum, frame):
+    raise WorkerStopping('got signal %s' % signum)
+
+
+def runWorker(pollSeconds=5, once=False):
+    """
+    Runs queued jobs one at a time, polling the queue every
+    @pollSeconds when it is empty. With @once, returns when the queue
+    is empty instead. Returns after requeueing the current job on
+    SIGTERM or SIGINT.
+    """
+    worker = getWorkerName()
+    logging.info('exportQueue: worker %s started', worker)
+    signal.signal(signal.SIGTERM, stopWorker)
+    signal.signal(signal.SIGINT, stopWorker)
+    try:
+        while True:
+            # this process is long-lived, so don't hang on to stale connections
+            close_old_connections()
+            requeueStaleJobs()
+            job = claimNextJob(worker)
+            if job is not None:
+                runJob(job)
+            elif once:
+                return
+            else:
+                time.sleep(pollSeconds)
+    except WorkerStopping as e:
+        logging.info('exportQueue: worker %s stopping (%s)', worker, e)
@@ -0,0 +1,73 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Renders queued overlay exports (see exportQueue). Run one or more of
+these next to the web server:
+
+  ./manage.py exportWorker
+  ./manage.py exportWorker --once
+  ./manage.py exportWorker --processes 4
+
+With --processes, the workers are child processes, e.g. to render the
+shards of a sharded export in parallel on one host.
+"""
+
+import signal
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from geocamTiePoint import exportQueue
+
+
+class Command(BaseCommand):
+    help = 'Render queued geocamTiePoint overlay exports'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when the queue is empty')
+        parser.add_argument('--pollSeconds', type=float,
+                            default=settings.GEOCAM_TIE_POINT_EXPORT_WORKER_POLL_SECONDS,
+                            help='How often to check an empty queue')
+        parser.add_argument('--processes', type=int, default=1,
+                            help='Number of worker processes to run')
+
+    def handle(self, *args, **options):
+        if options['processes'] <= 1:
+            exportQueue.runWorker(options['pollSeconds'], options['once'])
+            return
+
+        # the children can't share our database connection
+        connections.close_all()
+        children = [multiprocessing.Process(target=exportQueue.runWorker,
+                                            args=(options['pollSeconds'], options['once']))
+                    for _ in xrange(options['processes'])]
+        for child in children:
+            child.start()
+
+        def stopChildren(signum, frame):
+            for child in children:
+                if child.is_alive():
+                    child.terminate()
+
+        signal.signal(signal.SIGTERM, stopChildren)
+        # the terminal sends SIGINT to the children too
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        for child in children:
+            child.join()
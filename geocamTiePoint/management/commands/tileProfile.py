@@ -0,0 +1,74 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Shows per-stage tile rendering timings merged across all worker
+processes, and turns the profiler on and off at runtime.
+
+  ./manage.py tileProfile --enable
+  ./manage.py tileProfile [--generator warped] [--zoom 12] [--json]
+  ./manage.py tileProfile --reset
+  ./manage.py tileProfile --disable
+"""
+
+import json
+
+from django.core.management.base import BaseCommand
+
+from geocamTiePoint.tileProfiler import profiler, PERCENTILES
+
+
+class Command(BaseCommand):
+    help = 'Show or control the geocamTiePoint tile rendering profiler'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--enable', action='store_true',
+                            help='Start profiling in all processes')
+        parser.add_argument('--disable', action='store_true',
+                            help='Stop profiling in all processes')
+        parser.add_argument('--reset', action='store_true',
+                            help='Clear the recorded timings')
+        parser.add_argument('--generator',
+                            help='Only show this generator type (simple, warped, getTile)')
+        parser.add_argument('--zoom', type=int,
+                            help='Only show this zoom level')
+        parser.add_argument('--json', action='store_true',
+                            help='Print the summary as JSON')
+
+    def handle(self, *args, **options):
+        if options['enable'] or options['disable'] or options['reset']:
+            enabled = None
+            if options['enable']:
+                enabled = True
+            elif options['disable']:
+                enabled = False
+            profiler.setControl(enabled=enabled, reset=options['reset'])
+
+        stats = [s for s in profiler.getSummary()
+                 if ((options['generator'] is None or s['generator'] == options['generator'])
+                     and (options['zoom'] is None or s['zoom'] == options['zoom']))]
+        if options['json']:
+            self.stdout.write(json.dumps(stats, indent=4, sort_keys=True))
+            return
+
+        self.stdout.write('profiling is %s' % ('enabled' if profiler.isEnabled() else 'disabled'))
+        columns = ['meanMs'] + ['p%dMs' % pct for pct in PERCENTILES]
+        self.stdout.write('%-10s %4s %-10s %9s' % ('generator', 'zoom', 'stage', 'count')
+                          + ''.join(['%10s' % c for c in columns]))
+        for s in stats:
+            self.stdout.write('%-10s %4d %-10s %9d' % (s['generator'], s['zoom'], s['stage'], s['count'])
+                              + ''.join([('%10.2f' % s[c]) if c in s else '%10s' % '-'
+                                         for c in columns]))
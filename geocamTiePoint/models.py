@@ -23,6 +23,8 @@ import re
 import logging
 import threading
 import sys
+import time
+import shutil
 
 try:
     from cStringIO import StringIO
@@ -33,9 +35,12 @@ import PIL.Image
 import numpy as np
 from osgeo import gdal
 
-from django.db import models
+from django.db import models, transaction, close_old_connections
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
+from django.core.files import File
 from django.core.files.base import ContentFile
 from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
@@ -44,7 +49,11 @@ from django.conf import settings
 from geocamUtil import anyjson as json
 from geocamUtil import gdal2tiles, imageInfo
 from geocamUtil.models.ExtrasDotField import ExtrasDotField
-from geocamTiePoint import quadTree, transform, rpcModel, gdalUtil
+from geocamTiePoint import quadTree, transform, rpcModel, gdalUtil, sourceRaster, tileEnhancement
+from geocamTiePoint import exportEstimator
+from geocamTiePoint.tileStore import DiskTileStore
+from geocamTiePoint.renderQueue import RenderQueue
+from geocamTiePoint.tileProfiler import profiler
 from geocamUtil.ErrorJSONResponse import ErrorJSONResponse, checkIfErrorJSONResponse
 from georef_imageregistration import offline_config, registration_common
 
@@ -58,6 +67,22 @@ from deepzoom.models import DeepZoom
 # use the memcached cache, but that would get rid of much of the benefit
 # in terms of serialization/deserialization.
 cachedGeneratorG = threading.local()
+diskTileStoreG = None
+
+# background writer of the unaligned tiles of newly imported images
+persistTilesQueueG = RenderQueue()
+
+profiler.configure(settings.DATA_ROOT + 'geocamTiePoint/profile',
+                   settings.GEOCAM_TIE_POINT_TILE_PROFILING)
+
+# timings of finished exports, for estimating new ones
+exportCostsG = exportEstimator.ExportCostModel(settings.DATA_ROOT
+                                               + 'geocamTiePoint/profile/exportCosts.json')
+
+# export types that can be split into shards, and the file each shard
+# writes its part of the archive to
+EXPORT_PART_FILES = {'html': 'part.tar.gz',
+                     'mbtiles': 'part.mbtiles'}
 
 
 def getNewImageFileName(instance, filename):
@@ -252,9 +277,50 @@ class ImageData(models.Model):
         
     def save(self, *args, **kwargs):
         self.lastModifiedTime = datetime.datetime.utcnow()
+        if not self.checksum and self.image:
+            self.checksum = self.computeChecksum()
         super(ImageData, self).save(*args, **kwargs)
 
+    def computeChecksum(self):
+        """
+        Returns the SHA-1 of the displayed image bits. Code that replaces
+        the image should clear checksum so that save() recomputes it.
+        """
+        self.image.open('rb')
+        bits = self.image.read()
+        self.image.seek(0)
+        return quadTree.getContentHash(bits)
+
+    def getSourceRasterPath(self):
+        return (settings.DATA_ROOT + 'geocamTiePoint/rasters/%s.raster'
+                % os.path.basename(self.image.name))
+
+    def getSourceRaster(self, image=None):
+        """
+        Returns a TiledRaster for the displayed image, converting it on
+        first use. Pass @image if it is already decoded to save reading
+        it again.
+        """
+        path = self.getSourceRasterPath()
+        if os.path.exists(path):
+            try:
+                return sourceRaster.TiledRaster(path)
+            except sourceRaster.SourceRasterError:
+                logging.warning('getSourceRaster: rebuilding %s', path)
+        if image is None:
+            image = PIL.Image.open(StringIO(self.image.file.read()))
+        return sourceRaster.TiledRaster.fromImage(image, path)
+
+    def deleteSourceRaster(self):
+        if not self.image.name:
+            return
+        try:
+            os.unlink(self.getSourceRasterPath())
+        except OSError:
+            pass
+
     def delete(self, *args, **kwargs):
+        self.deleteSourceRaster()
         self.image.delete()
         self.unenhancedImage.delete()
         self.enhancedImage.delete()
@@ -276,6 +342,8 @@ class QuadTree(models.Model):
     # transform is either an empty string (simple quadTree) or a JSON-formatted
     # definition of the warping transform (warped quadTree)
     transform = models.TextField(blank=True)
+    # identifies the tiles this QuadTree renders; see getContentKey()
+    contentKey = models.CharField(max_length=128, blank=True, db_index=True)
 
     # note: 'exportZip' is a bit of a misnomer since the archive may not
     # be a zipfile (tarball by default).  but no real need to change the
@@ -300,6 +368,11 @@ class QuadTree(models.Model):
     metadataExport = models.FileField(upload_to=getNewExportFileName,
                                       max_length=255,
                                       null=True, blank=True)
+    mbtilesExportName = models.CharField(max_length=255,
+                                         null=True, blank=True)
+    mbtilesExport = models.FileField(upload_to=getNewExportFileName,
+                                     max_length=255,
+                                     null=True, blank=True)
 
     # we set unusedTime when a QuadTree is no longer referenced by an Overlay.
     # it will eventually be deleted.
@@ -314,8 +387,118 @@ class QuadTree(models.Model):
         self.lastModifiedTime = datetime.datetime.utcnow()
         super(QuadTree, self).save(*args, **kwargs)
 
+    @staticmethod
+    def getTilesRootPath():
+        return settings.DATA_ROOT + 'geocamTiePoint/tiles'
+
     def getBasePath(self):
-        return settings.DATA_ROOT + 'geocamTiePoint/tiles/%d' % self.id
+        return self.getTilesRootPath() + '/%d' % self.id
+
+    @staticmethod
+    def getContentKey(imageData, transformJson=''):
+        """
+        QuadTrees with the same content key render the same tiles: same
+        image bits, same transform up to JSON formatting and key order.
+        Returns '' if the image checksum is unknown.
+
+        The key includes the ImageData row, so a QuadTree is only reused
+        within one overlay's images. QuadTrees hold their overlay's
+        exports and are deleted along with their ImageData, so they
+        can't be shared between overlays, even ones made from the same
+        image bits.
+        """
+        if imageData is None or not imageData.checksum:
+            return ''
+        if transformJson:
+            transformJson = dumps(json.loads(transformJson))
+        return quadTree.getContentHash('%s\n%s\n%s'
+                                       % (imageData.id, imageData.checksum, transformJson))
+
+    @classmethod
+    def getOrCreate(cls, imageData, transformJson=''):
+        """
+        Returns (quadTree, created). Reuses an existing QuadTree with the
+        same content key, with its cached tiles and exports, if there is
+        one.
+        """
+        contentKey = cls.getContentKey(imageData, transformJson)
+        if contentKey:
+            existing = (cls.objects
+                        .filter(contentKey=contentKey)
+                        .order_by('-id')
+                        .first())
+            if existing is not None:
+                if existing.unusedTime is not None:
+                    # rescue it from the garbage collector
+                    existing.unusedTime = None
+                    existing.save()
+                return existing, False
+        qt = cls(imageData=imageData,
+                 transform=transformJson,
+                 contentKey=contentKey)
+        qt.save()
+        return qt, True
+
+    @classmethod
+    def getDiskTileStore(cls):
+        """
+        Returns the process-wide DiskTileStore, or None if the disk tile
+        cache is disabled.
+        """
+        global diskTileStoreG
+        if (diskTileStoreG is None
+                and settings.GEOCAM_TIE_POINT_DISK_TILE_CACHE_MAX_BYTES):
+            diskTileStoreG = DiskTileStore(cls.getTilesRootPath(),
+                                           settings.GEOCAM_TIE_POINT_DISK_TILE_CACHE_MAX_BYTES)
+        return diskTileStoreG
+
+    def persistTilesToDisk(self):
+        """
+        Renders every tile into the disk tile cache, in each encoding
+        getTile may negotiate, so that getTile never has to build the
+        pyramid for them. The tiles bypass the memory tile cache, which
+        they would only flush.
+        """
+        store = self.getDiskTileStore()
+        if store is None:
+            return
+        gen = self.getGenerator()
+        quality = settings.GEOCAM_TIE_POINT_TILE_QUALITY
+        encodings = quadTree.getNegotiableTileEncodings(settings.GEOCAM_TIE_POINT_PREFERRED_TILE_ENCODINGS,
+                                                        needsAlpha=True)
+        for zoom, x, y in gen.getAllTiles():
+            try:
+                tileImage = gen.generateTile(zoom, x, y, quality)
+            except quadTree.OutOfBounds:
+                continue
+            # crop once, encode once per encoding
+            for encoding in encodings:
+                store.putTile(self.id, zoom, x, y,
+                              quadTree.encodeTile(tileImage, encoding or gen.defaultEncoding),
+                              quality, encoding)
+
+    @classmethod
+    def schedulePersistTilesToDisk(cls, quadTreeId):
+        """
+        Queues persistTilesToDisk() for the QuadTree on a background
+        thread, once the current transaction has committed the row.
+        """
+        transaction.on_commit(lambda: persistTilesQueueG.schedule(('persistTiles', quadTreeId),
+                                                                  cls.persistTilesToDiskById,
+                                                                  quadTreeId))
+
+    @classmethod
+    def persistTilesToDiskById(cls, quadTreeId):
+        try:
+            qt = cls.objects.filter(id=quadTreeId).first()
+            if qt is None:
+                # deleted while it was queued
+                return
+            qt.persistTilesToDisk()
+            logging.info('persistTilesToDisk: QuadTree %s done', quadTreeId)
+        finally:
+            # worker threads don't get the request_finished cleanup
+            close_old_connections()
 
     def convertImageToRgbaIfNeeded(self, image):
         """
@@ -329,9 +512,14 @@ class QuadTree(models.Model):
             image.save(out, format='png')
             self.imageData.image.save('dummy.png', ContentFile(out.getvalue()), save=False)
             self.imageData.contentType = 'image/png'
+            self.imageData.checksum = ''
             self.imageData.save()
     
     def getImage(self):
+        if settings.GEOCAM_TIE_POINT_TILED_SOURCE_RASTERS:
+            # only the pixel window each tile needs gets read
+            return self.imageData.getSourceRaster()
+
         # apparently image.file is not a very good file work-alike,
         # so let's delegate to StringIO(), which PIL is tested against
         bits = self.imageData.image.file.read()
@@ -367,10 +555,12 @@ class QuadTree(models.Model):
         if self.transform:
             return quadTree.WarpedQuadTreeGenerator(self.id,
                                                    image,
-                                                   json.loads(self.transform))
+                                                   json.loads(self.transform),
+                                                   settings.GEOCAM_TIE_POINT_WARP_ENGINE)
         else:
             return quadTree.SimpleQuadTreeGenerator(self.id,
-                                                image)
+                                                image,
+                                                settings.GEOCAM_TIE_POINT_PYRAMID_CACHE_MAX_BYTES)
 
     @staticmethod
     def getSimpleViewHtml(tileRootUrl, metaJson, slug):
@@ -404,8 +594,58 @@ class QuadTree(models.Model):
                 pixels = np.column_stack((pixels, newCol))
         return pixels        
 
-    def generateHtmlExport(self, exportName, metaJson, slug):
-        overlay = Overlay.objects.get(alignedQuadTree = self)
+    def estimateExport(self, exportType):
+        """
+        Returns the exportEstimator estimate for exporting this
+        quadtree as @exportType.
+        """
+        return exportCostsG.estimate(self.getGeneratorWithCache(self.id), exportType,
+                                     settings.GEOCAM_TIE_POINT_EXPORT_MAX_ZOOM)
+
+    def recordExportCost(self, exportType, seconds, fieldFile):
+        """
+        Feeds the time and size of a finished export into the estimates.
+        """
+        gen = self.getGeneratorWithCache(self.id)
+        coveredTiles = exportEstimator.countCoveredTiles(gen,
+                                                         settings.GEOCAM_TIE_POINT_EXPORT_MAX_ZOOM)
+        exportCostsG.record(exportType, coveredTiles, seconds, fieldFile.size)
+
+    @staticmethod
+    def getExportSeconds(startTime, checkpoint):
+        if checkpoint is None:
+            return time.time() - startTime
+        # including the earlier runs of a resumed export
+        return checkpoint.getSeconds()
+
+    def getExportCheckpoint(self, workDir, exportType, slug, shardRanges=None):
+        """
+        Returns the quadTree.ExportCheckpoint kept in @workDir, or None
+        if there is no @workDir (the export can't be resumed).
+        """
+        if workDir is None:
+            return None
+        if not os.path.exists(workDir):
+            os.makedirs(workDir)
+        params = {'quadTreeId': self.id,
+                  'exportType': exportType,
+                  'slug': slug,
+                  'quality': settings.GEOCAM_TIE_POINT_EXPORT_TILE_QUALITY,
+                  'metatileSize': settings.GEOCAM_TIE_POINT_EXPORT_METATILE_SIZE,
+                  'maxZoom': settings.GEOCAM_TIE_POINT_EXPORT_MAX_ZOOM}
+        if shardRanges is not None:
+            params['shardRanges'] = shardRanges
+        return quadTree.ExportCheckpoint(os.path.join(workDir, 'checkpoint.json'),
+                                         params,
+                                         settings.GEOCAM_TIE_POINT_EXPORT_CHECKPOINT_SECONDS)
+
+    def generateHtmlExport(self, overlay, exportName, metaJson, slug, progress=None, workDir=None):
+        """
+        With a @workDir, the archive is written there with checkpoints,
+        and an export interrupted before it finished resumes from them.
+        """
+        startTime = time.time()
+        checkpoint = self.getExportCheckpoint(workDir, 'html', slug)
         imageSizeType = overlay.imageData.sizeType
         gen = self.getGeneratorWithCache(self.id)
         now = datetime.datetime.utcnow()
@@ -417,20 +657,173 @@ class QuadTree(models.Model):
         html = self.getSimpleViewHtml(tileRootUrl, metaJson, slug)
         logging.debug('html: len=%s head=%s', len(html), repr(html[:10]))
         # tar the html export
-        writer = quadTree.TarWriter(htmlExportName)
-        gen.writeQuadTree(writer, slug)
+        if checkpoint is None:
+            writer = quadTree.TarWriter(htmlExportName,
+                                        compresslevel=settings.GEOCAM_TIE_POINT_TILE_ARCHIVE_COMPRESS_LEVEL)
+        else:
+            # tiles already in the archive are filed under the first run's name
+            htmlExportName = checkpoint.getInfo('exportName', htmlExportName)
+            writer = quadTree.TarWriter(htmlExportName,
+                                        compresslevel=settings.GEOCAM_TIE_POINT_TILE_ARCHIVE_COMPRESS_LEVEL,
+                                        path=os.path.join(workDir, 'export.tar.gz'),
+                                        resumeState=checkpoint.writerState)
+        gen.writeQuadTree(writer, slug, settings.GEOCAM_TIE_POINT_EXPORT_TILE_QUALITY,
+                          metatileSize=settings.GEOCAM_TIE_POINT_EXPORT_METATILE_SIZE,
+                          maxZoom=settings.GEOCAM_TIE_POINT_EXPORT_MAX_ZOOM,
+                          progress=progress,
+                          checkpoint=checkpoint)
         writer.writeData(viewHtmlPath, html)
         writer.writeData('meta.json', dumps(metaJson))
         self.htmlExportName = '%s.tar.gz' % htmlExportName
-        self.htmlExport.save(self.htmlExportName,
-                            ContentFile(writer.getData()))
+        self.saveExport(self.htmlExport, self.htmlExportName, writer)
+        self.recordExportCost('html', self.getExportSeconds(startTime, checkpoint),
+                              self.htmlExport)
+
+    def generateMbtilesExport(self, overlay, exportName, metaJson, slug, progress=None, workDir=None):
+        """
+        This generates the tiles as a single MBTiles (SQLite) file. It
+        is resumable with a @workDir, like generateHtmlExport().
+        """
+        startTime = time.time()
+        checkpoint = self.getExportCheckpoint(workDir, 'mbtiles', slug)
+        imageSizeType = overlay.imageData.sizeType
+        gen = self.getGeneratorWithCache(self.id)
+        now = datetime.datetime.utcnow()
+        timestamp = now.strftime('%Y-%m-%d-%H%M%S-UTC')
+        mbtilesExportName = exportName + ('-%s-mbtiles_%s' % (imageSizeType, timestamp))
+        metadata = self.getMbtilesMetadata(mbtilesExportName, metaJson)
+        if checkpoint is None:
+            writer = quadTree.MBTilesWriter(mbtilesExportName, metadata)
+        else:
+            mbtilesExportName = checkpoint.getInfo('exportName', mbtilesExportName)
+            writer = quadTree.MBTilesWriter(mbtilesExportName, metadata,
+                                            path=os.path.join(workDir, 'export.mbtiles'),
+                                            resumeState=checkpoint.writerState)
+        try:
+            gen.writeQuadTree(writer, slug, settings.GEOCAM_TIE_POINT_EXPORT_TILE_QUALITY,
+                              metatileSize=settings.GEOCAM_TIE_POINT_EXPORT_METATILE_SIZE,
+                              maxZoom=settings.GEOCAM_TIE_POINT_EXPORT_MAX_ZOOM,
+                              progress=progress,
+                              checkpoint=checkpoint)
+        except:
+            # unlike the tar writer's, the database isn't an anonymous
+            # temp file. a resumable one is kept for the next attempt.
+            if checkpoint is None:
+                writer.discard()
+            raise
+        writer.writeData('meta.json', dumps(metaJson))
+        self.mbtilesExportName = '%s.mbtiles' % mbtilesExportName
+        self.saveExport(self.mbtilesExport, self.mbtilesExportName, writer)
+        self.recordExportCost('mbtiles', self.getExportSeconds(startTime, checkpoint),
+                              self.mbtilesExport)
+
+    @staticmethod
+    def getMbtilesMetadata(mbtilesExportName, metaJson):
+        metadata = {'description': metaJson.get('name', mbtilesExportName)}
+        bounds = metaJson.get('bounds')
+        if bounds:
+            metadata['bounds'] = ('%s,%s,%s,%s'
+                                  % (bounds['west'], bounds['south'],
+                                     bounds['east'], bounds['north']))
+        return metadata
+
+    def getExportShards(self, numShards):
+        """
+        Splits the tiles of an export into up to @numShards shards (see
+        WarpedQuadTreeGenerator.getExportShards()).
+        """
+        gen = self.getGeneratorWithCache(self.id)
+        return gen.getExportShards(numShards,
+                                   settings.GEOCAM_TIE_POINT_EXPORT_MAX_ZOOM,
+                                   settings.GEOCAM_TIE_POINT_EXPORT_METATILE_SIZE)
+
+    def generateExportShard(self, archiveName, slug, exportType, shardRanges, workDir,
+                            progress=None):
+        """
+        Renders the tiles of one shard of an html or mbtiles export
+        into a partial archive in @workDir, for mergeExport(). Like
+        generateHtmlExport(), it resumes from its checkpoint.
+        """
+        gen = self.getGeneratorWithCache(self.id)
+        checkpoint = self.getExportCheckpoint(workDir, exportType, slug, shardRanges)
+        partPath = os.path.join(workDir, EXPORT_PART_FILES[exportType])
+        if exportType == 'html':
+            # the entries are filed under the name of the merged archive
+            writer = quadTree.TarWriter(archiveName,
+                                        compresslevel=settings.GEOCAM_TIE_POINT_TILE_ARCHIVE_COMPRESS_LEVEL,
+                                        path=partPath,
+                                        resumeState=checkpoint.writerState,
+                                        dirEntry=False)
+        else:
+            writer = quadTree.MBTilesWriter(archiveName,
+                                            path=partPath,
+                                            resumeState=checkpoint.writerState)
+        # the final checkpoint holds the writer state mergeExport() needs
+        gen.writeQuadTree(writer, slug, settings.GEOCAM_TIE_POINT_EXPORT_TILE_QUALITY,
+                          metatileSize=settings.GEOCAM_TIE_POINT_EXPORT_METATILE_SIZE,
+                          maxZoom=settings.GEOCAM_TIE_POINT_EXPORT_MAX_ZOOM,
+                          progress=progress,
+                          checkpoint=checkpoint,
+                          shardRanges=shardRanges)
+
+    def mergeExport(self, archiveName, metaJson, slug, exportType, partDirs):
+        """
+        Assembles the html or mbtiles export from the partial archives
+        that generateExportShard() wrote in @partDirs, in shard order.
+        The parts are copied as they are, not re-rendered or
+        recompressed. The cost recorded for the export is the time the
+        shards took in total, plus the merge.
+        """
+        startTime = time.time()
+        shardSeconds = 0
+        if exportType == 'html':
+            writer = quadTree.TarWriter(archiveName,
+                                        compresslevel=settings.GEOCAM_TIE_POINT_TILE_ARCHIVE_COMPRESS_LEVEL)
+        else:
+            writer = quadTree.MBTilesWriter(archiveName,
+                                            self.getMbtilesMetadata(archiveName, metaJson))
+        try:
+            for partDir in partDirs:
+                state = quadTree.ExportCheckpoint.load(os.path.join(partDir, 'checkpoint.json'))
+                if state is None or state['params']['quadTreeId'] != self.id:
+                    # e.g. the overlay was realigned while the shards rendered
+                    raise ValueError('%s holds no part of this export' % partDir)
+                writer.appendPart(os.path.join(partDir, EXPORT_PART_FILES[exportType]),
+                                  state['writerState'])
+                shardSeconds += state.get('seconds', 0)
+        except:
+            if exportType == 'mbtiles':
+                writer.discard()
+            raise
+        writer.writeData('meta.json', dumps(metaJson))
+        if exportType == 'html':
+            writer.writeData('view.html', self.getSimpleViewHtml('./%s' % slug, metaJson, slug))
+            self.htmlExportName = '%s.tar.gz' % archiveName
+            self.saveExport(self.htmlExport, self.htmlExportName, writer)
+        else:
+            self.mbtilesExportName = '%s.mbtiles' % archiveName
+            self.saveExport(self.mbtilesExport, self.mbtilesExportName, writer)
+        self.recordExportCost(exportType, shardSeconds + time.time() - startTime,
+                              getattr(self, exportType + 'Export'))
+
+    @staticmethod
+    def saveExport(fieldFile, name, writer):
+        """
+        Copies the finished archive from the writer's temp file to
+        storage without reading it all into memory.
+        """
+        archive = writer.getFile()
+        try:
+            fieldFile.save(name, File(archive))
+        finally:
+            archive.close()
 
         
-    def generateGeotiffExport(self, exportName, metaJson, slug):
+    def generateGeotiffExport(self, overlay, exportName, metaJson, slug, progress=None, workDir=None):
         """
-        This generates a geotiff from RPC.
+        This generates a geotiff from RPC. It always starts over.
         """
-        overlay = Overlay.objects.get(alignedQuadTree = self)
+        startTime = time.time()
         imageSizeType = overlay.imageData.sizeType
         now = datetime.datetime.utcnow()
         timestamp = now.strftime('%Y-%m-%d-%H%M%S-UTC')
@@ -464,15 +857,15 @@ class QuadTree(models.Model):
         geotiff_writer.writeData('meta.json', dumps(metaJson))
         geotiff_writer.addFile(fullFilePath, geotiffExportName + '/' + arcName)  # double check this line (second arg may not be necessary)
         self.geotiffExportName = '%s.tar.gz' % geotiffExportName
-        self.geotiffExport.save(self.geotiffExportName,
-                                ContentFile(geotiff_writer.getData()))
+        self.saveExport(self.geotiffExport, self.geotiffExportName, geotiff_writer)
+        self.recordExportCost('geotiff', time.time() - startTime, self.geotiffExport)
 
     
-    def generateKmlExport(self, exportName, metaJson, slug):
+    def generateKmlExport(self, overlay, exportName, metaJson, slug, progress=None, workDir=None):
         """
-        this generates the kml and the tiles.
+        this generates the kml and the tiles. It always starts over.
         """
-        overlay = Overlay.objects.get(alignedQuadTree = self)
+        startTime = time.time()
         imageSizeType = overlay.imageData.sizeType
         now = datetime.datetime.utcnow()
         timestamp = now.strftime('%Y-%m-%d-%H%M%S-UTC')
@@ -490,14 +883,25 @@ class QuadTree(models.Model):
         g2t.process()
         
         # tar the kml
-        kml_writer = quadTree.TarWriter(kmlExportName)
+        kml_writer = quadTree.TarWriter(kmlExportName,
+                                        compresslevel=settings.GEOCAM_TIE_POINT_TILE_ARCHIVE_COMPRESS_LEVEL)
         kml_writer.writeData('meta.json', dumps(metaJson))
         kml_writer.addFile(kmlFolderPath, kmlExportName)  # double check. second arg may not be necessary
         self.kmlExportName = '%s.tar.gz' % kmlExportName
-        self.kmlExport.save(self.kmlExportName, 
-                            ContentFile(kml_writer.getData()))      
+        self.saveExport(self.kmlExport, self.kmlExportName, kml_writer)
+        self.recordExportCost('kml', time.time() - startTime, self.kmlExport)
         
         
+@receiver(post_delete, sender=QuadTree)
+def deleteQuadTreeTiles(sender, instance, **kwargs):
+    """
+    Removes the tiles cached on disk by views.getTile. A signal handler
+    rather than QuadTree.delete(), so cascade and queryset deletes run
+    it too, and a later QuadTree that reuses the id starts clean.
+    """
+    shutil.rmtree(instance.getBasePath(), ignore_errors=True)
+
+
 class Overlay(models.Model):
     # required fields 
     key = models.AutoField(primary_key=True, unique=True)
@@ -566,6 +970,19 @@ class Overlay(models.Model):
             return None
         
 
+    def getUnalignedTilesUrl(self):
+        """
+        The tile url template for the unaligned image, with the image's
+        enhancement settings, which are applied as tiles are served.
+        """
+        url = reverse('geocamTiePoint_tile',
+                      args=[str(self.unalignedQuadTree.id)])
+        if self.imageData is not None:
+            enhancementKey = tileEnhancement.Enhancement.fromImageData(self.imageData).getKey()
+            if enhancementKey:
+                url += '?enhance=%s' % enhancementKey
+        return url
+
     def getAlignedTilesUrl(self):
         if self.isPublic:
             urlName = 'geocamTiePoint_publicTile'
@@ -601,8 +1018,7 @@ class Overlay(models.Model):
         if 'issMRF' not in result:
             result['issMRF'] = self.imageData.issMRF
         if self.unalignedQuadTree is not None:
-            result['unalignedTilesUrl'] = reverse('geocamTiePoint_tile',
-                                                  args=[str(self.unalignedQuadTree.id)])
+            result['unalignedTilesUrl'] = self.getUnalignedTilesUrl()
             result['unalignedTilesZoomOffset'] = quadTree.ZOOM_OFFSET
         if self.alignedQuadTree is not None:
             result['alignedTilesUrl'] = self.getAlignedTilesUrl()
@@ -676,9 +1092,16 @@ class Overlay(models.Model):
         now = datetime.datetime.utcnow()
         return 'georef-%s' % self.getSlug()
 
+    def getExportArchiveName(self, exportType, exportTime):
+        # same as the names the generate*Export methods make up
+        timestamp = exportTime.strftime('%Y-%m-%d-%H%M%S-UTC')
+        return (self.getExportName()
+                + ('-%s-%s_%s' % (self.imageData.sizeType, exportType, timestamp)))
+
     def generateUnalignedQuadTree(self):
-        qt = QuadTree(imageData=self.imageData)
-        qt.save()
+        qt, created = QuadTree.getOrCreate(self.imageData)
+        if created and settings.GEOCAM_TIE_POINT_PERSIST_UNALIGNED_TILES:
+            QuadTree.schedulePersistTilesToDisk(qt.id)
 
         self.unalignedQuadTree = qt
         self.save()
@@ -690,32 +1113,83 @@ class Overlay(models.Model):
             return None
         # grab the original image's imageData
         originalImageData = self.getRawImageData()
-        qt = QuadTree(imageData=originalImageData,
-                    transform=dumps(self.extras.transform))
-        qt.save()
+        qt, _created = QuadTree.getOrCreate(originalImageData,
+                                            dumps(self.extras.transform))
         self.alignedQuadTree = qt
         return qt
 
-    def generateHtmlExport(self):
+    def estimateExport(self, exportType):
+        return self.alignedQuadTree.estimateExport(exportType)
+
+    def generateHtmlExport(self, progress=None, workDir=None):
         (self.alignedQuadTree.generateHtmlExport
-         (self.getExportName(),
+         (self,
+          self.getExportName(),
           self.getJsonDict(),
-          self.getSlug()))
+          self.getSlug(),
+          progress,
+          workDir))
         return self.alignedQuadTree.htmlExport 
 
-    def generateKmlExport(self):
+    def generateKmlExport(self, progress=None, workDir=None):
         (self.alignedQuadTree.generateKmlExport
-         (self.getExportName(),
+         (self,
+          self.getExportName(),
           self.getJsonDict(),
-          self.getSlug()))
+          self.getSlug(),
+          progress,
+          workDir))
         return self.alignedQuadTree.kmlExport 
 
-    def generateGeotiffExport(self):
+    def generateMbtilesExport(self, progress=None, workDir=None):
+        (self.alignedQuadTree.generateMbtilesExport
+         (self,
+          self.getExportName(),
+          self.getJsonDict(),
+          self.getSlug(),
+          progress,
+          workDir))
+        return self.alignedQuadTree.mbtilesExport
+
+    def generateGeotiffExport(self, progress=None, workDir=None):
         (self.alignedQuadTree.generateGeotiffExport
-         (self.getExportName(),
+         (self,
+          self.getExportName(),
           self.getJsonDict(),
-          self.getSlug()))
+          self.getSlug(),
+          progress,
+          workDir))
         return self.alignedQuadTree.geotiffExport 
+
+    def getExportShards(self, numShards):
+        return self.alignedQuadTree.getExportShards(numShards)
+
+    def generateExportShard(self, exportType, shardRanges, workDir, exportTime, progress=None):
+        (self.alignedQuadTree.generateExportShard
+         (self.getExportArchiveName(exportType, exportTime),
+          self.getSlug(),
+          exportType,
+          shardRanges,
+          workDir,
+          progress))
+
+    def mergeExport(self, exportType, partDirs, exportTime):
+        (self.alignedQuadTree.mergeExport
+         (self.getExportArchiveName(exportType, exportTime),
+          self.getJsonDict(),
+          self.getSlug(),
+          exportType,
+          partDirs))
+        return getattr(self.alignedQuadTree, exportType + 'Export')
+
+    def generateExport(self, exportType, progress=None, workDir=None):
+        generators = {'html': self.generateHtmlExport,
+                      'kml': self.generateKmlExport,
+                      'mbtiles': self.generateMbtilesExport,
+                      'geotiff': self.generateGeotiffExport}
+        if exportType not in generators:
+            raise ValueError('unknown export type %s' % exportType)
+        return generators[exportType](progress, workDir)
     
     def updateAlignment(self):
         toPts, fromPts = transform.splitPoints(self.extras.points)
@@ -729,8 +1203,149 @@ class Overlay(models.Model):
                 .getSimpleViewHtml(alignedTilesRootUrl,
                                    self.getJsonDict(),
                                    self.getSlug()))
-        
-        
+
+
+EXPORT_JOB_STATUS_CHOICES = (('waiting', 'Waiting for shards'),
+                             ('queued', 'Queued'),
+                             ('running', 'Running'),
+                             ('done', 'Done'),
+                             ('failed', 'Failed'),
+                             ('canceled', 'Canceled'))
+
+
+class ExportJob(models.Model):
+    """
+    An export of an overlay, queued by overlayGenerateExport and
+    rendered by an exportWorker process (see exportQueue). Jobs with
+    higher priority run first, then the oldest.
+
+    A sharded export is a parent job with numShards shard jobs, each
+    rendering a range of tile columns (shardRanges) into a partial
+    archive, possibly on different hosts. The parent waits until they
+    are all done, then merges the parts.
+    """
+    overlay = models.ForeignKey(Overlay, related_name='exportJobs')
+    exportType = models.CharField(max_length=16)
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=16, choices=EXPORT_JOB_STATUS_CHOICES,
+                              default='queued', db_index=True)
+    createdTime = models.DateTimeField()
+    startTime = models.DateTimeField(null=True, blank=True)
+    endTime = models.DateTimeField(null=True, blank=True)
+    # last time the worker reported progress or sent a heartbeat
+    updateTime = models.DateTimeField(null=True, blank=True)
+    # last time the worker reported progress in the current run
+    progressTime = models.DateTimeField(null=True, blank=True)
+    completedTiles = models.IntegerField(default=0)
+    # the part of completedTiles that the current run skipped because
+    # an earlier run had rendered them
+    resumedTiles = models.IntegerField(default=0)
+    totalTiles = models.IntegerField(default=0)
+    # exportEstimator's guess, used for the ETA until there is progress
+    estimatedSeconds = models.FloatField(null=True, blank=True)
+    cancelRequested = models.BooleanField(default=False)
+    # host-pid of the worker running the job
+    worker = models.CharField(max_length=255, blank=True)
+    # how many times a worker has started the job
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True)
+    # set on the parent of a sharded export
+    numShards = models.IntegerField(default=0)
+    # set on shards
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='shards')
+    shardIndex = models.IntegerField(null=True, blank=True)
+    # JSON list of [zoom, xmin, xmax] tile column ranges
+    shardRanges = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-priority', 'createdTime']
+
+    def __unicode__(self):
+        return ('ExportJob id=%s overlay=%s type=%s status=%s'
+                % (self.id, self.overlay_id, self.exportType, self.status))
+
+    def isFinished(self):
+        return self.status in ('done', 'failed', 'canceled')
+
+    def getShardRanges(self):
+        return json.loads(self.shardRanges)
+
+    def getWorkDir(self):
+        """
+        Directory for the partial output and checkpoint of the job,
+        which a worker that picks up an interrupted job resumes from.
+        """
+        if self.parent_id is not None:
+            # where the parent job merges it from
+            return os.path.join(self.parent.getWorkDir(), 'shard%s' % self.shardIndex)
+        return settings.DATA_ROOT + 'geocamTiePoint/exportWork/job%s' % self.id
+
+    def getProgress(self):
+        """
+        Returns the fraction of the job that is done, from 0 to 1.
+        """
+        if self.status == 'done':
+            return 1.0
+        if self.status == 'waiting':
+            shards = self.shards.all()
+            completedTiles = sum([s.completedTiles for s in shards])
+            totalTiles = sum([s.totalTiles for s in shards])
+        else:
+            completedTiles, totalTiles = self.completedTiles, self.totalTiles
+        if not totalTiles:
+            return 0.0
+        return min(float(completedTiles) / totalTiles, 1.0)
+
+    def getEtaSeconds(self):
+        """
+        Returns the expected number of seconds until the job is done,
+        or None if we can't tell.
+        """
+        if self.isFinished():
+            return 0
+        if self.status == 'waiting':
+            # shards run in parallel, if there are enough workers
+            shardEtas = [s.getEtaSeconds() for s in self.shards.all()]
+            if None in shardEtas:
+                return self.estimatedSeconds
+            return max(shardEtas)
+        # the rate comes from the tiles rendered in the current run;
+        # startTime is reset when a worker resumes the job
+        renderedTiles = self.completedTiles - self.resumedTiles
+        if self.status == 'running' and self.progressTime is not None and renderedTiles > 0:
+            elapsed = (self.progressTime - self.startTime).total_seconds()
+            remainingTiles = max(self.totalTiles - self.completedTiles, 0)
+            sinceProgress = (datetime.datetime.utcnow() - self.progressTime).total_seconds()
+            return max(elapsed * remainingTiles / renderedTiles - sinceProgress, 0)
+        if self.estimatedSeconds is None:
+            return None
+        if self.status == 'running':
+            elapsed = (datetime.datetime.utcnow() - self.startTime).total_seconds()
+            return max(self.estimatedSeconds - elapsed, 0)
+        return self.estimatedSeconds
+
+    def getJsonDict(self):
+        return {'id': self.id,
+                'overlayId': self.overlay_id,
+                'exportType': self.exportType,
+                'priority': self.priority,
+                'status': self.status,
+                'progress': self.getProgress(),
+                'completedTiles': self.completedTiles,
+                'totalTiles': self.totalTiles,
+                'etaSeconds': self.getEtaSeconds(),
+                'cancelRequested': self.cancelRequested,
+                'attempts': self.attempts,
+                'numShards': self.numShards,
+                'parentId': self.parent_id,
+                'shardIndex': self.shardIndex,
+                'createdTime': self.createdTime.isoformat(),
+                'startTime': self.startTime.isoformat() if self.startTime else None,
+                'endTime': self.endTime.isoformat() if self.endTime else None,
+                'error': self.error,
+                'statusUrl': reverse('geocamTiePoint_exportJobStatus', args=[self.id])}
+
+
 #########################################
 # models for autoregistration pipeline  #
 #########################################
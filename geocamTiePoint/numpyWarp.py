@@ -0,0 +1,258 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Warp engine that resamples the source image in numpy from a dense
+per-pixel map of source coordinates, as an alternative to PIL's
+Image.transform() with QUAD or MESH. Every target pixel gets its own
+exact reverse transform, so there is no mesh approximation error.
+
+For transforms with a vectorized reverseArray() the map is computed
+exactly at every pixel. For the others (which invert by iterative
+optimization, one point at a time) it is computed on a grid every
+GRID_STEP pixels and interpolated bilinearly.
+
+Like Image.transform(), target pixels whose source point falls
+outside the image are transparent, and the filter clamps at the image
+edges. Resampling works on premultiplied alpha, so transparent source
+pixels don't bleed dark fringes into their neighbors.
+"""
+
+import math
+
+import numpy
+from PIL import Image
+
+from geocamTiePoint import transform, sourceRaster
+
+TILE_SIZE = transform.TILE_SIZE
+
+# spacing of the exact reverse transforms, in tile pixels, for
+# transforms that can't be evaluated at every pixel
+GRID_STEP = 32
+
+# source pixels read around the sample points, enough for the widest
+# (bicubic) filter
+WINDOW_MARGIN = 3
+
+
+def getSourceCoordinatesExact(tform, zoom, px, py):
+    """
+    Returns (sx, sy) arrays of shape (len(py), len(px)) with the source
+    pixel coordinates of the mercator tile pixel coordinates px, py.
+    """
+    gx, gy = numpy.meshgrid(px, py)
+    mx, my = transform.pixelsToMeters(gx.ravel(), gy.ravel(), zoom)
+    source = tform.reverseArray(numpy.column_stack([mx, my]))
+    return (source[:, 0].reshape(gx.shape),
+            source[:, 1].reshape(gx.shape))
+
+
+def interpolateGrid(values, gridPx, gridPy, px, py):
+    """
+    Bilinearly interpolates @values, sampled at the grid positions
+    gridPx x gridPy, at the positions px x py.
+    """
+    def getIndexAndWeight(gridPos, pos):
+        f = (pos - gridPos[0]) / (gridPos[1] - gridPos[0])
+        i = numpy.clip(numpy.floor(f).astype(int), 0, len(gridPos) - 2)
+        return i, f - i
+
+    ix, wx = getIndexAndWeight(gridPx, px)
+    iy, wy = getIndexAndWeight(gridPy, py)
+    iy = iy[:, numpy.newaxis]
+    wy = wy[:, numpy.newaxis]
+    top = (1 - wx) * values[iy, ix] + wx * values[iy, ix + 1]
+    bottom = (1 - wx) * values[iy + 1, ix] + wx * values[iy + 1, ix + 1]
+    return (1 - wy) * top + wy * bottom
+
+
+def getSourceCoordinates(tform, zoom, x, y, width, height, scale):
+    """
+    Returns (sx, sy) arrays of shape (height, width) with the source
+    pixel coordinates of the pixel centers of a width x height target
+    image whose upper-left corner is the corner of tile (x, y), with
+    @scale target pixels per tile pixel. Points that have no inverse
+    are nan.
+    """
+    px = x * TILE_SIZE + (numpy.arange(width) + 0.5) / scale
+    py = y * TILE_SIZE + (numpy.arange(height) + 0.5) / scale
+    if tform.hasFastReverseArray:
+        return getSourceCoordinatesExact(tform, zoom, px, py)
+
+    # the grid is aligned to multiples of GRID_STEP, so that the
+    # interpolated coordinates don't depend on the extent of the image
+    step = float(GRID_STEP)
+    gridLeft = math.floor(px[0] / step) * step
+    gridTop = math.floor(py[0] / step) * step
+    numX = int(math.ceil((px[-1] - gridLeft) / step)) + 1
+    numY = int(math.ceil((py[-1] - gridTop) / step)) + 1
+    gridPx = gridLeft + step * numpy.arange(max(numX, 2))
+    gridPy = gridTop + step * numpy.arange(max(numY, 2))
+    gridSx, gridSy = getSourceCoordinatesExact(tform, zoom, gridPx, gridPy)
+    return (interpolateGrid(gridSx, gridPx, gridPy, px, py),
+            interpolateGrid(gridSy, gridPx, gridPy, px, py))
+
+
+def getCubicWeights(t):
+    """
+    Returns the four Catmull-Rom (Keys, a = -0.5) weights for taps at
+    offsets -1, 0, 1, 2 from the sample's integer position, where @t is
+    its fractional part.
+    """
+    t2 = t * t
+    t3 = t2 * t
+    return [-0.5 * t3 + t2 - 0.5 * t,
+            1.5 * t3 - 2.5 * t2 + 1,
+            -1.5 * t3 + 2 * t2 + 0.5 * t,
+            0.5 * t3 - 0.5 * t2]
+
+
+def resampleArray(source, u, v, resample):
+    """
+    Samples the premultiplied float array @source (rows x cols x 4) at
+    the 1-D arrays of coordinates u (column), v (row), where integer
+    coordinates are pixel centers, clamping at the edges. Returns an
+    array of shape (len(u), 4).
+    """
+    rows, cols = source.shape[:2]
+    flat = source.reshape((rows * cols, 4))
+
+    # flat indices of the taps are rowOffset[j] + column[i], with rows
+    # and columns clamped separately
+    def getColumns(i):
+        return numpy.clip(i, 0, cols - 1)
+
+    def getRowOffsets(j):
+        return numpy.clip(j, 0, rows - 1) * cols
+
+    if resample == Image.NEAREST:
+        return flat.take(getRowOffsets(numpy.floor(v + 0.5).astype(int))
+                         + getColumns(numpy.floor(u + 0.5).astype(int)), axis=0)
+
+    if resample == Image.BILINEAR:
+        offsets = (0, 1)
+    elif resample == Image.BICUBIC:
+        offsets = (-1, 0, 1, 2)
+    else:
+        raise ValueError('unsupported resampling filter %s' % resample)
+
+    i0 = numpy.floor(u).astype(int)
+    j0 = numpy.floor(v).astype(int)
+    tx = (u - i0).astype('float32')[:, numpy.newaxis]
+    ty = (v - j0).astype('float32')[:, numpy.newaxis]
+    if resample == Image.BILINEAR:
+        wx = [1 - tx, tx]
+        wy = [1 - ty, ty]
+    else:
+        wx = getCubicWeights(tx)
+        wy = getCubicWeights(ty)
+    columns = [getColumns(i0 + di) for di in offsets]
+
+    result = numpy.zeros((len(u), 4), dtype='float32')
+    for wj, dj in zip(wy, offsets):
+        rowOffsets = getRowOffsets(j0 + dj)
+        row = numpy.zeros((len(u), 4), dtype='float32')
+        for wi, column in zip(wx, columns):
+            row += wi * flat.take(rowOffsets + column, axis=0)
+        result += wj * row
+    return result
+
+
+def getSourceWindow(image, window, reduction):
+    """
+    Returns @window, grown if needed so that it maps to whole pixels of
+    the overview level getSourceArray() reads from.
+    """
+    if not isinstance(image, sourceRaster.TiledRaster):
+        return window
+    _level, factor = image.getLevelForScale(reduction)
+    if factor == 1:
+        return window
+    # the right and bottom edges may stay at the image edge, the
+    # overview level covers the partial pixel there
+    return (window[0] // factor * factor,
+            window[1] // factor * factor,
+            min(-(-window[2] // factor) * factor, image.size[0]),
+            min(-(-window[3] // factor) * factor, image.size[1]))
+
+
+def getSourceArray(image, window, reduction):
+    """
+    Reads the @window box of @image, shrunk by the integer factor
+    @reduction, as a premultiplied float32 array. If @image is a
+    TiledRaster, the window is read from the overview level that
+    matches @reduction; see getSourceWindow().
+    """
+    factor = 1
+    if isinstance(image, sourceRaster.TiledRaster):
+        image, factor = image.getLevelForScale(reduction)
+        window = (window[0] // factor,
+                  window[1] // factor,
+                  -(-window[2] // factor),
+                  -(-window[3] // factor))
+    windowImage = image.crop(window)
+    if windowImage.mode != 'RGBA':
+        windowImage = windowImage.convert('RGBA')
+    if reduction > factor:
+        width, height = windowImage.size
+        scale = float(factor) / reduction
+        windowImage = windowImage.resize((int(math.ceil(width * scale)),
+                                          int(math.ceil(height * scale))),
+                                         Image.ANTIALIAS)
+    arr = numpy.asarray(windowImage, dtype='float32')
+    return numpy.dstack([arr[:, :, :3] * (arr[:, :, 3:] / 255.0), arr[:, :, 3]])
+
+
+def warp(image, sx, sy, resample=Image.BICUBIC):
+    """
+    Returns an RGBA image of shape sx.shape whose pixels are sampled
+    from @image at the source coordinates sx, sy. Only the window of
+    @image under the sample points is read. Where the sample points
+    are much sparser than the source pixels, the window is first
+    shrunk by an integer factor so that the filter doesn't alias.
+    """
+    height, width = sx.shape
+    imageWidth, imageHeight = image.size
+    inside = ((sx >= 0) & (sx < imageWidth)
+              & (sy >= 0) & (sy < imageHeight))
+    numInside = numpy.count_nonzero(inside)
+    if not numInside:
+        return Image.new('RGBA', (width, height))
+    sxInside = sx[inside]
+    syInside = sy[inside]
+    margin = WINDOW_MARGIN
+    window = (max(int(math.floor(sxInside.min())) - margin, 0),
+              max(int(math.floor(syInside.min())) - margin, 0),
+              min(int(math.ceil(sxInside.max())) + margin, imageWidth),
+              min(int(math.ceil(syInside.max())) + margin, imageHeight))
+
+    # source pixels per target pixel, from the footprint of the samples
+    density = math.sqrt(float((window[2] - window[0]) * (window[3] - window[1]))
+                        / numInside)
+    reduction = max(int(density), 1)
+    window = getSourceWindow(image, window, reduction)
+    source = getSourceArray(image, window, reduction)
+
+    samples = resampleArray(source,
+                            (sxInside - window[0]) / reduction - 0.5,
+                            (syInside - window[1]) / reduction - 0.5,
+                            resample)
+    alpha = numpy.clip(samples[:, 3:], 0, 255)
+    rgb = numpy.where(alpha > 0, samples[:, :3] * 255.0 / numpy.maximum(alpha, 1e-6), 0)
+    out = numpy.zeros((height, width, 4), dtype='uint8')
+    out[inside] = numpy.round(numpy.hstack([numpy.clip(rgb, 0, 255), alpha]))
+    return Image.fromarray(out, 'RGBA')
@@ -19,6 +19,9 @@
 
 import json
 import os
+import errno
+import hashlib
+import functools
 import math
 import sys
 import time
@@ -26,25 +29,88 @@ try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
+import re
 import zipfile
 import tarfile
+import tempfile
+import sqlite3
+from collections import OrderedDict
 
 from PIL import Image
 import numpy
 import numpy.linalg
 
 from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 
-from geocamTiePoint import transform
+from geocamTiePoint import transform, sourceRaster, numpyWarp
+from geocamTiePoint.tileProfiler import profiler, writeJsonAtomic, readJson
 
+# minimum size (in target tile pixels) of a patch in the adaptive warp mesh
 PATCH_SIZE = 32
+# max allowed error (in source image pixels) between the exact reverse
+# transform and the bilinear interpolation PIL uses within a mesh patch
+MESH_TOLERANCE = 0.5
+# tiles are warped from a crop of their source window, unless the window
+# covers more than this fraction of the image (low zoom levels), where
+# the crop would cost more than it saves
+MAX_SOURCE_WINDOW_FRACTION = 0.25
+# default cap on the memory used by the downsampled levels that
+# SimpleQuadTreeGenerator keeps around
+DEFAULT_PYRAMID_CACHE_BYTES = 256 * 1024 * 1024
+# 'pil' warps with Image.transform() QUAD/MESH, 'numpy' with numpyWarp
+WARP_ENGINES = ('pil', 'numpy')
+DEFAULT_WARP_ENGINE = 'pil'
 TILE_SIZE = transform.TILE_SIZE
-PATCHES_PER_TILE = int(TILE_SIZE / PATCH_SIZE)
-PATCH_ZOOM_OFFSET = math.log(PATCHES_PER_TILE, 2)
 ZOOM_OFFSET = 3
-BENCHMARK_WARP_STEPS = False
 BLACK = (0, 0, 0)
 GRAY = (192, 192, 192)
+# sentinel for reverse-transform memo lookups (None is a valid result)
+MISSING_POINT = object()
+# points per image edge in the overlay footprint polygon
+FOOTPRINT_EDGE_STEPS = 17
+# margin (in tile pixels) around the footprint within which warping
+# and resizing can still leave partially transparent pixels
+FOOTPRINT_MARGIN = 4
+
+# named rendering quality profiles for warped tiles. supersample is the
+# factor by which the warp canvas exceeds TILE_SIZE; when it is greater
+# than 1 the canvas is downsampled to TILE_SIZE using resizeFilter.
+#  draft: nearest-neighbor, no supersampling. the fastest; served as
+#    the short-lived preview tile while progressive tile serving
+#    renders the final one (see views.PREVIEW_TILE_QUALITY).
+#  preview: bilinear, no supersampling. cheap but smooth, for clients
+#    that ask for it with ?quality=preview.
+#  standard: bicubic at 2x, downsampled with ANTIALIAS. the default for
+#    served tiles (TILE_QUALITY).
+#  export: bicubic at 3x, downsampled with LANCZOS, for exported tiles
+#    (EXPORT_TILE_QUALITY). compared to 'standard', it roughly halves
+#    the error against an 8x render of fine detail, for 1.4-2x the warp
+#    time (bin/benchmarkTiler.py cases). 4x only gains a little more, at
+#    2-3.5x the time.
+QUALITY_PROFILES = {
+    'draft': {'supersample': 1,
+              'warpFilter': Image.NEAREST,
+              'resizeFilter': None},
+    'preview': {'supersample': 1,
+                'warpFilter': Image.BILINEAR,
+                'resizeFilter': None},
+    'standard': {'supersample': 2,
+                 'warpFilter': Image.BICUBIC,
+                 'resizeFilter': Image.ANTIALIAS},
+    'export': {'supersample': 3,
+               'warpFilter': Image.BICUBIC,
+               'resizeFilter': Image.LANCZOS},
+}
+DEFAULT_QUALITY = 'standard'
+
+
+def getQualityProfile(quality):
+    try:
+        return QUALITY_PROFILES[quality]
+    except KeyError:
+        raise ValueError('unknown quality profile %s, expected one of: %s'
+                         % (quality, ', '.join(sorted(QUALITY_PROFILES.keys()))))
 
 
 class ZoomTooBig(Exception):
@@ -132,6 +198,47 @@ def getImageCorners(image):
             (w, h))
 
 
+def getImageRing(image):
+    """
+    Like getImageCorners(), but in order around the image, so the
+    corners form a polygon.
+    """
+    w, h = image.size
+    return ((0, 0),
+            (w, 0),
+            (w, h),
+            (0, h))
+
+
+def clipPolygon(points, axis, value, keepGreater):
+    """
+    Clips the polygon @points to the half-plane where coordinate @axis
+    is >= @value (keepGreater) or <= @value (Sutherland-Hodgman).
+    """
+    def isInside(pt):
+        if keepGreater:
+            return pt[axis] >= value
+        else:
+            return pt[axis] <= value
+
+    if not points:
+        return []
+    result = []
+    for p1, p2 in pairsWithWrap(points):
+        if isInside(p1) != isInside(p2):
+            d = float(value - p1[axis]) / (p2[axis] - p1[axis])
+            result.append((p1[0] + d * (p2[0] - p1[0]),
+                           p1[1] + d * (p2[1] - p1[1])))
+        if isInside(p2):
+            result.append(p2)
+    return result
+
+
+def boxesIntersect(box1, box2):
+    return (box1[0] < box2[2] and box2[0] < box1[2]
+            and box1[1] < box2[3] and box2[1] < box1[3])
+
+
 def calculateMaxZoom(bounds, image):
     metersPerPixelX = (bounds.xmax - bounds.xmin) / image.size[0]
     metersPerPixelY = (bounds.ymax - bounds.ymin) / image.size[1]
@@ -147,11 +254,11 @@ def tileIndex(zoom, mercatorCoords):
     return index
 
 
-def tileExtent(zoom, x, y):
+def tileExtent(zoom, x, y, numX=1, numY=1):
     corners = ((x, y),
-               (x, y + 1),
-               (x + 1, y + 1),
-               (x + 1, y))
+               (x, y + numY),
+               (x + numX, y + numY),
+               (x + numX, y))
     pixelCorners = [tileIndexToPixels(*corner) for corner in corners]
     mercatorCorners = [transform.pixelsToMeters(*(pixels + (zoom,))) for pixels in pixelCorners]
     return mercatorCorners
@@ -190,15 +297,135 @@ def flatten(listOfLists):
     return [item for subList in listOfLists for item in subList]
 
 
-def getImageDataPng(image):
+def getImageDataPng(image, **saveOptions):
     out = StringIO()
-    image.save(out, format='png')
+    image.save(out, format='png', **saveOptions)
     return (out.getvalue(), 'image/png')
 
 
-def getTileCacheKey(quadTreeId, zoom, x, y):
-    return ('geocamTiePoint.tile.%s.%s.%s.%s'
-            % (quadTreeId, zoom, x, y))
+def getImageDataPngPalette(image, **saveOptions):
+    # fast octree is the only PIL quantizer that keeps the alpha channel
+    image = image.quantize(256, Image.FASTOCTREE)
+    return getImageDataPng(image, **saveOptions)
+
+
+def getImageDataWebp(image, **saveOptions):
+    out = StringIO()
+    image.save(out, format='webp', **saveOptions)
+    return (out.getvalue(), 'image/webp')
+
+
+def getTileCacheKey(quadTreeId, zoom, x, y, quality=DEFAULT_QUALITY,
+                    encoding=None, enhancement=''):
+    """
+    @enhancement is a tileEnhancement key; tiles enhanced at serving
+    time are cached separately from the unenhanced ones.
+    """
+    key = ('geocamTiePoint.tile.%s.%s.%s.%s'
+           % (quadTreeId, zoom, x, y))
+    if quality != DEFAULT_QUALITY:
+        key += '.%s' % quality
+    if encoding is not None:
+        key += '.%s' % encoding
+    if enhancement:
+        key += '.e%s' % enhancement
+    return key
+
+
+def getContentHash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+TILE_CONTENT_CACHE_KEY_PREFIX = 'geocamTiePoint.tileContent.'
+
+
+def getTileContentCacheKey(contentHash):
+    return TILE_CONTENT_CACHE_KEY_PREFIX + contentHash
+
+
+def getCachedTileHash(key):
+    """
+    Returns the content hash of the tile cached under the tile key
+    @key, or None on a miss, without fetching the tile itself.
+    """
+    contentKey = cache.get(key)
+    if contentKey is None:
+        return None
+    return contentKey[len(TILE_CONTENT_CACHE_KEY_PREFIX):]
+
+
+def getCachedTile(key):
+    """
+    Returns the (bits, contentType) tuple cached under the tile key
+    @key, or None on a miss. Tile keys hold a reference to a
+    content-addressed entry, so identical tiles are cached once.
+    """
+    contentKey = cache.get(key)
+    if contentKey is None:
+        return None
+    return cache.get(contentKey)
+
+
+def setCachedTile(key, data, timeout=DEFAULT_TIMEOUT):
+    """
+    Caches @data under the tile key @key. The timeout only applies to
+    the reference; the content entry may be shared with other tiles so
+    it always gets the default timeout.
+    """
+    bits, _contentType = data
+    contentKey = getTileContentCacheKey(getContentHash(bits))
+    cache.set(contentKey, data)
+    cache.set(key, contentKey, timeout)
+
+
+def isTransparent(image):
+    """
+    True if every pixel of the image has zero alpha.
+    """
+    if image.mode != 'RGBA':
+        return False
+    return image.getextrema()[3][1] == 0
+
+
+# encoded fully transparent tiles, keyed by encoding name
+EMPTY_TILE_DATA = {}
+EMPTY_TILE_IMAGE = []
+
+
+def getEmptyTileImage():
+    """
+    Returns the shared fully transparent tile image. Don't modify it.
+    """
+    if not EMPTY_TILE_IMAGE:
+        EMPTY_TILE_IMAGE.append(Image.new('RGBA', (int(TILE_SIZE),) * 2, (0, 0, 0, 0)))
+    return EMPTY_TILE_IMAGE[0]
+
+
+def getEmptyTileData(encoding):
+    """
+    Returns the encoded fully transparent tile for @encoding, encoding
+    it only once per process.
+    """
+    result = EMPTY_TILE_DATA.get(encoding)
+    if result is None:
+        result = getTileEncoder(encoding)['encode'](getEmptyTileImage())
+        EMPTY_TILE_DATA[encoding] = result
+    return result
+
+
+def encodeTile(image, encoding):
+    """
+    Encodes @image with the registered tile encoder @encoding,
+    short-circuiting to the shared empty tile when the image is fully
+    transparent.
+    """
+    if image is getEmptyTileImage() or isTransparent(image):
+        return getEmptyTileData(encoding)
+    return getTileEncoder(encoding)['encode'](image)
+
+
+def getImageBytes(image):
+    return image.size[0] * image.size[1] * len(image.getbands())
 
 
 def setBackgroundColor(image, backgroundColor):
@@ -210,13 +437,109 @@ def setBackgroundColor(image, backgroundColor):
     return background
 
 
-def getImageDataJpg(image):
+def getImageDataJpg(image, **saveOptions):
     out = StringIO()
     image = setBackgroundColor(image, GRAY)
-    image.save(out, format='jpeg')
+    image.save(out, format='jpeg', **saveOptions)
     return (out.getvalue(), 'image/jpeg')
 
 
+# tile encoders, keyed by encoding name ('format' or 'format-variant').
+# contentType and hasAlpha let views negotiate an encoding from the
+# Accept header before rendering.
+TILE_ENCODERS = {}
+
+
+def registerTileEncoder(name, contentType, hasAlpha, encodeFunc, **saveOptions):
+    TILE_ENCODERS[name] = {'contentType': contentType,
+                           'hasAlpha': hasAlpha,
+                           'encode': functools.partial(encodeFunc, **saveOptions)}
+
+
+def getTileEncoder(encoding):
+    try:
+        return TILE_ENCODERS[encoding]
+    except KeyError:
+        raise ValueError('unknown tile encoding %s, expected one of: %s'
+                         % (encoding, ', '.join(sorted(TILE_ENCODERS.keys()))))
+
+
+# PIL defaults (zlib level 6, adaptive row filters)
+registerTileEncoder('png', 'image/png', True, getImageDataPng)
+registerTileEncoder('png-fast', 'image/png', True, getImageDataPng,
+                    compress_level=1)
+registerTileEncoder('png-small', 'image/png', True, getImageDataPng,
+                    optimize=True)
+# zlib Z_RLE strategy: much faster than the default, and tiles with
+# large flat or transparent areas compress nearly as well
+registerTileEncoder('png-rle', 'image/png', True, getImageDataPng,
+                    compress_type=3)
+registerTileEncoder('png-palette', 'image/png', True, getImageDataPngPalette)
+registerTileEncoder('jpeg', 'image/jpeg', False, getImageDataJpg)
+registerTileEncoder('jpeg-low', 'image/jpeg', False, getImageDataJpg,
+                    quality=60)
+registerTileEncoder('jpeg-high', 'image/jpeg', False, getImageDataJpg,
+                    quality=90)
+Image.init()
+if 'WEBP' in Image.SAVE:
+    registerTileEncoder('webp', 'image/webp', True, getImageDataWebp,
+                        quality=80)
+    registerTileEncoder('webp-lossless', 'image/webp', True, getImageDataWebp,
+                        lossless=True)
+
+
+def parseAcceptHeader(accept):
+    """
+    Returns a dict mapping each media type listed in the HTTP Accept
+    header @accept to its q value.
+    """
+    result = {}
+    for item in accept.split(','):
+        params = item.strip().split(';')
+        mediaType = params[0].strip().lower()
+        if not mediaType:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        result[mediaType] = q
+    return result
+
+
+def negotiateTileEncoding(accept, preferredEncodings, needsAlpha):
+    """
+    Returns the first of @preferredEncodings whose content type the
+    client explicitly lists in the Accept header @accept, or None if
+    the generator's default encoding should be used. Wildcards don't
+    count, since every client accepts the defaults.
+    """
+    accepted = parseAcceptHeader(accept or '')
+    for encoding in preferredEncodings:
+        encoder = TILE_ENCODERS.get(encoding)
+        if encoder is None:
+            continue
+        if needsAlpha and not encoder['hasAlpha']:
+            continue
+        if accepted.get(encoder['contentType'], 0) > 0:
+            return encoding
+    return None
+
+
+def getNegotiableTileEncodings(preferredEncodings, needsAlpha):
+    """
+    Returns the encodings negotiateTileEncoding() may pick from
+    @preferredEncodings, including None for the generator's default.
+    """
+    return [None] + [encoding for encoding in preferredEncodings
+                     if encoding in TILE_ENCODERS
+                     and (TILE_ENCODERS[encoding]['hasAlpha'] or not needsAlpha)]
+
+
 
 def imageMapBounds(imageSize, tform):
     w, h = imageSize
@@ -242,10 +565,22 @@ def contentTypeToExtension(contentType):
         return '.png'
     elif contentType == 'image/jpeg':
         return '.jpg'
+    elif contentType == 'image/webp':
+        return '.webp'
     else:
         raise ValueError('unknown content type')
 
 
+# files with these extensions are already compressed. deflating them
+# again costs CPU and saves next to nothing, so archive writers store
+# them as-is where the archive format allows it.
+COMPRESSED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.gz', '.tgz', '.zip')
+
+
+def isCompressedPath(path):
+    return os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS
+
+
 def getDirTarInfo(name, mode=0755):
     result = tarfile.TarInfo(name)
     result.mtime = time.time()
@@ -263,62 +598,192 @@ def getFileTarInfo(name, rawData, mode=0644):
     return result
 
 
+def getLinkTarInfo(name, linkName, mode=0644):
+    result = tarfile.TarInfo(name)
+    result.mtime = time.time()
+    result.mode = mode
+    result.type = tarfile.LNKTYPE
+    result.linkname = linkName
+    return result
+
+
+def getSymlinkZipInfo(name, mode=0777):
+    result = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    result.create_system = 3  # unix, so external_attr is honored
+    result.external_attr = (0120000 | mode) << 16  # S_IFLNK
+    return result
+
+
 class TarWriter(object):
     """
-    A writer class where writeX() methods add file entries to an
-    in-memory tar.gz file.  The paths of all entries in the tarball are
-    prefixed with dirName. Once all entries have been added, the raw
-    tarball contents can be extracted using the getData() method and
-    written to a file or blob storage.
+    A writer class where writeX() methods add file entries to a tar.gz
+    file that is streamed to an anonymous temp file on disk, so memory
+    use doesn't grow with the archive. The paths of all entries in the
+    tarball are prefixed with dirName. Once all entries have been added,
+    getFile() returns a handle on the finished archive that can be
+    handed to file or blob storage (getData() returns the raw bytes).
+
+    gzip compresses the whole stream, so already-compressed entries
+    can't be stored individually; callers writing mostly tiles should
+    pass a low compresslevel instead.
+
+    If dedupe is set, entries whose data duplicates an earlier entry
+    are written as hard links to the first copy.
+
+    Given a path, the archive is written there instead, and can be
+    resumed: checkpoint() ends the current gzip member and makes the
+    file durable, and a new writer built with the state it returned
+    (resumeState) drops anything written after that point and appends
+    to the archive. gzip readers treat the members as a single stream.
+
+    The same way, the output of writers with dirEntry=False, finished
+    with checkpoint(), can be merged into another archive with
+    appendPart() by copying its gzip members as they are.
     """
 
-    def __init__(self, dirName):
+    def __init__(self, dirName, dedupe=True, compresslevel=9, path=None,
+                 resumeState=None, dirEntry=True):
         self.dirName = dirName
-        self.out = StringIO()
-        self.tar = tarfile.open(fileobj=self.out, mode='w:gz')
-        self.tar.addfile(getDirTarInfo(self.dirName))
+        self.dedupe = dedupe
+        self.compresslevel = compresslevel
+        self.contentPaths = {}
+        self.path = path
+        self.tar = None
+        # size of the uncompressed tar stream ended by the last checkpoint
+        self.tarOffset = 0
+        if path is None:
+            self.out = tempfile.TemporaryFile(suffix='.tar.gz')
+        elif resumeState:
+            self.out = open(path, 'r+b')
+            self.out.seek(0, os.SEEK_END)
+            if self.out.tell() < resumeState['offset']:
+                raise IOError('%s is shorter than its checkpoint' % path)
+            self.out.truncate(resumeState['offset'])
+            self.out.seek(0, os.SEEK_END)
+            self.tarOffset = resumeState['tarOffset']
+        else:
+            self.out = open(path, 'w+b')
+        if dirEntry and not resumeState:
+            self.getTar().addfile(getDirTarInfo(self.dirName))
         self.closed = False
-    
+
+    def getTar(self):
+        if self.tar is None:
+            self.tar = tarfile.open(fileobj=self.out, mode='w:gz',
+                                    compresslevel=self.compresslevel)
+            # keep tar's block accounting continuous across gzip members
+            self.tar.offset = self.tarOffset
+        return self.tar
+
+    def checkpoint(self):
+        """
+        Flushes everything written so far to disk and returns a
+        JSON-friendly state to resume from.
+        """
+        assert not self.closed
+        self.endMember()
+        self.out.flush()
+        os.fsync(self.out.fileno())
+        return {'offset': self.out.tell(),
+                'tarOffset': self.tarOffset}
+
+    def endMember(self):
+        if self.tar is not None:
+            self.tarOffset = self.tar.offset
+            # close the gzip member without writing tar's end-of-archive blocks
+            self.tar.fileobj.close()
+            self.tar = None
+
+    def appendPart(self, path, state):
+        """
+        Appends the entries of the part archive at @path, where @state is
+        what checkpoint() returned when the part was finished.
+        """
+        assert not self.closed
+        self.endMember()
+        with open(path, 'rb') as part:
+            remaining = state['offset']
+            while remaining:
+                data = part.read(min(remaining, 1024 * 1024))
+                if not data:
+                    raise IOError('%s is shorter than its checkpoint' % path)
+                self.out.write(data)
+                remaining -= len(data)
+        self.tarOffset += state['tarOffset']
+
     def addFile(self, path, arcname):
         # need full path of the file I am adding for "path"
         # arcname is the file name I want to give it for the tar.
         assert not self.closed
-        self.tar.add(path, arcname=arcname)
+        self.getTar().add(path, arcname=arcname)
 
     def writeData(self, path, data):
         assert not self.closed
         if isinstance(data, unicode):
             data = data.encode('utf-8')
-        tinfo = getFileTarInfo(os.path.join(self.dirName, path),
-                               data)
-        self.tar.addfile(tinfo, fileobj=StringIO(data))
-
-    def getData(self):
+        fullPath = os.path.join(self.dirName, path)
+        if self.dedupe:
+            contentHash = getContentHash(data)
+            firstPath = self.contentPaths.get(contentHash)
+            if firstPath is not None:
+                self.getTar().addfile(getLinkTarInfo(fullPath, firstPath))
+                return
+            self.contentPaths[contentHash] = fullPath
+        tinfo = getFileTarInfo(fullPath, data)
+        self.getTar().addfile(tinfo, fileobj=StringIO(data))
+
+    def getFile(self):
+        """
+        Finishes the archive and returns the file holding it, rewound
+        to the start. A temp file is deleted when closed.
+        """
         if not self.closed:
-            self.tar.close()
+            self.getTar().close()
             self.closed = True
-        return self.out.getvalue()
+        self.out.seek(0)
+        return self.out
+
+    def getData(self):
+        return self.getFile().read()
 
 
 class ZipWriter(object):
     """
-    A writer class where writeX() methods add file entries to an
-    in-memory zip file.  The paths of all entries in the zip file are
-    prefixed with dirName. Once all entries have been added, the raw zip
-    contents can be extracted using the getData() method and written to
-    a file or blob storage.
+    A writer class where writeX() methods add file entries to a zip
+    file, either at fullOutputPath or streamed to an anonymous temp
+    file. The paths of all entries in the zip file are prefixed with
+    dirName. Once all entries have been added, getFile() returns a
+    handle on the finished zip that can be handed to file or blob
+    storage (getData() returns the raw bytes).
+
+    Entries are deflated unless isCompressedPath() says they are already
+    compressed, in which case they are stored.
+
+    Zip has no hard links, so if dedupe is set, entries whose data
+    duplicates an earlier entry are written as unix symlinks (relative
+    paths) to the first copy. Windows Explorer and many other zip tools
+    can't extract those, so it is off by default.
     """
 
-    def __init__(self, inputDirName, fullOutputPath = None):
+    def __init__(self, inputDirName, fullOutputPath = None, dedupe=False):
         self.dirName = inputDirName  # input directory name
-        if not fullOutputPath: # put it in memory.
-            self.out = StringIO()
-            self.zip = zipfile.ZipFile(self.out, 'w')
+        self.dedupe = dedupe
+        self.contentPaths = {}
+        if not fullOutputPath:  # stream it to a temp file.
+            self.out = tempfile.TemporaryFile(suffix='.zip')
         else:  # write the zipfile to fullOutputPath 
             self.out = fullOutputPath
-            self.zip =  zipfile.ZipFile(self.out, 'w', zipfile.ZIP_DEFLATED)
+        self.zip = zipfile.ZipFile(self.out, 'w', zipfile.ZIP_DEFLATED,
+                                   allowZip64=True)
         self.closed = False
 
+    @staticmethod
+    def getCompressType(path):
+        if isCompressedPath(path):
+            return zipfile.ZIP_STORED
+        else:
+            return zipfile.ZIP_DEFLATED
+
     def addDir(self, frame=None, centerPointSource=None):
         for root, dirs, files in os.walk(self.dirName):
             #filter the list so that only the  files with matching frame number gets zipped.
@@ -335,70 +800,432 @@ class ZipWriter(object):
                 fullFilePath = os.path.join(root,file)
                 fileBaseName = os.path.basename(fullFilePath)
                 try:
-                    self.zip.write(fullFilePath, fileBaseName)
+                    self.zip.write(fullFilePath, fileBaseName,
+                                   self.getCompressType(fileBaseName))
                 except:
                     print "COULD NOT WRITE FILE %S to ZIP" % fileBaseName
         self.zip.close()
 
     def writeData(self, path, data):
         assert not self.closed
-        self.zip.writestr(os.path.join(self.dirName, path),
-                          data)
-
-    def getData(self):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        fullPath = os.path.join(self.dirName, path)
+        if self.dedupe:
+            contentHash = getContentHash(data)
+            firstPath = self.contentPaths.get(contentHash)
+            if firstPath is not None:
+                linkTarget = os.path.relpath(firstPath, os.path.dirname(fullPath))
+                self.zip.writestr(getSymlinkZipInfo(fullPath), linkTarget)
+                return
+            self.contentPaths[contentHash] = fullPath
+        zinfo = zipfile.ZipInfo(fullPath, time.localtime(time.time())[:6])
+        zinfo.external_attr = 0644 << 16
+        zinfo.compress_type = self.getCompressType(fullPath)
+        self.zip.writestr(zinfo, data)
+
+    def getFile(self):
+        """
+        Finishes the zip and returns a file handle on it, rewound to the
+        start. A temp file is deleted when closed.
+        """
         if not self.closed:
             self.zip.close()
             self.closed = True
-        return self.out.getvalue()
+        if isinstance(self.out, basestring):
+            return open(self.out, 'rb')
+        self.out.seek(0)
+        return self.out
+
+    def getData(self):
+        return self.getFile().read()
 
 
 class FileWriter(object):
     """
     A writer class where writeX() methods write files to disk under the specified
-    basePath.
+    basePath. If dedupe is set, files whose data duplicates an earlier
+    file are hard linked to the first copy.
+
+    A file that is already there (e.g. from an earlier run) is replaced,
+    never overwritten in place, since it may be a hard link shared with
+    other files.
     """
 
-    def __init__(self, basePath):
+    def __init__(self, basePath, dedupe=True):
         self.basePath = basePath
+        self.dedupe = dedupe
+        self.contentPaths = {}
 
     def makeParentDirIfNeeded(self, fullPath):
         d = os.path.dirname(fullPath)
         if not os.path.exists(d):
             os.makedirs(d)
 
+    @staticmethod
+    def removeIfExists(fullPath):
+        try:
+            os.unlink(fullPath)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
     def writeData(self, path, data):
         fullPath = os.path.join(self.basePath, path)
         self.makeParentDirIfNeeded(fullPath)
+        if self.dedupe:
+            contentHash = getContentHash(data)
+            firstPath = self.contentPaths.get(contentHash)
+            if firstPath == fullPath:
+                return
+            if firstPath is not None:
+                self.removeIfExists(fullPath)
+                try:
+                    os.link(firstPath, fullPath)
+                    return
+                except OSError:
+                    # e.g. the filesystem has no hard links; fall back
+                    # to writing a copy
+                    pass
+            else:
+                self.contentPaths[contentHash] = fullPath
+        self.removeIfExists(fullPath)
         open(fullPath, 'w').write(data)
 
+    def checkpoint(self):
+        # every file is complete once written, so there is nothing to
+        # drop on resume
+        return {}
+
+
+TILE_PATH_REGEX = re.compile(r'^(?:.*/)?(?P<zoom>\d+)/(?P<x>\d+)/(?P<y>\d+)(?P<ext>\.\w+)$')
+
+MBTILES_SCHEMA = """
+CREATE TABLE metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+CREATE TABLE map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_id TEXT);
+CREATE UNIQUE INDEX map_index ON map (zoom_level, tile_column, tile_row);
+CREATE VIEW tiles AS
+    SELECT map.zoom_level AS zoom_level,
+           map.tile_column AS tile_column,
+           map.tile_row AS tile_row,
+           images.tile_data AS tile_data
+    FROM map JOIN images ON map.tile_id = images.tile_id;
+"""
+
+
+class MBTilesWriter(object):
+    """
+    A writer class where writeData() adds tiles to an MBTiles file (a
+    single indexed SQLite database) that can be served directly. Tile
+    entries must have paths like [slug/]zoom/x/y.ext, as written by
+    writeTile(). Identical tile images are stored once and referenced
+    from the map table. Other entries (e.g. meta.json) are stored in
+    the metadata table under their path.
+
+    Inserts are committed in batches of batchSize. The database lives in
+    a temp file, or at path if one is given, until getFile() finishes it.
+
+    Tiles are keyed by position, so writing a tile again replaces it. A
+    writer built with the state returned by checkpoint() (resumeState)
+    appends to the database at path, which makes it resumable. The
+    database is not synced to disk, so that survives the writer's
+    process dying but not its host.
+    """
+
+    def __init__(self, name, metadata=None, batchSize=1000, path=None,
+                 resumeState=None):
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.mbtiles')
+            os.close(fd)
+        if not resumeState and os.path.exists(path):
+            os.unlink(path)
+        elif resumeState and not os.path.exists(path):
+            raise IOError('%s is missing' % path)
+        self.path = path
+        self.db = sqlite3.connect(self.path)
+        self.db.text_factory = str
+        self.db.execute('PRAGMA synchronous = OFF')
+        if not resumeState:
+            self.db.executescript(MBTILES_SCHEMA)
+        self.batchSize = batchSize
+        self.numPending = 0
+        if resumeState:
+            self.minZoom = resumeState['minZoom']
+            self.maxZoom = resumeState['maxZoom']
+            self.tileFormat = resumeState['tileFormat']
+        else:
+            self.minZoom = None
+            self.maxZoom = None
+            self.tileFormat = None
+        self.metadata = {'name': name,
+                         'type': 'overlay',
+                         'version': '1.1',
+                         'description': name}
+        if metadata:
+            self.metadata.update(metadata)
+        self.closed = False
+        self.out = None
+
+    def setMetadata(self, name, value):
+        self.metadata[name] = value
+
+    def commitIfNeeded(self, force=False):
+        if self.numPending and (force or self.numPending >= self.batchSize):
+            self.db.commit()
+            self.numPending = 0
+
+    def writeData(self, path, data):
+        assert not self.closed
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        m = TILE_PATH_REGEX.match(path)
+        if m is None:
+            self.setMetadata(path, data)
+            return
+        zoom, x, y = int(m.group('zoom')), int(m.group('x')), int(m.group('y'))
+        if self.tileFormat is None:
+            self.tileFormat = m.group('ext')[1:]
+        if self.minZoom is None:
+            self.minZoom = self.maxZoom = zoom
+        self.minZoom = min(self.minZoom, zoom)
+        self.maxZoom = max(self.maxZoom, zoom)
+
+        # mbtiles uses TMS row numbering, which counts from the south
+        tileRow = (2 ** zoom) - 1 - y
+        tileId = getContentHash(data)
+        self.db.execute('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+                        (tileId, sqlite3.Binary(data)))
+        self.db.execute('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id)'
+                        ' VALUES (?, ?, ?, ?)',
+                        (zoom, x, tileRow, tileId))
+        self.numPending += 1
+        self.commitIfNeeded()
+
+    def checkpoint(self):
+        """
+        Commits the tiles written so far and returns a JSON-friendly
+        state to resume from.
+        """
+        assert not self.closed
+        self.commitIfNeeded(force=True)
+        return {'minZoom': self.minZoom,
+                'maxZoom': self.maxZoom,
+                'tileFormat': self.tileFormat}
+
+    def appendPart(self, path, state):
+        """
+        Adds the tiles of the part database at @path, where @state is
+        what checkpoint() returned when the part was finished.
+        """
+        assert not self.closed
+        if state['tileFormat'] is None:
+            return
+        self.commitIfNeeded(force=True)
+        self.db.execute('ATTACH DATABASE ? AS part', (path,))
+        self.db.execute('INSERT OR IGNORE INTO images SELECT * FROM part.images')
+        self.db.execute('INSERT OR REPLACE INTO map SELECT * FROM part.map')
+        self.db.commit()
+        self.db.execute('DETACH DATABASE part')
+        if self.tileFormat is None:
+            self.tileFormat = state['tileFormat']
+            self.minZoom = state['minZoom']
+            self.maxZoom = state['maxZoom']
+        else:
+            self.minZoom = min(self.minZoom, state['minZoom'])
+            self.maxZoom = max(self.maxZoom, state['maxZoom'])
+
+    def finish(self):
+        if self.closed:
+            return
+        if self.tileFormat is not None:
+            self.metadata.setdefault('format', self.tileFormat)
+            self.metadata.setdefault('minzoom', str(self.minZoom))
+            self.metadata.setdefault('maxzoom', str(self.maxZoom))
+        self.db.executemany('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)',
+                            self.metadata.items())
+        self.commitIfNeeded(force=True)
+        self.db.commit()
+        self.db.close()
+        self.closed = True
+
+    def discard(self):
+        """
+        Deletes the unfinished database, e.g. when the export fails.
+        """
+        if not self.closed:
+            self.db.close()
+            self.closed = True
+        if self.out is None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def getFile(self):
+        """
+        Finishes the database and returns an open handle on it. The
+        temp file is unlinked, so it goes away when the handle is closed.
+        """
+        if self.out is None:
+            self.finish()
+            self.out = open(self.path, 'rb')
+            os.unlink(self.path)
+        self.out.seek(0)
+        return self.out
+
+    def getData(self):
+        return self.getFile().read()
+
+
+class ExportCheckpoint(object):
+    """
+    Remembers which tile columns of a writeQuadTree() export are
+    written, in a JSON sidecar file at path, so an export that dies
+    partway through (e.g. its worker is restarted) can continue where
+    it stopped instead of starting over.
+
+    Written columns are kept as [xmin, xmax] ranges per zoom. save()
+    first asks the writer to make its output durable
+    (writer.checkpoint()) and then records the ranges together with
+    the writer's state, so the sidecar never claims tiles the output
+    doesn't hold. Tiles written after the last save are written again
+    on resume, after the writer resumed from writerState has dropped
+    them.
+
+    A sidecar saved with different params (e.g. another quality or
+    maxZoom) is ignored, and the export starts over.
+
+    The sidecar also keeps the time spent on the export up to the last
+    save, so getSeconds() covers all the runs of a resumed export.
+    """
+
+    def __init__(self, path, params, intervalSeconds=30):
+        self.path = path
+        self.params = params
+        self.intervalSeconds = intervalSeconds
+        self.startTime = self.lastSaveTime = time.time()
+        state = self.load(path)
+        if state and state.get('params') == params:
+            self.done = dict([(int(zoom), ranges)
+                              for zoom, ranges in state['done'].iteritems()])
+            self.writerState = state['writerState']
+            self.info = state['info']
+            self.previousSeconds = state.get('seconds', 0)
+        else:
+            self.done = {}
+            self.writerState = None
+            self.info = {}
+            self.previousSeconds = 0
+
+    @staticmethod
+    def load(path):
+        """
+        Returns the saved state (params, done, writerState, info,
+        seconds) at @path, or None if there is none.
+        """
+        return readJson(path)
+
+    def isResumed(self):
+        return self.writerState is not None
+
+    def getSeconds(self):
+        """
+        Returns the seconds spent on the export so far, in this run and
+        the saved part of earlier ones.
+        """
+        return self.previousSeconds + time.time() - self.startTime
+
+    def getInfo(self, name, default):
+        """
+        Returns the value saved under @name, saving @default if there
+        isn't one. Use it for anything that must not change when the
+        export resumes, like a timestamped archive name.
+        """
+        return self.info.setdefault(name, default)
+
+    def isDone(self, zoom, x):
+        for xmin, xmax in self.done.get(zoom, []):
+            if xmin <= x <= xmax:
+                return True
+        return False
+
+    def addDone(self, zoom, xmin, xmax):
+        ranges = self.done.setdefault(zoom, [])
+        if ranges and ranges[-1][1] + 1 == xmin:
+            # columns are usually written in order
+            ranges[-1][1] = xmax
+        else:
+            ranges.append([xmin, xmax])
+
+    def save(self, writer):
+        self.writerState = writer.checkpoint()
+        writeJsonAtomic(self.path, {'params': self.params,
+                                    'done': self.done,
+                                    'writerState': self.writerState,
+                                    'info': self.info,
+                                    'seconds': self.getSeconds()})
+        self.lastSaveTime = time.time()
+
+    def saveIfNeeded(self, writer):
+        if time.time() - self.lastSaveTime >= self.intervalSeconds:
+            self.save(writer)
+
 
 class AbstractQuadTreeGenerator(object):
-    def getTileData(self, zoom, x, y):
+    # generator type in tileProfiler stats
+    profileName = 'abstract'
+    # name of the tile encoder used when the caller doesn't ask for one
+    defaultEncoding = 'png'
+    # False if tiles are rendered opaque, so encodings without an alpha
+    # channel lose nothing
+    needsAlpha = True
+
+    def getTileData(self, zoom, x, y, quality=DEFAULT_QUALITY, encoding=None):
         raise NotImplementedError('implement in derived classes')
 
-    def getTileDataWithCache(self, zoom, x, y):
-        key = getTileCacheKey(self.quadTreeId, zoom, x, y)
-        data = cache.get(key)
+    def getMetatileData(self, zoom, x, y, quality=DEFAULT_QUALITY, encoding=None,
+                        metatileSize=1):
+        """
+        Returns a dict mapping (x, y) -> tile data for the tiles of the
+        metatileSize x metatileSize block containing tile (x, y), so
+        that the caller can cache its siblings. Generators that can't
+        render a block in one pass just return the requested tile.
+        """
+        return {(x, y): self.getTileData(zoom, x, y, quality, encoding)}
+
+    def getHistogramImage(self):
+        """
+        Returns an image with the same color distribution as the source
+        image, preferably a reduced one, for auto-enhance.
+        """
+        return self.image
+
+    def getTileDataWithCache(self, zoom, x, y, quality=DEFAULT_QUALITY, encoding=None):
+        key = getTileCacheKey(self.quadTreeId, zoom, x, y, quality, encoding)
+        data = getCachedTile(key)
         if data is None:
-            data = self.getTileData(zoom, x, y)
-            cache.set(key, data)
+            profiler.record(self.profileName, zoom, 'cacheMiss')
+            data = self.getTileData(zoom, x, y, quality, encoding)
+            setCachedTile(key, data)
+        else:
+            profiler.record(self.profileName, zoom, 'cacheHit')
         return data
 
-    def writeTile(self, writer, slug, zoom, x, y):
-        bits, contentType = self.getTileDataWithCache(zoom, x, y)
+    def writeTile(self, writer, slug, zoom, x, y, quality=DEFAULT_QUALITY, encoding=None):
+        bits, contentType = self.getTileDataWithCache(zoom, x, y, quality, encoding)
 
-        if BENCHMARK_WARP_STEPS:
-            saveStart = time.time()
         ext = contentTypeToExtension(contentType)
-        writer.writeData('%s/%s/%s/%s%s' % (slug, zoom, x, y, ext),
-                         bits)
-        if BENCHMARK_WARP_STEPS:
-            print 'saveTime:', time.time() - saveStart
+        with profiler.timer(self.profileName, zoom, 'write'):
+            writer.writeData('%s/%s/%s/%s%s' % (slug, zoom, x, y, ext),
+                             bits)
 
 
 class SimpleQuadTreeGenerator(AbstractQuadTreeGenerator):
-    def __init__(self, quadTreeId, image):
+    profileName = 'simple'
+    defaultEncoding = 'jpeg'
+    needsAlpha = False
+
+    def __init__(self, quadTreeId, image, maxPyramidBytes=DEFAULT_PYRAMID_CACHE_BYTES):
         self.quadTreeId = quadTreeId
+        self.image = image
         self.imageSize = image.size
         w, h = self.imageSize
         self.coords = ((0, 0),
@@ -411,37 +1238,111 @@ class SimpleQuadTreeGenerator(AbstractQuadTreeGenerator):
         else:
             self.maxZoom = int(math.ceil(math.log(self.imageSize[1] / TILE_SIZE, 2)))
 
-        self.zoomedImage = {}
-        self.zoomedImage[self.maxZoom] = image
+        # downsampled levels below maxZoom, least recently used first.
+        # the full-resolution level is self.image and isn't counted.
+        self.maxPyramidBytes = maxPyramidBytes
+        self.zoomedImage = OrderedDict()
+        self.zoomedImageBytes = 0
+
+    def getLevelSize(self, zoom):
+        w, h = self.imageSize
+        for _ in xrange(self.maxZoom - zoom):
+            w, h = int(math.ceil(w / 2.)), int(math.ceil(h / 2.))
+        return w, h
+
+    def getStoredLevel(self, zoom):
+        """
+        Returns the overview level of a TiledRaster source image that
+        matches @zoom, or None if the source doesn't store it.
+        """
+        if not isinstance(self.image, sourceRaster.TiledRaster):
+            return None
+        index = self.maxZoom - zoom
+        if index >= self.image.getNumLevels():
+            return None
+        return self.image.getLevel(index)
 
     def getZoomedImage(self, zoom):
-        result = self.zoomedImage.get(zoom, None)
+        if zoom >= self.maxZoom:
+            return self.image
+        # stored overview levels are read block by block, like
+        # self.image, and don't need caching
+        storedLevel = self.getStoredLevel(zoom)
+        if storedLevel is not None:
+            return storedLevel
+        result = self.zoomedImage.get(zoom)
         if result is None:
-            image = self.getZoomedImage(zoom + 1)
-            result = image.resize((int(math.ceil(image.size[0] / 2.)),
-                                   int(math.ceil(image.size[1] / 2.))),
-                                  Image.ANTIALIAS)
-            self.zoomedImage[zoom] = result
+            # halve iteratively, starting from the closest finer level
+            # that is stored or still cached
+            sourceZoom = zoom + 1
+            while (sourceZoom < self.maxZoom
+                   and sourceZoom not in self.zoomedImage
+                   and self.getStoredLevel(sourceZoom) is None):
+                sourceZoom += 1
+            result = self.getZoomedImage(sourceZoom)
+            for z in xrange(sourceZoom - 1, zoom - 1, -1):
+                with profiler.timer(self.profileName, z + ZOOM_OFFSET, 'resize'):
+                    result = result.resize((int(math.ceil(result.size[0] / 2.)),
+                                            int(math.ceil(result.size[1] / 2.))),
+                                           Image.ANTIALIAS)
+                self.cacheZoomedImage(z, result)
+        else:
+            self.cacheZoomedImage(zoom, result)
         return result
 
-    def writeQuadTree(self, writer, slug):
+    def getHistogramImage(self):
+        # the coarsest level is small, and stored in the source raster
+        # or usually cached already
+        return self.getZoomedImage(0)
+
+    def cacheZoomedImage(self, zoom, image):
+        """
+        Adds (or refreshes) @image as the most recently used level,
+        evicting the least recently used levels while we are over
+        maxPyramidBytes. The newest level is always kept.
+        """
+        old = self.zoomedImage.pop(zoom, None)
+        if old is not None:
+            self.zoomedImageBytes -= getImageBytes(old)
+        self.zoomedImage[zoom] = image
+        self.zoomedImageBytes += getImageBytes(image)
+        while (self.zoomedImageBytes > self.maxPyramidBytes
+               and len(self.zoomedImage) > 1):
+            _, evicted = self.zoomedImage.popitem(last=False)
+            self.zoomedImageBytes -= getImageBytes(evicted)
+
+    def writeQuadTree(self, writer, slug, quality=DEFAULT_QUALITY, encoding=None,
+                      metatileSize=1):
+        # metatileSize is ignored: unaligned tiles are mostly cropped,
+        # not warped, so there is no per-warp overhead to share
+        for zoom0, x, y in self.getAllTiles():
+            try:
+                self.writeTile(writer, slug, zoom0, x, y, quality, encoding)
+            except OutOfBounds:
+                # no surprise if some tiles are empty around the edges
+                pass
+
+    def getAllTiles(self):
+        """
+        Yields (zoom, x, y) for every tile of the pyramid, finest zoom
+        first.
+        """
         for zoom in xrange(self.maxZoom, -1, -1):
-            nx = int(math.ceil(self.imageSize[0] / TILE_SIZE))
-            ny = int(math.ceil(self.imageSize[1] / TILE_SIZE))
+            w, h = self.getLevelSize(zoom)
+            nx = int(math.ceil(w / TILE_SIZE))
+            ny = int(math.ceil(h / TILE_SIZE))
             for x in xrange(nx):
                 for y in xrange(ny):
-                    zoom0 = zoom + ZOOM_OFFSET
-                    try:
-                        self.writeTile(writer, slug, zoom0, x, y)
-                    except OutOfBounds:
-                        # no surprise if some tiles are empty around the edges
-                        pass
+                    yield zoom + ZOOM_OFFSET, x, y
 
-    def getTileData(self, zoom0, x, y):
-        return getImageDataJpg(self.generateTile(zoom0, x, y))
+    def getTileData(self, zoom0, x, y, quality=DEFAULT_QUALITY, encoding=None):
+        tileImage = self.generateTile(zoom0, x, y, quality)
+        with profiler.timer(self.profileName, zoom0, 'encode'):
+            return encodeTile(tileImage, encoding or self.defaultEncoding)
 
-    def generateTile(self, zoom0, x, y):
+    def generateTile(self, zoom0, x, y, quality=DEFAULT_QUALITY):
         zoom = zoom0 - ZOOM_OFFSET
+        profile = getQualityProfile(quality)
 
         tileBounds = [TILE_SIZE * x,
                       TILE_SIZE * y,
@@ -458,10 +1359,13 @@ class SimpleQuadTreeGenerator(AbstractQuadTreeGenerator):
             if allPointsOutsideCorners(cornerPoints(sourceTileBounds), getImageCorners(image)):
                 raise OutOfBounds("tile at zoom=%d, x=%d, y=%d is out of the image bounds"
                                   % (zoom0, x, y))
-            return image.transform((int(TILE_SIZE), int(TILE_SIZE)),
-                                   Image.EXTENT,
-                                   sourceTileBounds,
-                                   Image.BICUBIC)
+            with profiler.timer(self.profileName, zoom0, 'warp'):
+                return sourceRaster.windowedTransform(image,
+                                                      (int(TILE_SIZE), int(TILE_SIZE)),
+                                                      Image.EXTENT,
+                                                      sourceTileBounds,
+                                                      profile['warpFilter'],
+                                                      maxWindowFraction=MAX_SOURCE_WINDOW_FRACTION)
         else:
             # this tile is at lower resolution than the original
             # image. use crop() to extract it from one of the cached
@@ -506,10 +1410,16 @@ def fillEdges(corners, numSteps):
 
 
 class WarpedQuadTreeGenerator(AbstractQuadTreeGenerator):
-    def __init__(self, quadTreeId, image, transformDict):
+    profileName = 'warped'
+
+    def __init__(self, quadTreeId, image, transformDict, warpEngine=DEFAULT_WARP_ENGINE):
+        if warpEngine not in WARP_ENGINES:
+            raise ValueError('unknown warp engine %s, expected one of: %s'
+                             % (warpEngine, ', '.join(WARP_ENGINES)))
         self.quadTreeId = quadTreeId
         self.image = image
         self.transform = transform.makeTransform(transformDict)
+        self.warpEngine = warpEngine
 
         corners = getImageCorners(self.image)
         self.mercatorCorners = [self.transform.forward(corner)
@@ -536,6 +1446,13 @@ class WarpedQuadTreeGenerator(AbstractQuadTreeGenerator):
         self.maxZoom = calculateMaxZoom(bounds, self.image)
         self.tileBounds = {}
 
+        # the outline of the warped image, in mercator meters
+        imageFootprint = fillEdges(getImageRing(self.image), FOOTPRINT_EDGE_STEPS)
+        self.mercatorFootprint = [self.transform.forward(edgePoint)
+                                  for edgePoint in imageFootprint]
+        self.footprintErrorMeters = self.getFootprintError(imageFootprint)
+        self.footprintPixels = {}
+
     def getTileBounds(self, zoom):
         result = self.tileBounds.get(zoom)
         if result is None:
@@ -546,140 +1463,579 @@ class WarpedQuadTreeGenerator(AbstractQuadTreeGenerator):
             self.tileBounds[zoom] = result
         return result
 
-    def writeQuadTree(self, writer, slug):
+    def getFootprintError(self, imageFootprint):
+        """
+        Returns an estimate, in mercator meters, of how far the edges of
+        the warped image stray from the straight segments of
+        mercatorFootprint: twice the largest distance between the
+        midpoint of a segment and the warped midpoint of its source
+        segment. It is 0 for transforms that keep lines straight.
+        """
+        result = 0.0
+        for (p1, p2), (m1, m2) in zip(pairsWithWrap(imageFootprint),
+                                      pairsWithWrap(self.mercatorFootprint)):
+            mid = self.transform.forward([(p1[0] + p2[0]) / 2.0, (p1[1] + p2[1]) / 2.0])
+            result = max(result, math.hypot(mid[0] - (m1[0] + m2[0]) / 2.0,
+                                            mid[1] - (m1[1] + m2[1]) / 2.0))
+        return 2 * result
+
+    def getFootprintPixels(self, zoom):
+        """
+        Returns the footprint polygon in pixel coordinates at @zoom.
+        """
+        result = self.footprintPixels.get(zoom)
+        if result is None:
+            result = [transform.metersToPixels(pt[0], pt[1], zoom)
+                      for pt in self.mercatorFootprint]
+            self.footprintPixels[zoom] = result
+        return result
+
+    def getCoveredBox(self, zoom, x, y, numX=1, numY=1):
+        """
+        Returns the (left, top, right, bottom) box, in pixels relative
+        to the upper-left corner of the numX x numY block of tiles whose
+        upper-left tile is (x, y), outside of which the block is fully
+        transparent: the bounding box of the block's part of the
+        footprint plus a margin, clipped to the block. Returns None if
+        the whole block is transparent.
+        """
+        width = int(TILE_SIZE * numX)
+        height = int(TILE_SIZE * numY)
+        margin = FOOTPRINT_MARGIN + self.footprintErrorMeters / transform.resolution(zoom)
+        left = x * TILE_SIZE
+        top = y * TILE_SIZE
+        polygon = self.getFootprintPixels(zoom)
+        polygon = clipPolygon(polygon, 0, left - margin, True)
+        polygon = clipPolygon(polygon, 0, left + width + margin, False)
+        polygon = clipPolygon(polygon, 1, top - margin, True)
+        polygon = clipPolygon(polygon, 1, top + height + margin, False)
+        if not polygon:
+            return None
+        xs = [pt[0] - left for pt in polygon]
+        ys = [pt[1] - top for pt in polygon]
+        box = (max(int(math.floor(min(xs) - margin)), 0),
+               max(int(math.floor(min(ys) - margin)), 0),
+               min(int(math.ceil(max(xs) + margin)), width),
+               min(int(math.ceil(max(ys) + margin)), height))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None
+        return box
+
+    def getFootprintTileRanges(self, zoom):
+        """
+        Returns a list of (y, xmin, xmax) for the rows of tiles at @zoom
+        that the overlay footprint touches, where xmin..xmax are the
+        tiles of row y that it touches. For a non-convex footprint the
+        rows may include a few tiles that it doesn't touch.
+        """
+        xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
+        polygon = [[coord / TILE_SIZE for coord in pt]
+                   for pt in self.getFootprintPixels(zoom)]
+        result = []
+        for y in xrange(int(ymin), int(ymax) + 1):
+            row = clipPolygon(clipPolygon(polygon, 1, y, True), 1, y + 1, False)
+            if not row:
+                continue
+            rowXs = [pt[0] for pt in row]
+            rowXmin = max(int(math.floor(min(rowXs))), xmin)
+            rowXmax = min(int(math.ceil(max(rowXs))) - 1, xmax)
+            if rowXmin <= rowXmax:
+                result.append((y, rowXmin, rowXmax))
+        return result
+
+    def getExportMaxZoom(self, maxZoom=None):
+        """
+        Returns the deepest zoom level of an export, capped at @maxZoom.
+        """
+        if maxZoom is None:
+            return int(self.maxZoom)
+        return min(int(self.maxZoom), int(maxZoom))
+
+    def getExportShards(self, numShards, maxZoom=None, metatileSize=1):
+        """
+        Splits the tiles of an export down to @maxZoom into up to
+        @numShards runs of tile columns, contiguous in writeQuadTree()
+        order (deepest zoom first, then west to east), with about the
+        same amount of work in each. Work is counted as the covered
+        tiles of each column (see getFootprintTileRanges()) plus one for
+        its empty tiles. Each shard is a list of [zoom, xmin, xmax]
+        column ranges, at most one per zoom. Ranges don't split
+        metatiles of @metatileSize.
+        """
+        columns = []
+        for zoom in xrange(self.getExportMaxZoom(maxZoom), -1, -1):
+            xmin, _ymin, xmax, _ymax = self.getTileBounds(zoom).bounds
+            coveredTiles = {}
+            for _y, rowXmin, rowXmax in self.getFootprintTileRanges(zoom):
+                for mx in xrange(rowXmin - rowXmin % metatileSize, rowXmax + 1, metatileSize):
+                    overlap = min(mx + metatileSize - 1, rowXmax) - max(mx, rowXmin) + 1
+                    coveredTiles[mx] = coveredTiles.get(mx, 0) + overlap
+            for mx in xrange(xmin - xmin % metatileSize, xmax + 1, metatileSize):
+                columns.append((zoom,
+                                max(mx, xmin),
+                                min(mx + metatileSize - 1, xmax),
+                                coveredTiles.get(mx, 0) + 1))
+
+        shardWork = float(sum([work for _zoom, _xmin, _xmax, work in columns])) / numShards
+        shards = []
+        shard = []
+        workSoFar = 0
+        for zoom, xmin, xmax, work in columns:
+            if shard and shard[-1][0] == zoom:
+                shard[-1][2] = xmax
+            else:
+                shard.append([zoom, xmin, xmax])
+            workSoFar += work
+            if workSoFar >= shardWork * (len(shards) + 1) and len(shards) < numShards - 1:
+                shards.append(shard)
+                shard = []
+        if shard:
+            shards.append(shard)
+        return shards
+
+    def getExportColumns(self, zoom, shardRanges=None):
+        """
+        Returns the (xmin, xmax) range of tile columns an export writes
+        at @zoom: all of them, or those in @shardRanges (see
+        getExportShards()). Returns None if the shard has none.
+        """
+        xmin, _ymin, xmax, _ymax = self.getTileBounds(zoom).bounds
+        if shardRanges is None:
+            return xmin, xmax
+        for shardZoom, shardXmin, shardXmax in shardRanges:
+            if shardZoom == zoom:
+                return max(xmin, shardXmin), min(xmax, shardXmax)
+        return None
+
+    def writeQuadTree(self, writer, slug, quality=DEFAULT_QUALITY, encoding=None,
+                      metatileSize=1, maxZoom=None, progress=None, checkpoint=None,
+                      shardRanges=None):
+        """
+        Writes the tiles down to @maxZoom (capped at self.maxZoom). If
+        @progress is given, it is called as progress(tilesSoFar,
+        totalTiles, resumedTiles) after each tile or metatile, where
+        resumedTiles is the part of tilesSoFar that was skipped because
+        @checkpoint had it. It may raise an exception to stop the
+        export.
+
+        If @checkpoint (an ExportCheckpoint) is given, columns it has
+        recorded are skipped, and it is saved as columns are written,
+        so an interrupted export can be resumed.
+
+        If @shardRanges is given, only the tile columns in it are
+        written (see getExportShards()).
+        """
         print >> sys.stderr, 'warping...'
         totalTiles = 0
         startTime = time.time()
+        maxZoom = self.getExportMaxZoom(maxZoom)
+
+        zoomColumns = []
+        for zoom in xrange(maxZoom, -1, -1):
+            columns = self.getExportColumns(zoom, shardRanges)
+            if columns is not None:
+                zoomColumns.append((zoom, columns))
 
         totalTiles = 0
-        for zoom in xrange(int(self.maxZoom), -1, -1):
-            xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
+        for zoom, (xmin, xmax) in zoomColumns:
+            _xmin, ymin, _xmax, ymax = self.getTileBounds(zoom).bounds
             numTilesAtZoom = (xmax - xmin + 1) * (ymax - ymin + 1)
             totalTiles += numTilesAtZoom
         sys.stderr.write('%d total tiles\n' % totalTiles)
 
-        tilesSoFar = 0
-        for zoom in xrange(int(self.maxZoom), -1, -1):
-            xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
+        tilesSoFar = [0]
+        resumedTiles = [0]
+
+        def addTiles(numTiles, resumed=False):
+            tilesSoFar[0] += numTiles
+            if resumed:
+                resumedTiles[0] += numTiles
+            if progress is not None:
+                progress(tilesSoFar[0], totalTiles, resumedTiles[0])
+
+        for zoom, (xmin, xmax) in zoomColumns:
+            _xmin, ymin, _xmax, ymax = self.getTileBounds(zoom).bounds
             maxNumTiles = (xmax - xmin + 1) * (ymax - ymin + 1)
             sys.stderr.write('zoom %d (%d tiles)' % (zoom, maxNumTiles))
-            for x in xrange(int(xmin), int(xmax) + 1):
-                for y in xrange(int(ymin), int(ymax) + 1):
-                    try:
-                        self.writeTile(writer, slug, zoom, x, y)
-                    except OutOfBounds:
-                        # no surprise if some tiles are empty around the edges
-                        pass
-                    tilesSoFar += 1
-            sys.stderr.write('[completed tiles: %d / %d]\n' % (tilesSoFar, totalTiles))
+            if metatileSize > 1:
+                self.writeMetatiles(writer, slug, zoom, quality, encoding, metatileSize,
+                                    addTiles, checkpoint, (xmin, xmax))
+            else:
+                for x in xrange(int(xmin), int(xmax) + 1):
+                    if checkpoint is not None and checkpoint.isDone(zoom, x):
+                        addTiles(ymax - ymin + 1, resumed=True)
+                        continue
+                    for y in xrange(int(ymin), int(ymax) + 1):
+                        try:
+                            self.writeTile(writer, slug, zoom, x, y, quality, encoding)
+                        except OutOfBounds:
+                            # no surprise if some tiles are empty around the edges
+                            pass
+                        addTiles(1)
+                    if checkpoint is not None:
+                        checkpoint.addDone(zoom, x, x)
+                        checkpoint.saveIfNeeded(writer)
+            sys.stderr.write('[completed tiles: %d / %d]\n' % (tilesSoFar[0], totalTiles))
+
+        if checkpoint is not None:
+            checkpoint.save(writer)
 
         elapsedTime = time.time() - startTime
         print >> sys.stderr, ('warping complete: %d tiles, elapsed time %.1f seconds = %d ms/tile'
-                              % (totalTiles, elapsedTime, int(1000 * elapsedTime / totalTiles)))
-
-    def getTileData(self, zoom, x, y):
-        return getImageDataPng(self.generateTile(zoom, x, y))
+                              % (totalTiles, elapsedTime,
+                                 int(1000 * elapsedTime / max(totalTiles, 1))))
+
+    def getTileData(self, zoom, x, y, quality=DEFAULT_QUALITY, encoding=None):
+        tileImage = self.generateTile(zoom, x, y, quality)
+        with profiler.timer(self.profileName, zoom, 'encode'):
+            return encodeTile(tileImage, encoding or self.defaultEncoding)
+
+    def getMetatileData(self, zoom, x, y, quality=DEFAULT_QUALITY, encoding=None,
+                        metatileSize=1):
+        self.checkTileBounds(zoom, x, y)
+        tiles = self.generateMetatile(zoom,
+                                      x - x % metatileSize,
+                                      y - y % metatileSize,
+                                      metatileSize, quality)
+        encoding = encoding or self.defaultEncoding
+        with profiler.timer(self.profileName, zoom, 'encode'):
+            return dict([(tileCoords, encodeTile(tileImage, encoding))
+                         for tileCoords, tileImage in tiles.iteritems()])
+
+    def writeMetatiles(self, writer, slug, zoom, quality=DEFAULT_QUALITY, encoding=None,
+                       metatileSize=1, addTiles=None, checkpoint=None, columns=None):
+        """
+        Writes the tiles of @zoom a metatile at a time, calling
+        addTiles(numTiles, resumed) after each metatile if it is given.
+        Columns of metatiles are skipped or recorded in @checkpoint as
+        in writeQuadTree(). If @columns is given, only the tile columns in
+        that (xmin, xmax) range are written.
+        """
+        xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
+        if columns is not None:
+            xmin, xmax = columns
+        # align blocks to multiples of metatileSize, like getMetatileData()
+        for mx in xrange(xmin - xmin % metatileSize, xmax + 1, metatileSize):
+            columnXmin = max(mx, xmin)
+            columnXmax = min(mx + metatileSize - 1, xmax)
+            if checkpoint is not None and checkpoint.isDone(zoom, columnXmin):
+                if addTiles is not None:
+                    addTiles((columnXmax - columnXmin + 1) * (ymax - ymin + 1), True)
+                continue
+            for my in xrange(ymin - ymin % metatileSize, ymax + 1, metatileSize):
+                tiles = self.generateMetatile(zoom, mx, my, metatileSize, quality)
+                for (x, y), tileImage in tiles.iteritems():
+                    with profiler.timer(self.profileName, zoom, 'encode'):
+                        bits, contentType = encodeTile(tileImage,
+                                                       encoding or self.defaultEncoding)
+                    ext = contentTypeToExtension(contentType)
+                    with profiler.timer(self.profileName, zoom, 'write'):
+                        writer.writeData('%s/%s/%s/%s%s' % (slug, zoom, x, y, ext),
+                                         bits)
+                if addTiles is not None:
+                    addTiles(len(tiles))
+            if checkpoint is not None:
+                checkpoint.addDone(zoom, columnXmin, columnXmax)
+                checkpoint.saveIfNeeded(writer)
+
+    def getOverviewTiles(self, maxTiles):
+        """
+        Returns up to maxTiles (zoom, x, y) tuples covering the overlay,
+        starting from zoom 0 and working down, with the tiles of each
+        zoom ordered from the center of the overlay outward. These are
+        the tiles a map view of a freshly aligned overlay needs first.
+        """
+        result = []
+        for zoom in xrange(0, int(self.maxZoom) + 1):
+            xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
+            cx = (xmin + xmax) / 2.0
+            cy = (ymin + ymax) / 2.0
+            tiles = [(zoom, x, y)
+                     for x in xrange(int(xmin), int(xmax) + 1)
+                     for y in xrange(int(ymin), int(ymax) + 1)]
+            tiles.sort(key=lambda t: (t[1] - cx) ** 2 + (t[2] - cy) ** 2)
+            result += tiles[:maxTiles - len(result)]
+            if len(result) >= maxTiles:
+                break
+        return result
 
-    def generateTile(self, zoom, x, y):
+    def checkTileBounds(self, zoom, x, y):
         xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
         if (not ((xmin <= x <= xmax)
                  and (ymin <= y <= ymax))):
             raise OutOfBounds("tile at zoom=%d, x=%d, y=%d is out of the image bounds"
                               % (zoom, x, y))
 
+    def generateTile(self, zoom, x, y, quality=DEFAULT_QUALITY):
+        self.checkTileBounds(zoom, x, y)
+        return self.generateMetatile(zoom, x, y, 1, quality)[(x, y)]
+
+    def generateMetatile(self, zoom, x, y, span, quality=DEFAULT_QUALITY):
+        """
+        Warps the span x span block of tiles whose upper-left tile is
+        (x, y) in a single pass and slices it into tiles, so that the
+        per-warp overhead is shared and the resampling filters see
+        across tile seams. The block is clipped to the tile bounds, so
+        we don't render empty tiles around the edges. Returns a dict
+        mapping (x, y) -> tile image for the tiles that are left.
+
+        Only the part of the block that the overlay footprint covers
+        (see getCoveredBox()) is warped and resized. Tiles outside of
+        it are the shared empty tile.
+        """
+        profile = getQualityProfile(quality)
+        xmin, ymin, xmax, ymax = self.getTileBounds(zoom).bounds
+        x0, y0 = max(x, xmin), max(y, ymin)
+        numX = min(x + span - 1, xmax) - x0 + 1
+        numY = min(y + span - 1, ymax) - y0 + 1
+        if numX <= 0 or numY <= 0:
+            return {}
+
+        blockSize = (int(TILE_SIZE * numX), int(TILE_SIZE * numY))
+        box = self.getCoveredBox(zoom, x0, y0, numX, numY)
+        if box is None:
+            profiler.record(self.profileName, zoom, 'emptyBlock')
+            return dict([((x0 + i, y0 + j), getEmptyTileImage())
+                         for i in xrange(numX)
+                         for j in xrange(numY)])
+
         sys.stderr.write('.')
 
-        if isinstance(self.transform,
-                      (transform.LinearTransform,
-                       transform.ProjectiveTransform)):
-            transformArgs = self.getPilTransformArgsProjective(zoom, x, y)
+        if self.warpEngine == 'numpy':
+            boxImage = self.warpNumpy(zoom, x0, y0, profile, numX, numY, box)
         else:
-            transformArgs = self.getPilTransformArgsGeneral(zoom, x, y)
+            boxImage = self.warpPil(zoom, x0, y0, profile, numX, numY, box)
 
-        if BENCHMARK_WARP_STEPS:
-            warpDataStart = time.time()
-        tileImage = self.image.transform(*transformArgs)
-        if BENCHMARK_WARP_STEPS:
-            print 'warpDataTime:', time.time() - warpDataStart
+        if profile['supersample'] != 1:
+            with profiler.timer(self.profileName, zoom, 'resize'):
+                boxImage = boxImage.resize((box[2] - box[0], box[3] - box[1]),
+                                           profile['resizeFilter'])
 
-        if BENCHMARK_WARP_STEPS:
-            resizeStart = time.time()
-        tileImage = tileImage.resize((int(TILE_SIZE),) * 2, Image.ANTIALIAS)
-        if BENCHMARK_WARP_STEPS:
-            print 'resizeTime:', time.time() - resizeStart
-
-        return tileImage
-
-    def getPilTransformArgsProjective(self, zoom, x, y):
-        corners = tileExtent(zoom, x, y)
-        sourceCorners = [intMap(self.transform.reverse(corner))
-                         for corner in corners]
+        if box == (0, 0) + blockSize:
+            blockImage = boxImage
+        else:
+            blockImage = Image.new('RGBA', blockSize, (0, 0, 0, 0))
+            blockImage.paste(boxImage, box[:2])
+
+        if numX == numY == 1:
+            return {(x0, y0): blockImage}
+
+        result = {}
+        for i in xrange(numX):
+            for j in xrange(numY):
+                left = int(i * TILE_SIZE)
+                top = int(j * TILE_SIZE)
+                tileBox = (left, top, left + int(TILE_SIZE), top + int(TILE_SIZE))
+                if boxesIntersect(tileBox, box):
+                    result[(x0 + i, y0 + j)] = blockImage.crop(tileBox)
+                else:
+                    result[(x0 + i, y0 + j)] = getEmptyTileImage()
+        return result
 
-        return ((int(TILE_SIZE * 2),) * 2,
+    def getBlockBox(self, numX, numY, box):
+        if box is None:
+            return (0, 0, int(TILE_SIZE * numX), int(TILE_SIZE * numY))
+        return box
+
+    def warpPil(self, zoom, x, y, profile, numX=1, numY=1, box=None):
+        """
+        Warps the @box part (in pixels relative to the block, the whole
+        block by default) of the numX x numY block of tiles whose
+        upper-left tile is (x, y) at the profile's supersampled
+        resolution, using Image.transform() with a QUAD or MESH.
+        """
+        box = self.getBlockBox(numX, numY, box)
+        if (isinstance(self.transform, transform.LinearTransform)
+                or (numX == numY == 1
+                    and isinstance(self.transform, transform.ProjectiveTransform))):
+            # a single QUAD is exact for linear transforms. for
+            # projective ones it's only close enough over one tile.
+            transformArgs = self.getPilTransformArgsProjective(zoom, x, y, profile,
+                                                               numX, numY, box)
+            with profiler.timer(self.profileName, zoom, 'warp'):
+                return sourceRaster.windowedTransform(self.image, *transformArgs,
+                                                      maxWindowFraction=MAX_SOURCE_WINDOW_FRACTION)
+
+        # the mesh is built for the whole block, without the patches
+        # that miss the box
+        transformArgs = self.getPilTransformArgsGeneral(zoom, x, y, profile,
+                                                        numX, numY, box)
+        with profiler.timer(self.profileName, zoom, 'warp'):
+            blockImage = sourceRaster.windowedTransform(self.image, *transformArgs,
+                                                        maxWindowFraction=MAX_SOURCE_WINDOW_FRACTION)
+            if box == self.getBlockBox(numX, numY, None):
+                return blockImage
+            supersample = profile['supersample']
+            return blockImage.crop(tuple([int(c * supersample) for c in box]))
+
+    def warpNumpy(self, zoom, x, y, profile, numX=1, numY=1, box=None):
+        """
+        Like warpPil(), but resamples every target pixel from its own
+        exact source coordinates with numpyWarp.
+        """
+        box = self.getBlockBox(numX, numY, box)
+        supersample = profile['supersample']
+        with profiler.timer(self.profileName, zoom, 'transform'):
+            sx, sy = numpyWarp.getSourceCoordinates(self.transform, zoom,
+                                                    x + box[0] / TILE_SIZE,
+                                                    y + box[1] / TILE_SIZE,
+                                                    int((box[2] - box[0]) * supersample),
+                                                    int((box[3] - box[1]) * supersample),
+                                                    supersample)
+        with profiler.timer(self.profileName, zoom, 'warp'):
+            return numpyWarp.warp(self.image, sx, sy, profile['warpFilter'])
+
+    def getPilTransformArgsProjective(self, zoom, x, y, profile, numX=1, numY=1, box=None):
+        corners = tileExtent(zoom, x, y, numX, numY)
+        with profiler.timer(self.profileName, zoom, 'transform'):
+            sourceCorners = [intMap(self.transform.reverse(corner))
+                             for corner in corners]
+
+        box = self.getBlockBox(numX, numY, box)
+        if box != self.getBlockBox(numX, numY, None):
+            # the QUAD of the box is the block's QUAD restricted to the
+            # box, so the box's pixels come out the same as the block's
+            nw, sw, se, ne = [numpy.array(c, dtype='d') for c in sourceCorners]
+
+            def getSourcePoint(px, py):
+                u = px / (TILE_SIZE * numX)
+                v = py / (TILE_SIZE * numY)
+                return ((1 - u) * ((1 - v) * nw + v * sw)
+                        + u * ((1 - v) * ne + v * se)).tolist()
+
+            left, top, right, bottom = box
+            sourceCorners = [getSourcePoint(left, top),
+                             getSourcePoint(left, bottom),
+                             getSourcePoint(right, bottom),
+                             getSourcePoint(right, top)]
+
+        return ((int((box[2] - box[0]) * profile['supersample']),
+                 int((box[3] - box[1]) * profile['supersample'])),
                 Image.QUAD,
                 flatten(sourceCorners),
-                Image.BICUBIC)
-
-    def getPilTransformArgsGeneral(self, zoom, x, y):
-        corners = tileExtent(zoom, x, y)
+                profile['warpFilter'])
+
+    def getPilTransformArgsGeneral(self, zoom, x, y, profile, numX=1, numY=1, box=None):
+        """
+        Builds an Image.MESH warp for the numX x numY block of tiles
+        by adaptive subdivision. We start with a single patch covering
+        a square block (or one per tile otherwise) and split a patch
+        into four only where bilinear interpolation of its corners
+        strays more than MESH_TOLERANCE source pixels from the exact
+        reverse transform. Patches are never split below PATCH_SIZE.
+        Patches that miss @box (in block pixels) are left out.
+        """
+        box = self.getBlockBox(numX, numY, box)
+        isProfiling = profiler.isEnabled()
+        meshStart = time.time()
+        # total time spent in reverse transforms, for the profiler
+        transformSeconds = [0.0]
+        sourceTable = {}
+
+        def getSourcePoint(px, py):
+            # px, py are target pixel offsets within the block
+            result = sourceTable.get((px, py), MISSING_POINT)
+            if result is MISSING_POINT:
+                targetPixels = (x * TILE_SIZE + px,
+                                y * TILE_SIZE + py)
+                mercatorPoint = transform.pixelsToMeters(targetPixels[0],
+                                                         targetPixels[1],
+                                                         zoom)
+                if isProfiling:
+                    transformStart = time.time()
+                    result = self.transform.reverse(mercatorPoint)
+                    transformSeconds[0] += time.time() - transformStart
+                else:
+                    result = self.transform.reverse(mercatorPoint)
+                sourceTable[(px, py)] = result
+            return result
 
-        if BENCHMARK_WARP_STEPS:
-            transformStart = time.time()
-        doublePatchSize = PATCH_SIZE * 2
         meshPatches = []
-
-        patchTable = {}
-        for px in xrange(PATCHES_PER_TILE + 1):
-            for py in xrange(PATCHES_PER_TILE + 1):
-                targetPatchOrigin = tileIndexToPixels(x * PATCHES_PER_TILE + px,
-                                                      y * PATCHES_PER_TILE + py)
-                mercatorPatchOrigin = transform.pixelsToMeters(targetPatchOrigin[0],
-                                                     targetPatchOrigin[1],
-                                                     zoom + PATCH_ZOOM_OFFSET)
-                sourcePatchOrigin = intMap(self.transform.reverse(mercatorPatchOrigin))
-                patchTable[(px, py)] = sourcePatchOrigin
-        if BENCHMARK_WARP_STEPS:
-            print
-            print 'transformTime:', time.time() - transformStart
-
-        if BENCHMARK_WARP_STEPS:
-            meshStart = time.time()
-        for px in xrange(PATCHES_PER_TILE):
-            for py in xrange(PATCHES_PER_TILE):
-                corners = ((px, py),
-                           (px, py + 1),
-                           (px + 1, py + 1),
-                           (px + 1, py))
-                sourcePatchCorners = [patchTable[corner]
-                                      for corner in corners]
-
-                # reject the patch if any corner is out of bounds
-                if any([c is None
-                        for c in sourcePatchCorners]):
-                    continue
-
-                xoff = px * doublePatchSize
-                yoff = py * doublePatchSize
-                targetBox = (xoff,
-                             yoff,
-                             xoff + doublePatchSize,
-                             yoff + doublePatchSize)
-                meshPatches.append([targetBox, flatten(sourcePatchCorners)])
-
-                if 0:
-                    print >> sys.stderr, 'patchCorners:', corners
-                    print >> sys.stderr, 'sourceCorners:', sourcePatchCorners
-                    print >> sys.stderr, 'targetBox:', targetBox
-
-        transformArgs = ((int(TILE_SIZE * 2),) * 2,
+        supersample = profile['supersample']
+
+        def addPatch(left, top, size):
+            if not boxesIntersect((left, top, left + size, top + size), box):
+                return
+            corners = ((left, top),
+                       (left, top + size),
+                       (left + size, top + size),
+                       (left + size, top))
+            sourcePatchCorners = [getSourcePoint(*corner)
+                                  for corner in corners]
+
+            if (size > PATCH_SIZE
+                    and not self.patchIsLinear(getSourcePoint, left, top, size,
+                                               sourcePatchCorners)):
+                half = size // 2
+                for dx in (0, half):
+                    for dy in (0, half):
+                        addPatch(left + dx, top + dy, half)
+                return
+
+            # reject the patch if any corner is out of bounds
+            if any([c is None
+                    for c in sourcePatchCorners]):
+                return
+
+            targetBox = (left * supersample,
+                         top * supersample,
+                         (left + size) * supersample,
+                         (top + size) * supersample)
+            meshPatches.append([targetBox,
+                                flatten([intMap(c)
+                                         for c in sourcePatchCorners])])
+
+            if 0:
+                print >> sys.stderr, 'patchCorners:', corners
+                print >> sys.stderr, 'sourceCorners:', sourcePatchCorners
+                print >> sys.stderr, 'targetBox:', targetBox
+
+        if numX == numY:
+            addPatch(0, 0, int(TILE_SIZE * numX))
+        else:
+            for i in xrange(numX):
+                for j in xrange(numY):
+                    addPatch(int(i * TILE_SIZE), int(j * TILE_SIZE), int(TILE_SIZE))
+        if isProfiling:
+            profiler.record(self.profileName, zoom, 'transform', transformSeconds[0])
+            profiler.record(self.profileName, zoom, 'mesh',
+                            time.time() - meshStart - transformSeconds[0])
+
+        transformArgs = ((int(TILE_SIZE * numX * supersample),
+                          int(TILE_SIZE * numY * supersample)),
                          Image.MESH,
                          meshPatches,
-                         Image.BICUBIC)
+                         profile['warpFilter'])
 
         if 0:
             print >> sys.stderr, 'meshPatches:'
             print >> sys.stderr, json.dumps(meshPatches, indent=4)
-        if BENCHMARK_WARP_STEPS:
-            print 'meshTime:', time.time() - meshStart
 
         return transformArgs
+
+    @staticmethod
+    def patchIsLinear(getSourcePoint, left, top, size, sourcePatchCorners):
+        """
+        Returns True if the exact source points at the center and edge
+        midpoints of the patch are within MESH_TOLERANCE of the bilinear
+        interpolation of its corners, which is what PIL does inside each
+        mesh patch.
+        """
+        if any([c is None for c in sourcePatchCorners]):
+            return False
+        upperLeft, lowerLeft, lowerRight, upperRight = [numpy.array(c)
+                                                        for c in sourcePatchCorners]
+        half = size // 2
+        checks = (((left + half, top), (upperLeft + upperRight) / 2),
+                  ((left, top + half), (upperLeft + lowerLeft) / 2),
+                  ((left + size, top + half), (upperRight + lowerRight) / 2),
+                  ((left + half, top + size), (lowerLeft + lowerRight) / 2),
+                  ((left + half, top + half),
+                   (upperLeft + lowerLeft + lowerRight + upperRight) / 4))
+        for targetPoint, interpolated in checks:
+            exact = getSourcePoint(*targetPoint)
+            if exact is None:
+                return False
+            if numpy.linalg.norm(numpy.array(exact) - interpolated) > MESH_TOLERANCE:
+                return False
+        return True
@@ -0,0 +1,88 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+A small in-process work queue for rendering tiles in the background,
+so that request handlers can return quickly and let the expensive
+render finish later.
+"""
+
+import logging
+import threading
+import Queue
+
+
+class RenderQueue(object):
+    """
+    Runs scheduled jobs on a pool of daemon worker threads. Each job has
+    a key; scheduling a key that is already pending is a no-op, so many
+    requests for the same tile only queue one render. The worker threads
+    are started lazily on the first call to schedule().
+    """
+
+    def __init__(self, numWorkers=1):
+        self.numWorkers = numWorkers
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.workers = []
+
+    def startWorkersIfNeeded(self):
+        # caller must hold self.lock
+        if self.workers:
+            return
+        for i in xrange(self.numWorkers):
+            worker = threading.Thread(target=self.runWorker,
+                                      name='geocamTiePoint.RenderQueue-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def schedule(self, key, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs) to run in the background unless a
+        job with the same key is already pending. Returns True if the
+        job was queued.
+        """
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+            self.startWorkersIfNeeded()
+        self.queue.put((key, func, args, kwargs))
+        return True
+
+    def isPending(self, key):
+        with self.lock:
+            return key in self.pending
+
+    def runWorker(self):
+        while True:
+            key, func, args, kwargs = self.queue.get()
+            try:
+                func(*args, **kwargs)
+            except Exception:  # pylint: disable=W0703
+                logging.exception('RenderQueue: job %s failed', key)
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+                self.queue.task_done()
+
+    def join(self):
+        """
+        Blocks until all queued jobs are done. Mostly useful for tests.
+        """
+        self.queue.join()
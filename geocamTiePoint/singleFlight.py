@@ -0,0 +1,107 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Single-flight coalescing of duplicate work, so that N concurrent
+requests for the same uncached tile render it once.
+"""
+
+import sys
+import time
+import logging
+import threading
+
+from django.core.cache import cache
+
+
+class Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        # sys.exc_info() of the leader's failure
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    run(key, compute, lookup) calls compute() for the first caller of a
+    key; concurrent callers in the same process wait for it and get its
+    result, or its exception if it fails.
+
+    With useCacheLock, the first caller also takes a lock in the shared
+    Django cache with cache.add(), which is atomic in memcached and the
+    database cache. If another process holds the lock, we poll lookup()
+    until that process has stored its result, and only compute() it
+    ourselves if the lock goes away or lockTimeout expires without one.
+    """
+
+    def __init__(self, useCacheLock=True, lockTimeout=30, pollInterval=0.05):
+        self.useCacheLock = useCacheLock
+        self.lockTimeout = lockTimeout
+        self.pollInterval = pollInterval
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def run(self, key, compute, lookup):
+        with self.lock:
+            flight = self.flights.get(key)
+            isLeader = flight is None
+            if isLeader:
+                flight = Flight()
+                self.flights[key] = flight
+
+        if not isLeader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error[0], flight.error[1], flight.error[2]
+            return flight.result
+
+        try:
+            flight.result = self.runLeader(key, compute, lookup)
+            return flight.result
+        except:
+            flight.error = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.done.set()
+
+    def runLeader(self, key, compute, lookup):
+        if not self.useCacheLock:
+            return compute()
+
+        lockKey = 'geocamTiePoint.SingleFlight.lock.%s' % key
+        if cache.add(lockKey, 1, self.lockTimeout):
+            try:
+                return compute()
+            finally:
+                cache.delete(lockKey)
+
+        # another process is computing it; wait for its result
+        logging.debug('SingleFlight: waiting on another process for %s', key)
+        deadline = time.time() + self.lockTimeout
+        while time.time() < deadline:
+            time.sleep(self.pollInterval)
+            result = lookup()
+            if result is not None:
+                return result
+            if cache.get(lockKey) is None:
+                break
+        result = lookup()
+        if result is not None:
+            return result
+        return compute()
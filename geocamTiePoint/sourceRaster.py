@@ -0,0 +1,390 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Windowed access to source images for the tile generators. An image is
+converted once to an internally tiled raw RGBA file, which is then
+read through mmap, so rendering a tile only touches the blocks under
+its source window instead of decoding the whole image.
+
+File layout: a HEADER_SIZE header (magic, version, width, height,
+blockSize, numLevels), then the levels, full resolution first. Each
+level after the first is an overview at half the size of the one
+before it, and the last one fits in a single block. A level is stored
+as blockSize x blockSize RGBA blocks in row-major block order. Blocks
+on the right and bottom edges are padded with transparent pixels.
+"""
+
+import os
+import math
+import mmap
+import struct
+import tempfile
+
+from PIL import Image
+
+MAGIC = 'GTPRASTR'
+VERSION = 2
+HEADER_FORMAT = '<8sIIIII'
+# keep blocks page-aligned
+HEADER_SIZE = 4096
+DEFAULT_BLOCK_SIZE = 256
+BYTES_PER_PIXEL = 4  # RGBA
+
+# extra source pixels to read around a warp's source window, so that
+# the resampling filter has context at the edges. PIL's transform()
+# uses a fixed-size kernel, so this doesn't depend on the scale.
+FILTER_MARGINS = {
+    Image.NEAREST: 1,
+    Image.BILINEAR: 1,
+    Image.BICUBIC: 2,
+}
+DEFAULT_FILTER_MARGIN = 3
+
+
+class SourceRasterError(Exception):
+    pass
+
+
+def getTransformSourceBox(method, data):
+    """
+    Returns the (left, top, right, bottom) bounding box, in source
+    pixels, of the source region read by Image.transform(size, method,
+    data).
+    """
+    if method == Image.EXTENT:
+        xs = (data[0], data[2])
+        ys = (data[1], data[3])
+    elif method == Image.QUAD:
+        xs = data[0::2]
+        ys = data[1::2]
+    elif method == Image.MESH:
+        xs = []
+        ys = []
+        for _targetBox, quad in data:
+            xs.extend(quad[0::2])
+            ys.extend(quad[1::2])
+    else:
+        raise ValueError('unsupported transform method %s' % method)
+    return (int(math.floor(min(xs))),
+            int(math.floor(min(ys))),
+            int(math.ceil(max(xs))),
+            int(math.ceil(max(ys))))
+
+
+def getPolygonArea(xs, ys):
+    area = 0
+    for i in xrange(len(xs)):
+        area += xs[i - 1] * ys[i] - xs[i] * ys[i - 1]
+    return abs(area) / 2.0
+
+
+def getTransformScale(size, method, data):
+    """
+    Returns the average number of source pixels per target pixel,
+    along one axis, of Image.transform(size, method, data).
+    """
+    if method == Image.EXTENT:
+        sourceArea = abs((data[2] - data[0]) * (data[3] - data[1]))
+        targetArea = size[0] * size[1]
+    elif method == Image.QUAD:
+        sourceArea = getPolygonArea(data[0::2], data[1::2])
+        targetArea = size[0] * size[1]
+    elif method == Image.MESH:
+        sourceArea = sum([getPolygonArea(quad[0::2], quad[1::2])
+                          for _targetBox, quad in data])
+        targetArea = sum([(right - left) * (bottom - top)
+                          for (left, top, right, bottom), _quad in data])
+    else:
+        raise ValueError('unsupported transform method %s' % method)
+    if not targetArea:
+        return 1.0
+    return math.sqrt(float(sourceArea) / targetArea)
+
+
+def scaleTransformData(method, data, factor):
+    """
+    Returns transform data equivalent to @data for a source image
+    shrunk by @factor.
+    """
+    factor = float(factor)
+    if method in (Image.EXTENT, Image.QUAD):
+        return [v / factor for v in data]
+    elif method == Image.MESH:
+        return [(targetBox, [v / factor for v in quad])
+                for targetBox, quad in data]
+    else:
+        raise ValueError('unsupported transform method %s' % method)
+
+
+def offsetTransformData(method, data, dx, dy):
+    """
+    Returns transform data equivalent to @data for a source image
+    whose origin has been moved to (dx, dy).
+    """
+    def offsetQuad(quad):
+        return [v - (dy if i % 2 else dx)
+                for i, v in enumerate(quad)]
+
+    if method in (Image.EXTENT, Image.QUAD):
+        return offsetQuad(data)
+    elif method == Image.MESH:
+        return [(targetBox, offsetQuad(quad))
+                for targetBox, quad in data]
+    else:
+        raise ValueError('unsupported transform method %s' % method)
+
+
+def intersectBoxes(box1, box2):
+    return (max(box1[0], box2[0]),
+            max(box1[1], box2[1]),
+            min(box1[2], box2[2]),
+            min(box1[3], box2[3]))
+
+
+def getTransformWindow(imageSize, method, data, resample=Image.NEAREST):
+    """
+    Returns the box of source pixels that Image.transform() can read
+    for the given arguments, clipped to the image, or None if the
+    transform lies entirely outside the image.
+    """
+    margin = FILTER_MARGINS.get(resample, DEFAULT_FILTER_MARGIN)
+    left, top, right, bottom = getTransformSourceBox(method, data)
+    window = intersectBoxes((left - margin, top - margin,
+                             right + margin, bottom + margin),
+                            (0, 0) + tuple(imageSize))
+    if window[0] >= window[2] or window[1] >= window[3]:
+        return None
+    return window
+
+
+def windowedTransform(image, size, method, data, resample=Image.NEAREST,
+                      maxWindowFraction=None):
+    """
+    Equivalent to image.transform(size, method, data, resample), but
+    crops the source window the transform reads first, so that the
+    warp only deals with that window. If the window covers more than
+    @maxWindowFraction of the image, cropping would just copy most of
+    it, and we transform the whole image instead. If @image is a
+    TiledRaster and the transform shrinks it, the source is read from
+    the overview level that matches the scale.
+    """
+    if isinstance(image, TiledRaster):
+        image, factor = image.getLevelForScale(getTransformScale(size, method, data))
+        if factor != 1:
+            data = scaleTransformData(method, data, factor)
+    window = getTransformWindow(image.size, method, data, resample)
+    if window is None:
+        return Image.new(image.mode, size)
+    if maxWindowFraction is not None:
+        windowArea = (window[2] - window[0]) * (window[3] - window[1])
+        if windowArea > maxWindowFraction * image.size[0] * image.size[1]:
+            return image.transform(size, method, data, resample)
+    return (image.crop(window)
+            .transform(size, method,
+                       offsetTransformData(method, data, window[0], window[1]),
+                       resample))
+
+
+class RasterLevel(object):
+    """
+    One level of a TiledRaster. Supports the subset of the PIL Image
+    interface used by the quadtree generators: size, mode, crop(),
+    transform() and resize(). crop() and transform() only read the
+    blocks they need.
+    """
+
+    mode = 'RGBA'
+
+    def __init__(self, mmap_, offset, size, blockSize):
+        self.mmap = mmap_
+        self.offset = offset
+        self.size = size
+        self.blockSize = blockSize
+        self.blocksPerRow = int(math.ceil(float(size[0]) / blockSize))
+        self.blocksPerColumn = int(math.ceil(float(size[1]) / blockSize))
+        self.blockBytes = blockSize * blockSize * BYTES_PER_PIXEL
+
+    def getNumBytes(self):
+        return self.blocksPerRow * self.blocksPerColumn * self.blockBytes
+
+    def getBlock(self, bx, by):
+        offset = self.offset + (by * self.blocksPerRow + bx) * self.blockBytes
+        # frombuffer() wraps the mapped bytes without copying them
+        return Image.frombuffer('RGBA', (self.blockSize, self.blockSize),
+                                buffer(self.mmap, offset, self.blockBytes),
+                                'raw', 'RGBA', 0, 1)
+
+    def crop(self, box):
+        left, top, right, bottom = [int(v) for v in box]
+        result = Image.new('RGBA', (right - left, bottom - top), (0, 0, 0, 0))
+        x0, y0, x1, y1 = intersectBoxes((left, top, right, bottom),
+                                        (0, 0) + self.size)
+        if x0 >= x1 or y0 >= y1:
+            return result
+
+        bs = self.blockSize
+        for by in xrange(y0 // bs, (y1 - 1) // bs + 1):
+            for bx in xrange(x0 // bs, (x1 - 1) // bs + 1):
+                blockBox = (bx * bs, by * bs, (bx + 1) * bs, (by + 1) * bs)
+                bl, bt, br, bb = intersectBoxes(blockBox, (x0, y0, x1, y1))
+                piece = self.getBlock(bx, by).crop((bl - blockBox[0],
+                                                    bt - blockBox[1],
+                                                    br - blockBox[0],
+                                                    bb - blockBox[1]))
+                result.paste(piece, (bl - left, bt - top))
+        return result
+
+    def transform(self, size, method, data=None, resample=Image.NEAREST):
+        """
+        Like Image.transform(), but reads only the source window the
+        transform touches.
+        """
+        return windowedTransform(self, size, method, data, resample)
+
+    def getImage(self):
+        """
+        Reads the whole level into a regular PIL image.
+        """
+        return self.crop((0, 0) + self.size)
+
+    def resize(self, size, resample=Image.NEAREST):
+        return self.getImage().resize(size, resample)
+
+
+def getLevelSizes(size, blockSize):
+    """
+    Returns the sizes of the levels stored for an image of @size:
+    halving, rounding up, until a level fits in one block.
+    """
+    width, height = size
+    result = [(width, height)]
+    while width > blockSize or height > blockSize:
+        width, height = int(math.ceil(width / 2.)), int(math.ceil(height / 2.))
+        result.append((width, height))
+    return result
+
+
+def writeLevel(out, image, blockSize):
+    width, height = image.size
+    for top in xrange(0, height, blockSize):
+        for left in xrange(0, width, blockSize):
+            # crop() pads past the image edge with zeros
+            block = image.crop((left, top,
+                                left + blockSize, top + blockSize))
+            out.write(block.tobytes())
+
+
+class TiledRaster(RasterLevel):
+    """
+    Read-only, memory-mapped RGBA raster. The TiledRaster itself reads
+    the full resolution level; getLevel() and getLevelForScale() return
+    the overviews.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            mmap_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = mmap_[:struct.calcsize(HEADER_FORMAT)]
+        magic, version, width, height, blockSize, numLevels = struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC or version != VERSION:
+            mmap_.close()
+            raise SourceRasterError('%s is not a version %d tiled raster' % (path, VERSION))
+        super(TiledRaster, self).__init__(mmap_, HEADER_SIZE, (width, height), blockSize)
+        self.levels = [self]
+        offset = HEADER_SIZE + self.getNumBytes()
+        for levelSize in getLevelSizes(self.size, blockSize)[1:numLevels]:
+            level = RasterLevel(mmap_, offset, levelSize, blockSize)
+            self.levels.append(level)
+            offset += level.getNumBytes()
+        if offset > len(mmap_):
+            mmap_.close()
+            raise SourceRasterError('%s is truncated' % path)
+
+    @classmethod
+    def fromImage(cls, image, path, blockSize=DEFAULT_BLOCK_SIZE):
+        """
+        Converts @image to a tiled raster at @path, with its overview
+        levels, and returns it. The file is written under a temporary
+        name and renamed into place, so concurrent readers never see a
+        partial raster.
+        """
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        width, height = image.size
+        levelSizes = getLevelSizes(image.size, blockSize)
+        dirName = os.path.dirname(path)
+        if not os.path.exists(dirName):
+            os.makedirs(dirName)
+        fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                header = struct.pack(HEADER_FORMAT, MAGIC, VERSION,
+                                     width, height, blockSize, len(levelSizes))
+                out.write(header.ljust(HEADER_SIZE, '\0'))
+                writeLevel(out, image, blockSize)
+                # each overview is halved from the previous one, the
+                # same way the simple generator builds its pyramid
+                for levelSize in levelSizes[1:]:
+                    image = image.resize(levelSize, Image.ANTIALIAS)
+                    writeLevel(out, image, blockSize)
+            os.chmod(tmpPath, 0644)
+            os.rename(tmpPath, path)
+        except:
+            os.unlink(tmpPath)
+            raise
+        return cls(path)
+
+    def close(self):
+        self.mmap.close()
+
+    def getNumLevels(self):
+        return len(self.levels)
+
+    def getLevel(self, index):
+        """
+        Returns the level @index, each level being half the size of the
+        one before it. Level 0 is the TiledRaster itself.
+        """
+        return self.levels[index]
+
+    def getLevelForScale(self, scale):
+        """
+        Returns (level, factor) for the coarsest level that still has
+        at least one pixel per target pixel when the raster is drawn at
+        @scale source pixels per target pixel. Source coordinates must
+        be divided by factor to address the level.
+        """
+        index = 0
+        while (index + 1 < len(self.levels)
+               and 2 ** (index + 1) <= scale):
+            index += 1
+        return self.levels[index], 2 ** index
+
+    def resize(self, size, resample=Image.NEAREST):
+        """
+        Like Image.resize(), but reads from the smallest level that is
+        at least @size.
+        """
+        level = self
+        for candidate in self.levels[1:]:
+            if candidate.size[0] < size[0] or candidate.size[1] < size[1]:
+                break
+            level = candidate
+        if level.size == tuple(size):
+            return level.getImage()
+        return level.getImage().resize(size, resample)
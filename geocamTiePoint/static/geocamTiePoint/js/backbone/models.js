@@ -307,6 +307,11 @@ $(function($) {
             	return null;
             }	
         },
+
+        setExportPending: function(type, pending) {
+            // read back by ExportOverlayView when it renders
+            this[type + 'ExportPending'] = pending;
+        },
         
         startExport: function(options) {
             var exportType = options.exportType;
@@ -316,22 +321,51 @@ $(function($) {
             assert(! this.get(exportUrl), 'Model has an exportUrl already.');
             var request_url = this.get('url').replace('.json',
                                                       '/generateExport/'+exportType);
-            var exportPending = this.getExportPendingObj(exportType);
-            exportPending = true;
             var model = this;
-            model.on(event, function() {
-            		exportPending = false;},
-            	this);
-            $.post(request_url, '', function() {
-                model.fetch({ success: function() {
-                	if (model.get(exportUrl)) {
-                		model.trigger(event);
-                	}
-                } });
+            model.setExportPending(exportType, true);
+            model.on(event, function onExportReady() {
+                model.off(event, onExportReady, this);
+                model.setExportPending(exportType, false);
+            }, this);
+            $.post(request_url, '', function(response) {
+                if (! response.job) {
+                    // refused, e.g. too big
+                    model.setExportPending(exportType, false);
+                    if (options.error) options.error(response.result);
+                    return;
+                }
+                model.pollExportJob(response.job.statusUrl, exportType, options);
             }, 'json')
             .error(function(xhr, status, error) {
-                 this.exportPending = false;
-                 if (options.error) options.error();
+                 model.setExportPending(exportType, false);
+                 if (options.error) options.error(error);
+            });
+        },
+
+        pollExportJob: function(statusUrl, exportType, options) {
+            // exports are rendered by a worker process; check on the
+            // job until it is finished, then pick up the export url
+            var model = this;
+            $.getJSON(statusUrl, function(job) {
+                if (job.status == 'done') {
+                    model.fetch({ success: function() {
+                        if (model.get(exportType + 'ExportUrl')) {
+                            model.trigger(exportType + '_export_ready');
+                        }
+                    } });
+                } else if (job.status == 'failed' || job.status == 'canceled') {
+                    model.setExportPending(exportType, false);
+                    if (options.error) options.error('export ' + job.status);
+                } else {
+                    model.trigger(exportType + '_export_progress', job);
+                    setTimeout(function() {
+                        model.pollExportJob(statusUrl, exportType, options);
+                    }, 2000);
+                }
+            })
+            .error(function(xhr, status, error) {
+                model.setExportPending(exportType, false);
+                if (options.error) options.error(error);
             });
         }
     });
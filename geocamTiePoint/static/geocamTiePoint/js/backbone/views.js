@@ -1333,7 +1333,7 @@ $(function($) {
 					var createArchiveElem = '#create_' + type + '_archive';
 					this.$(createArchiveElem).attr('disabled', true);
 					this.model.startExport({
-						error : function() {
+						error : function(error) {
 							$('#exportError').html(
 									'Error during export: ' + error);
 						},
@@ -1348,18 +1348,30 @@ $(function($) {
 					var createArchiveElem = '#create_' + type + '_archive';
 					var exportBtn = '#' + type + '_export_button';
 
-					this.model.on(event, function onExportReady() {
+					var onExportProgress = function(job) {
+						var status = (job.status == 'queued' ? 'queued'
+									  : Math.round(100 * job.progress) + '% done');
+						if (job.etaSeconds != null) {
+							status += ', about ' + Math.ceil(job.etaSeconds / 60) + ' min left';
+						}
+						thisView.$(exportBtn + ' .exportStatus').text(' (' + status + ')');
+					};
+					var onExportReady = function() {
 						this.model.off(null, onExportReady, null);
+						this.model.off(null, onExportProgress, null);
 						if (app.currentView === thisView)
 							this.render();
-					}, this);
+					};
+					this.model.on(event, onExportReady, this);
+					this.model.on(type + '_export_progress', onExportProgress, this);
 					this.$(createArchiveElem).attr('disabled', true);
 					(this.$(exportBtn)
 							.html('<img src="/static/geocamTiePoint/images/loading.gif">'
 									+ '&nbsp;'
 									+ 'Creating '
 									+ type
-									+ ' export archive (this could take a few minutes)...'));
+									+ ' export archive (this could take a few minutes)...'
+									+ '<span class="exportStatus"></span>'));
 				}
 			}); // end ExportOverlayView
 }); // end jQuery ready handler
@@ -14,7 +14,32 @@
 # specific language governing permissions and limitations under the License.
 #__END_LICENSE__
 
-from django.test import TestCase
+import os
+import math
+import time
+import shutil
+import sqlite3
+import struct
+import tarfile
+import zipfile
+import datetime
+import tempfile
+import threading
+import multiprocessing
+from StringIO import StringIO
+
+from PIL import Image
+
+from django.core.files.base import ContentFile
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
+from django.utils.http import quote_etag
+
+from geocamTiePoint import models, quadTree, sourceRaster, tileEnhancement, exportQueue, exportEstimator, transform, views
+from geocamTiePoint.models import Overlay, ExportJob, ImageData, QuadTree
+from geocamTiePoint.renderQueue import RenderQueue
+from geocamTiePoint.singleFlight import SingleFlight
+from geocamTiePoint.tileStore import DiskTileStore
 
 
 class geocamTiePointTest(TestCase):
@@ -23,3 +48,930 @@ class geocamTiePointTest(TestCase):
     """
     def test_geocamTiePoint(self):
         pass
+
+
+def getTestImage(size):
+    """
+    Returns an RGBA gradient image of @size with a transparent corner.
+    """
+    w, h = size
+    image = Image.new('RGBA', size)
+    image.putdata([((x * 255) // w, (y * 255) // h, 128, 0 if x < 10 and y < 10 else 255)
+                   for y in xrange(h)
+                   for x in xrange(w)])
+    return image
+
+
+class TileEnhancementTest(SimpleTestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_autoenhanceSmallTiledRaster(self):
+        # rasters no bigger than HISTOGRAM_IMAGE_SIZE are not resized
+        for size in ((200, 150), (256, 256), (400, 300)):
+            image = getTestImage(size)
+            raster = sourceRaster.TiledRaster.fromImage(image, '%s/%dx%d.raster' % ((self.tempDir,) + size))
+            self.assertEqual(tileEnhancement.getAutoenhanceLut(raster),
+                             tileEnhancement.getAutoenhanceLut(image))
+
+            # zoom level 0 of a single-tile image is the raster itself
+            if max(size) <= quadTree.TILE_SIZE:
+                gen = quadTree.SimpleQuadTreeGenerator('testAutoenhance%dx%d' % size, raster)
+                self.assertEqual(tileEnhancement.getAutoenhanceLut(gen.getHistogramImage()),
+                                 tileEnhancement.getAutoenhanceLut(image))
+
+
+class SourceRasterTest(SimpleTestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def createRaster(self, image):
+        return sourceRaster.TiledRaster.fromImage(image, '%s/%dx%d.raster'
+                                                  % ((self.tempDir,) + image.size))
+
+    def disableFullResolution(self, raster):
+        def getBlock(bx, by):
+            raise AssertionError('read full resolution block %d, %d' % (bx, by))
+        raster.getBlock = getBlock
+
+    def test_overviewLevels(self):
+        image = getTestImage((1000, 600))
+        raster = self.createRaster(image)
+        self.assertEqual([level.size for level in raster.levels],
+                         [(1000, 600), (500, 300), (250, 150)])
+        expected = image
+        for i in xrange(raster.getNumLevels()):
+            self.assertEqual(raster.getLevel(i).getImage().tobytes(), expected.tobytes())
+            expected = expected.resize((int(math.ceil(expected.size[0] / 2.)),
+                                        int(math.ceil(expected.size[1] / 2.))),
+                                       Image.ANTIALIAS)
+
+    def test_oldVersionRejected(self):
+        path = '%s/old.raster' % self.tempDir
+        with open(path, 'wb') as f:
+            f.write(struct.pack('<8sIIII', sourceRaster.MAGIC, 1, 16, 16, 256)
+                    .ljust(sourceRaster.HEADER_SIZE, '\0'))
+            f.write('\0' * 256 * 256 * 4)
+        self.assertRaises(sourceRaster.SourceRasterError, sourceRaster.TiledRaster, path)
+
+    def test_resizeReadsOverview(self):
+        raster = self.createRaster(getTestImage((1000, 600)))
+        self.disableFullResolution(raster)
+        self.assertEqual(raster.resize((250, 150)).tobytes(),
+                         raster.getLevel(2).getImage().tobytes())
+        self.assertEqual(raster.resize((400, 240)).size, (400, 240))
+
+    def test_transformReadsOverview(self):
+        raster = self.createRaster(getTestImage((1000, 600)))
+        level = raster.getLevel(2)
+        expected = level.transform((100, 60), Image.EXTENT, (0, 0, 250, 150), Image.BILINEAR)
+        self.disableFullResolution(raster)
+        # 4 source pixels per target pixel
+        result = sourceRaster.windowedTransform(raster, (100, 60), Image.EXTENT,
+                                                (0, 0, 1000, 600), Image.BILINEAR)
+        self.assertEqual(result.tobytes(), expected.tobytes())
+
+    def test_simpleGeneratorReadsOverviews(self):
+        image = getTestImage((1000, 600))
+        raster = self.createRaster(image)
+        self.disableFullResolution(raster)
+        gen = quadTree.SimpleQuadTreeGenerator('testOverviews', raster)
+        imageGen = quadTree.SimpleQuadTreeGenerator('testOverviewsImage', image)
+        for zoom in xrange(gen.maxZoom):
+            self.assertEqual(gen.generateTile(zoom + quadTree.ZOOM_OFFSET, 0, 0).tobytes(),
+                             imageGen.generateTile(zoom + quadTree.ZOOM_OFFSET, 0, 0).tobytes())
+        self.assertEqual(gen.getHistogramImage().size, (250, 150))
+
+
+# maps image pixels to spherical mercator meters near Houston, like the
+# transforms in bin/benchmarkTiler.py
+AFFINE_TRANSFORM = {
+    'type': 'projective',
+    'matrix': [[30.0, 4.0, -10600000.0],
+               [3.0, -30.0, 3500000.0],
+               [0.0, 0.0, 1.0]]
+}
+QUADRATIC_TRANSFORM = {
+    'type': 'quadratic',
+    'matrix': [[3.0e-3, 1.0e-3, 30.0, 4.0, -10600000.0],
+               [1.0e-3, -2.0e-3, 3.0, -30.0, 3500000.0],
+               [0.0, 0.0, 0.0, 0.0, 1.0]]
+}
+
+
+class AdaptiveMeshTest(SimpleTestCase):
+    def createGenerator(self, transformDict):
+        return quadTree.WarpedQuadTreeGenerator('testMesh', Image.new('RGBA', (768, 512)),
+                                                transformDict, 'pil')
+
+    def getCenterTile(self, gen, zoom):
+        xmin, ymin, xmax, ymax = gen.getTileBounds(zoom).bounds
+        return (xmin + xmax) // 2, (ymin + ymax) // 2
+
+    def getMeshPatches(self, gen, zoom, x, y):
+        size, method, patches, _resample = gen.getPilTransformArgsGeneral(
+            zoom, x, y, quadTree.getQualityProfile('draft'))
+        self.assertEqual(method, Image.MESH)
+        # the patches cover the whole tile
+        self.assertEqual(sum([(r - l) * (b - t) for (l, t, r, b), _quad in patches]),
+                         size[0] * size[1])
+        return patches
+
+    def getSourcePoint(self, gen, zoom, x, y, px, py):
+        return gen.transform.reverse(transform.pixelsToMeters(x * quadTree.TILE_SIZE + px,
+                                                              y * quadTree.TILE_SIZE + py,
+                                                              zoom))
+
+    def test_patchIsLinear(self):
+        corners = [(0, 0), (0, 64), (64, 64), (64, 0)]
+
+        def affine(px, py):
+            return (2 * px + py + 5, px - py)
+        self.assertTrue(quadTree.WarpedQuadTreeGenerator.patchIsLinear(
+            affine, 0, 0, 64, [affine(*c) for c in corners]))
+
+        for curvature, expected in ((1e-4, True), (1e-2, False)):
+            def curved(px, py):
+                return (px + curvature * px * px, py)
+            self.assertEqual(quadTree.WarpedQuadTreeGenerator.patchIsLinear(
+                curved, 0, 0, 64, [curved(*c) for c in corners]), expected)
+
+        # patches that leave the image are split until they are small
+        self.assertFalse(quadTree.WarpedQuadTreeGenerator.patchIsLinear(
+            affine, 0, 0, 64, [affine(*c) for c in corners[:3]] + [None]))
+
+    def test_affineSinglePatch(self):
+        gen = self.createGenerator(AFFINE_TRANSFORM)
+        zoom = gen.maxZoom - 2
+        x, y = self.getCenterTile(gen, zoom)
+        self.assertEqual(len(self.getMeshPatches(gen, zoom, x, y)), 1)
+
+    def test_nonLinearSubdivides(self):
+        gen = self.createGenerator(QUADRATIC_TRANSFORM)
+
+        # strongly curved over a low zoom tile: split down to PATCH_SIZE
+        zoom = gen.maxZoom - 2
+        x, y = self.getCenterTile(gen, zoom)
+        patches = self.getMeshPatches(gen, zoom, x, y)
+        self.assertEqual(set([r - l for (l, t, r, b), _quad in patches]),
+                         set([quadTree.PATCH_SIZE]))
+
+        # at full resolution, larger patches are enough, and bilinear
+        # interpolation within them stays within MESH_TOLERANCE
+        zoom = gen.maxZoom
+        x, y = self.getCenterTile(gen, zoom)
+        patches = self.getMeshPatches(gen, zoom, x, y)
+        self.assertTrue(1 < len(patches) < (quadTree.TILE_SIZE / quadTree.PATCH_SIZE) ** 2)
+        for (left, top, right, bottom), _quad in patches:
+            size = right - left
+            upperLeft, lowerLeft, lowerRight, upperRight = [
+                self.getSourcePoint(gen, zoom, x, y, px, py)
+                for px, py in ((left, top), (left, bottom), (right, bottom), (right, top))]
+            for u in (0.25, 0.5, 0.75):
+                for v in (0.25, 0.5, 0.75):
+                    interpolated = [(upperLeft[i] * (1 - u) * (1 - v)
+                                     + upperRight[i] * u * (1 - v)
+                                     + lowerLeft[i] * (1 - u) * v
+                                     + lowerRight[i] * u * v)
+                                    for i in (0, 1)]
+                    exact = self.getSourcePoint(gen, zoom, x, y,
+                                                left + u * size, top + v * size)
+                    self.assertLessEqual(math.hypot(exact[0] - interpolated[0],
+                                                    exact[1] - interpolated[1]),
+                                         quadTree.MESH_TOLERANCE)
+
+
+class CoveredBoxTest(SimpleTestCase):
+    # rotated by 45 degrees, so the corners of the tile bounds are
+    # outside the footprint
+    transformDict = {
+        'type': 'projective',
+        'matrix': [[20.0, 20.0, -10600000.0],
+                   [20.0, -20.0, 3500000.0],
+                   [0.0, 0.0, 1.0]]
+    }
+
+    def setUp(self):
+        self.gen = quadTree.WarpedQuadTreeGenerator('testCoveredBox',
+                                                    Image.new('RGBA', (768, 512), (200, 100, 50, 255)),
+                                                    self.transformDict, 'pil')
+        self.zoom = self.gen.maxZoom
+        self.profile = quadTree.getQualityProfile('draft')
+
+    def getTiles(self):
+        xmin, ymin, xmax, ymax = self.gen.getTileBounds(self.zoom).bounds
+        return [(x, y)
+                for x in xrange(xmin, xmax + 1)
+                for y in xrange(ymin, ymax + 1)]
+
+    def test_coveredBox(self):
+        fullBox = (0, 0, int(quadTree.TILE_SIZE), int(quadTree.TILE_SIZE))
+        kinds = set()
+        for x, y in self.getTiles():
+            box = self.gen.getCoveredBox(self.zoom, x, y)
+            # the tile rendered without the covered box
+            fullTile = self.gen.warpPil(self.zoom, x, y, self.profile)
+            alphaBox = fullTile.split()[3].getbbox()
+            if box is None:
+                kinds.add('outside')
+                self.assertEqual(alphaBox, None)
+                # the empty tile short-circuit
+                self.assertTrue(self.gen.generateTile(self.zoom, x, y, 'draft')
+                                is quadTree.getEmptyTileImage())
+                continue
+            kinds.add('inside' if box == fullBox else 'partial')
+            # the box holds every pixel of the footprint
+            self.assertEqual(quadTree.boxesIntersect(box, fullBox), True)
+            self.assertEqual(alphaBox, sourceRaster.intersectBoxes(alphaBox, box))
+            self.assertEqual(self.gen.generateTile(self.zoom, x, y, 'draft').tobytes(),
+                             fullTile.tobytes())
+        self.assertEqual(kinds, set(['outside', 'inside', 'partial']))
+
+    def test_metatile(self):
+        # a 2x2 block in the corner of the tile bounds, mostly outside
+        # the footprint
+        xmin, ymin, _xmax, _ymax = self.gen.getTileBounds(self.zoom).bounds
+        tiles = self.gen.generateMetatile(self.zoom, xmin, ymin, 2, 'draft')
+        self.assertEqual(sorted(tiles.keys()),
+                         [(xmin, ymin), (xmin, ymin + 1), (xmin + 1, ymin), (xmin + 1, ymin + 1)])
+        # the block rendered without the covered box
+        fullBlock = self.gen.warpPil(self.zoom, xmin, ymin, self.profile, 2, 2)
+        size = int(quadTree.TILE_SIZE)
+        numEmpty = 0
+        for (x, y), tile in tiles.iteritems():
+            left, top = (x - xmin) * size, (y - ymin) * size
+            fullTile = fullBlock.crop((left, top, left + size, top + size))
+            if fullTile.split()[3].getbbox() is None:
+                self.assertTrue(tile is quadTree.getEmptyTileImage())
+                numEmpty += 1
+            else:
+                self.assertEqual(tile.tobytes(), fullTile.tobytes())
+        self.assertTrue(0 < numEmpty < 4)
+
+
+class NegotiateTileEncodingTest(SimpleTestCase):
+    def test_parseAcceptHeader(self):
+        self.assertEqual(quadTree.parseAcceptHeader('image/webp,Image/PNG;q=0.8, */*;q=0.5,'
+                                                    ' image/jpeg;q=bad'),
+                         {'image/webp': 1.0,
+                          'image/png': 0.8,
+                          '*/*': 0.5,
+                          'image/jpeg': 0.0})
+        self.assertEqual(quadTree.parseAcceptHeader(''), {})
+
+    def test_qValues(self):
+        self.assertEqual(quadTree.negotiateTileEncoding('image/png;q=0.5', ['png-small'], True),
+                         'png-small')
+        # q=0 means not acceptable
+        self.assertEqual(quadTree.negotiateTileEncoding('image/png;q=0', ['png-small'], True),
+                         None)
+        # our preference order wins over the client's q values
+        self.assertEqual(quadTree.negotiateTileEncoding('image/png;q=0.1, image/jpeg',
+                                                        ['png-small', 'jpeg-high'], False),
+                         'png-small')
+
+    def test_wildcards(self):
+        for accept in ('*/*', 'image/*', 'image/*;q=1, */*;q=0.8'):
+            self.assertEqual(quadTree.negotiateTileEncoding(accept, ['png-small'], True), None)
+
+    def test_defaultFallback(self):
+        self.assertEqual(quadTree.negotiateTileEncoding(None, ['png-small'], True), None)
+        self.assertEqual(quadTree.negotiateTileEncoding('text/html', ['png-small'], True), None)
+        # encodings without alpha only qualify if alpha isn't needed
+        self.assertEqual(quadTree.negotiateTileEncoding('image/jpeg', ['jpeg-high'], True), None)
+        self.assertEqual(quadTree.negotiateTileEncoding('image/jpeg', ['jpeg-high'], False),
+                         'jpeg-high')
+        # unknown encodings are skipped
+        self.assertEqual(quadTree.negotiateTileEncoding('image/png', ['bogus', 'png-fast'], True),
+                         'png-fast')
+
+
+@override_settings(GEOCAM_TIE_POINT_PREFERRED_TILE_ENCODINGS=('png-small',),
+                   GEOCAM_TIE_POINT_TILE_QUALITY='standard')
+class TileViewTest(SimpleTestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        cache.clear()
+        self.diskTileStore = views.diskTileStore
+        views.diskTileStore = None
+
+    def tearDown(self):
+        views.diskTileStore = self.diskTileStore
+        cache.clear()
+
+    def cacheTile(self, encoding, bits):
+        key = quadTree.getTileCacheKey(1, 5, 3, 4, 'standard', encoding)
+        quadTree.setCachedTile(key, (bits, 'image/png'))
+
+    def getTile(self, query='', **headers):
+        request = self.factory.get('/tile/1/5/3/4.png' + query, **headers)
+        return views.getTile(request, '1', '5', '3', '4.png')
+
+    def test_negotiatedEncoding(self):
+        self.cacheTile(None, 'default tile')
+        self.cacheTile('png-small', 'small tile')
+
+        response = self.getTile(HTTP_ACCEPT='image/png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'small tile')
+        self.assertEqual(response['Vary'], 'Accept')
+
+        # wildcards get the default encoding, which also depends on Accept
+        response = self.getTile(HTTP_ACCEPT='*/*')
+        self.assertEqual(response.content, 'default tile')
+        self.assertEqual(response['Vary'], 'Accept')
+
+    def test_explicitEncoding(self):
+        self.cacheTile('png-small', 'small tile')
+        response = self.getTile('?encoding=png-small', HTTP_ACCEPT='image/jpeg')
+        self.assertEqual(response.content, 'small tile')
+        self.assertFalse(response.has_header('Vary'))
+
+        self.assertEqual(self.getTile('?encoding=bogus').status_code, 400)
+
+    def assertNotModified(self, etag):
+        for ifNoneMatch in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+            response = self.getTile(HTTP_ACCEPT='*/*', HTTP_IF_NONE_MATCH=ifNoneMatch)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response['Vary'], 'Accept')
+
+    def test_etagMemoryHit(self):
+        self.cacheTile(None, 'default tile')
+        response = self.getTile(HTTP_ACCEPT='*/*')
+        etag = quote_etag(quadTree.getContentHash('default tile'))
+        self.assertEqual(response['ETag'], etag)
+        self.assertNotModified(etag)
+
+        response = self.getTile(HTTP_ACCEPT='*/*', HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, 'default tile')
+
+    def test_etagDiskHit(self):
+        tempDir = tempfile.mkdtemp()
+        try:
+            views.diskTileStore = DiskTileStore(tempDir, maxBytes=1000000)
+            views.diskTileStore.putTile(1, 5, 3, 4, ('disk tile', 'image/png'), 'standard')
+            response = self.getTile(HTTP_ACCEPT='*/*')
+            self.assertEqual(''.join(response.streaming_content), 'disk tile')
+            response.close()
+            etag = quote_etag(quadTree.getContentHash('disk tile'))
+            self.assertEqual(response['ETag'], etag)
+            self.assertNotModified(etag)
+        finally:
+            shutil.rmtree(tempDir)
+
+    @override_settings(GEOCAM_TIE_POINT_PROGRESSIVE_TILES=True)
+    def test_etagProgressive(self):
+        renderQueue = views.tileRenderQueue
+        # no workers, so the final render stays queued
+        views.tileRenderQueue = RenderQueue(numWorkers=0)
+        try:
+            previewKey = quadTree.getTileCacheKey(1, 5, 3, 4, views.PREVIEW_TILE_QUALITY, None)
+            quadTree.setCachedTile(previewKey, ('preview tile', 'image/png'))
+            previewEtag = quote_etag(quadTree.getContentHash('preview tile'))
+            response = self.getTile(HTTP_ACCEPT='*/*')
+            self.assertEqual(response.content, 'preview tile')
+            self.assertEqual(response['ETag'], previewEtag)
+            self.assertTrue(response['Cache-Control'].startswith('max-age='))
+            finalKey = quadTree.getTileCacheKey(1, 5, 3, 4, 'standard', None)
+            self.assertTrue(views.tileRenderQueue.isPending(finalKey))
+
+            # the preview isn't the tile, so it's never "not modified"
+            response = self.getTile(HTTP_ACCEPT='*/*', HTTP_IF_NONE_MATCH=previewEtag)
+            self.assertEqual(response.status_code, 200)
+
+            # once the final tile is rendered, it replaces the preview
+            self.cacheTile(None, 'final tile')
+            response = self.getTile(HTTP_ACCEPT='*/*', HTTP_IF_NONE_MATCH=previewEtag)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, 'final tile')
+            self.assertNotModified(quote_etag(quadTree.getContentHash('final tile')))
+        finally:
+            views.tileRenderQueue = renderQueue
+
+
+class SingleFlightTest(SimpleTestCase):
+    numThreads = 8
+
+    def setUp(self):
+        cache.clear()
+
+    def runConcurrently(self, flight, compute):
+        """
+        Calls flight.run() for the same key from numThreads threads and
+        returns a list of ('result', value) or ('error', exception). The
+        first compute() call is held until all the threads have called
+        run().
+        """
+        started = threading.Semaphore(0)
+        release = threading.Event()
+        outcomes = []
+
+        def heldCompute():
+            release.wait()
+            return compute()
+
+        def request():
+            started.release()
+            try:
+                outcomes.append(('result', flight.run('tile', heldCompute, lambda: None)))
+            except Exception as e:  # pylint: disable=W0703
+                outcomes.append(('error', e))
+
+        threads = [threading.Thread(target=request) for _ in xrange(self.numThreads)]
+        for thread in threads:
+            thread.start()
+        for _ in threads:
+            started.acquire()
+        # let the followers reach their wait
+        time.sleep(0.2)
+        release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_sharedResult(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return 'tile data'
+        outcomes = self.runConcurrently(SingleFlight(useCacheLock=False), compute)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(outcomes, [('result', 'tile data')] * self.numThreads)
+
+    def test_sharedError(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            raise ValueError('render failed')
+        outcomes = self.runConcurrently(SingleFlight(useCacheLock=False), compute)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(outcomes), self.numThreads)
+        for kind, value in outcomes:
+            self.assertEqual(kind, 'error')
+            self.assertTrue(isinstance(value, ValueError))
+
+        # the failure isn't remembered
+        self.assertEqual(SingleFlight(useCacheLock=False).run('tile', lambda: 'ok', lambda: None),
+                         'ok')
+
+    def test_cacheLock(self):
+        # another process holds the lock and stores its result
+        stored = []
+        cache.add('geocamTiePoint.SingleFlight.lock.tile', 1, 30)
+        timer = threading.Timer(0.1, stored.append, ['tile data'])
+        timer.start()
+        flight = SingleFlight(useCacheLock=True, lockTimeout=5, pollInterval=0.01)
+
+        def compute():
+            raise AssertionError('computed a tile that another process is rendering')
+        self.assertEqual(flight.run('tile', compute, lambda: stored[0] if stored else None),
+                         'tile data')
+        timer.join()
+
+
+class PersistTilesTest(TestCase):
+    def setUp(self):
+        self.dataRoot = tempfile.mkdtemp()
+        self.settingsOverride = override_settings(DATA_ROOT=self.dataRoot + '/',
+                                                  MEDIA_ROOT=self.dataRoot + '/',
+                                                  GEOCAM_TIE_POINT_PREFERRED_TILE_ENCODINGS=('webp', 'jpeg'))
+        self.settingsOverride.enable()
+        models.diskTileStoreG = None
+
+    def tearDown(self):
+        models.diskTileStoreG = None
+        self.settingsOverride.disable()
+        shutil.rmtree(self.dataRoot)
+
+    def createQuadTree(self, size):
+        out = StringIO()
+        getTestImage(size).save(out, format='png')
+        imageData = ImageData(lastModifiedTime=datetime.datetime.utcnow(),
+                              contentType='image/png',
+                              width=size[0],
+                              height=size[1])
+        imageData.image.save('test.png', ContentFile(out.getvalue()))
+        return QuadTree.objects.create(imageData=imageData)
+
+    def test_persistTilesToDisk(self):
+        qt = self.createQuadTree((600, 400))
+        qt.persistTilesToDisk()
+
+        store = QuadTree.getDiskTileStore()
+        gen = qt.getGenerator()
+        quality = models.settings.GEOCAM_TIE_POINT_TILE_QUALITY
+        # jpeg has no alpha, so getTile never negotiates it
+        encodings = [None] + [e for e in ('webp',) if e in quadTree.TILE_ENCODERS]
+        tiles = list(gen.getAllTiles())
+        self.assertTrue(len(tiles) > 4)
+        for zoom, x, y in tiles:
+            for encoding in encodings:
+                stored = store.getTileFile(qt.id, zoom, x, y, quality, encoding)
+                self.assertTrue(stored is not None, (zoom, x, y, encoding))
+                stored[0].close()
+                self.assertEqual(stored[1], (quadTree.getTileEncoder(encoding)['contentType']
+                                             if encoding else 'image/jpeg'))
+            self.assertEqual(store.getTileFile(qt.id, zoom, x, y, quality, 'jpeg'), None)
+            # the memory tile cache is left alone
+            self.assertEqual(quadTree.getCachedTile(quadTree.getTileCacheKey(qt.id, zoom, x, y, quality)),
+                             None)
+
+    def test_deleteRemovesTiles(self):
+        qt = self.createQuadTree((300, 200))
+        qt.persistTilesToDisk()
+        self.assertTrue(os.path.isdir(qt.getBasePath()))
+        # queryset deletes don't call QuadTree.delete()
+        QuadTree.objects.filter(id=qt.id).delete()
+        self.assertFalse(os.path.exists(qt.getBasePath()))
+
+
+class DiskTileStoreTest(SimpleTestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_evictInBackground(self):
+        store = DiskTileStore(self.tempDir, maxBytes=10000, scanFraction=0.1)
+        scanThreads = []
+        scan = store.scan
+
+        def recordScan():
+            scanThreads.append(threading.current_thread())
+            return scan()
+        store.scan = recordScan
+
+        for y in xrange(30):
+            store.putTile(1, 5, 0, y, ('x' * 1000, 'image/png'))
+            # let the scans run between writes, as they would in a
+            # server that isn't writing tiles flat out
+            store.evictQueue.join()
+        self.assertTrue(scanThreads)
+        self.assertTrue(threading.current_thread() not in scanThreads)
+        totalBytes, _entries = store.scan()
+        self.assertTrue(totalBytes <= 10000)
+        # the newest tile is kept
+        stored = store.getTileFile(1, 5, 0, 29)
+        self.assertTrue(stored is not None)
+        stored[0].close()
+
+
+class ExportQueueTest(TestCase):
+    def setUp(self):
+        self.dataRoot = tempfile.mkdtemp()
+        self.settingsOverride = override_settings(DATA_ROOT=self.dataRoot + '/')
+        self.settingsOverride.enable()
+        self.overlay = Overlay.objects.create(name='test.png')
+
+    def tearDown(self):
+        self.settingsOverride.disable()
+        shutil.rmtree(self.dataRoot)
+
+    def createJob(self, exportType='html', **kwargs):
+        kwargs.setdefault('createdTime', datetime.datetime.utcnow())
+        return ExportJob.objects.create(overlay=self.overlay, exportType=exportType, **kwargs)
+
+    def createWorkDir(self, job):
+        workDir = job.getWorkDir()
+        os.makedirs(workDir)
+        return workDir
+
+    def reload(self, job):
+        return ExportJob.objects.get(id=job.id)
+
+    def test_claimNextJob(self):
+        low = self.createJob('kml')
+        high = self.createJob('mbtiles', priority=1)
+        self.createJob('html', status='waiting', numShards=2)
+
+        job = exportQueue.claimNextJob('worker1')
+        self.assertEqual(job.id, high.id)
+        self.assertEqual(job.status, 'running')
+        self.assertEqual(job.worker, 'worker1')
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(job.startTime is not None)
+
+        self.assertEqual(exportQueue.claimNextJob('worker2').id, low.id)
+        # waiting jobs are not ready to run
+        self.assertEqual(exportQueue.claimNextJob('worker3'), None)
+
+    def test_cancelQueuedJob(self):
+        job = self.createJob()
+        workDir = self.createWorkDir(job)
+        exportQueue.cancelJob(job)
+        job = self.reload(job)
+        self.assertEqual(job.status, 'canceled')
+        self.assertTrue(job.endTime is not None)
+        self.assertFalse(os.path.exists(workDir))
+        self.assertEqual(exportQueue.claimNextJob('worker1'), None)
+
+    def test_cancelRunningJob(self):
+        self.createJob()
+        job = exportQueue.claimNextJob('worker1')
+        progress = exportQueue.JobProgress(job)
+        progress(1, 10)
+
+        exportQueue.cancelJob(job)
+        job = self.reload(job)
+        # the worker stops it at its next progress report
+        self.assertEqual(job.status, 'running')
+        self.assertTrue(job.cancelRequested)
+        self.assertRaises(exportQueue.ExportCanceled, progress, 10, 10)
+
+    def test_etaSeconds(self):
+        self.createJob(estimatedSeconds=300)
+        job = exportQueue.claimNextJob('worker1')
+        # no progress yet, the estimate counts down from startTime
+        self.assertAlmostEqual(self.reload(job).getEtaSeconds(), 300, delta=2)
+
+        # a resumed run: 10 of its 20 tiles were skipped, and it took
+        # 10 seconds to render the other 10
+        exportQueue.JobProgress(job)(20, 100, 10)
+        job = self.reload(job)
+        self.assertEqual(job.resumedTiles, 10)
+        now = datetime.datetime.utcnow()
+        ExportJob.objects.filter(id=job.id).update(
+            startTime=now - datetime.timedelta(seconds=40),
+            progressTime=now - datetime.timedelta(seconds=30),
+            # heartbeats don't count as progress
+            updateTime=now)
+        # 80 tiles at 1 second each, 30 of them since the last report
+        self.assertAlmostEqual(self.reload(job).getEtaSeconds(), 50, delta=2)
+
+    def test_etaSecondsAfterRequeue(self):
+        job = self.createJob()
+        ExportJob.objects.filter(id=job.id).update(
+            completedTiles=50, totalTiles=100, resumedTiles=0,
+            progressTime=datetime.datetime.utcnow())
+        # the next run has rendered nothing yet
+        job = exportQueue.claimNextJob('worker1')
+        self.assertEqual(job.progressTime, None)
+        self.assertEqual(job.getEtaSeconds(), None)
+
+    def makeStale(self, job):
+        ExportJob.objects.filter(id=job.id).update(
+            updateTime=datetime.datetime.utcnow() - datetime.timedelta(seconds=120))
+
+    @override_settings(GEOCAM_TIE_POINT_EXPORT_STALE_JOB_SECONDS=60,
+                       GEOCAM_TIE_POINT_EXPORT_MAX_ATTEMPTS=2)
+    def test_requeueStaleJobs(self):
+        self.createJob('kml')
+        self.createJob('html')
+        job = exportQueue.claimNextJob('worker1')
+        live = exportQueue.claimNextJob('worker2')
+        workDir = self.createWorkDir(job)
+
+        self.makeStale(job)
+        exportQueue.requeueStaleJobs()
+        job = self.reload(job)
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.worker, '')
+        # the next worker resumes from the work dir
+        self.assertTrue(os.path.exists(workDir))
+        self.assertEqual(self.reload(live).status, 'running')
+
+        job = exportQueue.claimNextJob('worker3')
+        self.assertEqual(job.attempts, 2)
+        self.makeStale(job)
+        exportQueue.requeueStaleJobs()
+        job = self.reload(job)
+        self.assertEqual(job.status, 'failed')
+        self.assertTrue('after 2 attempts' in job.error)
+        self.assertTrue(job.endTime is not None)
+        self.assertFalse(os.path.exists(workDir))
+
+    @override_settings(GEOCAM_TIE_POINT_EXPORT_STALE_JOB_SECONDS=60)
+    def test_requeueStaleCanceledJob(self):
+        self.createJob()
+        job = exportQueue.claimNextJob('worker1')
+        exportQueue.cancelJob(job)
+        self.makeStale(job)
+        exportQueue.requeueStaleJobs()
+        self.assertEqual(self.reload(job).status, 'canceled')
+
+    def createShardedJob(self, numShards=2):
+        parent = self.createJob(status='waiting', numShards=numShards)
+        shards = [self.createJob(createdTime=parent.createdTime, parent=parent,
+                                 shardIndex=i, shardRanges='[]')
+                  for i in xrange(numShards)]
+        return parent, shards
+
+    def test_cancelWaitingJob(self):
+        parent, shards = self.createShardedJob()
+        workDir = self.createWorkDir(parent)
+        running = exportQueue.claimNextJob('worker1')
+        self.assertEqual(running.id, shards[0].id)
+
+        exportQueue.cancelJob(parent)
+        self.assertEqual(self.reload(parent).status, 'canceled')
+        self.assertTrue(self.reload(shards[0]).cancelRequested)
+        self.assertEqual(self.reload(shards[1]).status, 'canceled')
+        self.assertFalse(os.path.exists(workDir))
+
+    def test_shardsDone(self):
+        parent, shards = self.createShardedJob()
+        shards = [exportQueue.claimNextJob('worker%d' % i) for i in xrange(len(shards))]
+        shardDir = self.createWorkDir(shards[0])
+
+        exportQueue.finishJob(shards[0], 'done')
+        self.assertEqual(self.reload(parent).status, 'waiting')
+        # the merge needs the part
+        self.assertTrue(os.path.exists(shardDir))
+
+        exportQueue.finishJob(shards[1], 'done')
+        self.assertEqual(self.reload(parent).status, 'queued')
+        self.assertEqual(exportQueue.claimNextJob('worker2').id, parent.id)
+
+    def test_shardFailed(self):
+        parent, shards = self.createShardedJob(3)
+        workDir = self.createWorkDir(parent)
+        failed = exportQueue.claimNextJob('worker1')
+        running = exportQueue.claimNextJob('worker2')
+
+        exportQueue.finishJob(failed, 'failed', 'out of memory')
+        parent = self.reload(parent)
+        self.assertEqual(parent.status, 'failed')
+        self.assertEqual(parent.error, 'shard 0 was failed')
+        self.assertTrue(self.reload(running).cancelRequested)
+        self.assertEqual(self.reload(shards[2]).status, 'canceled')
+        self.assertFalse(os.path.exists(workDir))
+
+
+class ExportWriterTest(SimpleTestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def getMbtilesContents(self, path):
+        db = sqlite3.connect(path)
+        try:
+            tiles = sorted(db.execute('SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles'))
+            metadata = dict(db.execute('SELECT name, value FROM metadata'))
+        finally:
+            db.close()
+        return [(zoom, x, y, str(data)) for zoom, x, y, data in tiles], metadata
+
+    def test_tarWriterResume(self):
+        path = os.path.join(self.tempDir, 'export.tar.gz')
+        writer = quadTree.TarWriter('x', compresslevel=1, path=path)
+        writer.writeData('a.txt', 'a')
+        writer.writeData('b.txt', 'b')
+        state = writer.checkpoint()
+        # a worker that dies after writing more than it checkpointed
+        writer.writeData('c.txt', 'lost')
+        writer.endMember()
+        writer.out.close()
+        self.assertTrue(os.path.getsize(path) > state['offset'])
+
+        writer = quadTree.TarWriter('x', compresslevel=1, path=path, resumeState=state)
+        writer.writeData('c.txt', 'c')
+        writer.writeData('d.txt', 'd')
+        tar = tarfile.open(fileobj=writer.getFile(), mode='r:gz')
+        self.assertEqual(tar.getnames(), ['x', 'x/a.txt', 'x/b.txt', 'x/c.txt', 'x/d.txt'])
+        self.assertEqual(tar.extractfile('x/c.txt').read(), 'c')
+        writer.getFile().close()
+
+    def test_mbtilesWriterResume(self):
+        path = os.path.join(self.tempDir, 'export.mbtiles')
+        writer = quadTree.MBTilesWriter('x', path=path, batchSize=2)
+        writer.writeData('s/3/1/1.png', 'tile1')
+        state = writer.checkpoint()
+        # committed by a batch after the checkpoint
+        writer.writeData('s/4/2/2.png', 'lost2')
+        writer.writeData('s/5/3/3.png', 'lost3')
+        writer.db.close()
+
+        writer = quadTree.MBTilesWriter('x', path=path, resumeState=state)
+        writer.writeData('s/4/2/2.png', 'tile2')
+        writer.writeData('s/5/3/3.png', 'tile3')
+        writer.finish()
+        tiles, metadata = self.getMbtilesContents(path)
+        self.assertEqual(tiles, [(3, 1, 6, 'tile1'), (4, 2, 13, 'tile2'), (5, 3, 28, 'tile3')])
+        self.assertEqual((metadata['format'], metadata['minzoom'], metadata['maxzoom']),
+                         ('png', '3', '5'))
+
+    def test_fileWriterRewriteLinkedFile(self):
+        writer = quadTree.FileWriter(self.tempDir)
+        writer.writeData('a.png', 'same')
+        writer.writeData('b.png', 'same')
+        self.assertTrue(os.path.samefile(os.path.join(self.tempDir, 'a.png'),
+                                         os.path.join(self.tempDir, 'b.png')))
+
+        # a later run writes different data over one of the links
+        writer = quadTree.FileWriter(self.tempDir)
+        writer.writeData('b.png', 'new')
+        writer.writeData('c.png', 'new')
+        for name, data in (('a.png', 'same'), ('b.png', 'new'), ('c.png', 'new')):
+            with open(os.path.join(self.tempDir, name)) as f:
+                self.assertEqual(f.read(), data)
+
+    def test_zipWriterDuplicates(self):
+        writer = quadTree.ZipWriter('x')
+        writer.writeData('a.png', 'same')
+        writer.writeData('b.png', 'same')
+        archive = zipfile.ZipFile(writer.getFile())
+        # plain entries, not symlinks
+        self.assertEqual([(info.filename, info.external_attr >> 16) for info in archive.infolist()],
+                         [('x/a.png', 0644), ('x/b.png', 0644)])
+        self.assertEqual(archive.read('x/b.png'), 'same')
+
+    def test_checkpointSeconds(self):
+        path = os.path.join(self.tempDir, 'checkpoint.json')
+        checkpoint = quadTree.ExportCheckpoint(path, {'maxZoom': 5})
+        # pretend the first run took 10 seconds
+        checkpoint.startTime -= 10
+        checkpoint.save(quadTree.FileWriter(self.tempDir))
+
+        checkpoint = quadTree.ExportCheckpoint(path, {'maxZoom': 5})
+        self.assertTrue(checkpoint.getSeconds() >= 10)
+        # an export started over doesn't count the old runs
+        checkpoint = quadTree.ExportCheckpoint(path, {'maxZoom': 6})
+        self.assertTrue(checkpoint.getSeconds() < 10)
+
+    def test_tarWriterAppendPart(self):
+        states = []
+        for i, (name, data) in enumerate((('a', 'one'), ('c', 'two'))):
+            part = quadTree.TarWriter('x', compresslevel=1, dirEntry=False,
+                                      path=os.path.join(self.tempDir, 'part%d' % i))
+            part.writeData('s/%s.png' % name, data)
+            # written as a hard link
+            part.writeData('s/%s-copy.png' % name, data)
+            states.append(part.checkpoint())
+            part.out.close()
+
+        writer = quadTree.TarWriter('x', compresslevel=1)
+        for i, state in enumerate(states):
+            writer.appendPart(os.path.join(self.tempDir, 'part%d' % i), state)
+        writer.writeData('s/meta.json', '{}')
+        outDir = os.path.join(self.tempDir, 'out')
+        tar = tarfile.open(fileobj=writer.getFile(), mode='r:gz')
+        tar.extractall(outDir)
+        tar.close()
+
+        def readFile(path):
+            with open(os.path.join(outDir, 'x', 's', path)) as f:
+                return f.read()
+        self.assertEqual(sorted(os.listdir(os.path.join(outDir, 'x', 's'))),
+                         ['a-copy.png', 'a.png', 'c-copy.png', 'c.png', 'meta.json'])
+        self.assertEqual([readFile(path) for path in ('a-copy.png', 'c-copy.png', 'meta.json')],
+                         ['one', 'two', '{}'])
+        for name in ('a', 'c'):
+            self.assertTrue(os.path.samefile(os.path.join(outDir, 'x', 's', '%s.png' % name),
+                                             os.path.join(outDir, 'x', 's', '%s-copy.png' % name)))
+
+    def test_mbtilesWriterAppendPart(self):
+        states = []
+        for i, tiles in enumerate((['s/3/1/1.png'], ['s/4/2/2.png', 's/5/3/3.png'])):
+            part = quadTree.MBTilesWriter('x', path=os.path.join(self.tempDir, 'part%d' % i))
+            for path in tiles:
+                part.writeData(path, 'tile')
+            states.append(part.checkpoint())
+            part.db.close()
+
+        path = os.path.join(self.tempDir, 'export.mbtiles')
+        writer = quadTree.MBTilesWriter('x', path=path)
+        for i, state in enumerate(states):
+            writer.appendPart(os.path.join(self.tempDir, 'part%d' % i), state)
+        writer.finish()
+        tiles, metadata = self.getMbtilesContents(path)
+        self.assertEqual(tiles, [(3, 1, 6, 'tile'), (4, 2, 13, 'tile'), (5, 3, 28, 'tile')])
+        self.assertEqual((metadata['minzoom'], metadata['maxzoom']), ('3', '5'))
+
+
+def recordExportCosts(path):
+    costModel = exportEstimator.ExportCostModel(path)
+    for _ in xrange(5):
+        costModel.record('html', 100, 10.0, 1000)
+
+
+class ExportCostModelTest(SimpleTestCase):
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def test_concurrentRecord(self):
+        path = os.path.join(self.tempDir, 'exportCosts.json')
+        workers = [multiprocessing.Process(target=recordExportCosts, args=(path,))
+                   for _ in xrange(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        cost = exportEstimator.ExportCostModel(path).getCost('html')
+        self.assertEqual(cost['samples'], 20)
+        self.assertEqual(cost['secondsPerTile'], 0.1)
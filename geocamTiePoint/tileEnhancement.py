@@ -0,0 +1,132 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Image enhancement (auto-enhance, contrast, brightness) applied to
+tiles as they are served, instead of to the whole image. All the
+enhancements together reduce to a single 256-entry lookup table per
+color channel, so enhancing a tile is one Image.point() call, and
+every enhancement setting shares the same unenhanced pyramid.
+
+An enhancement is described by a short key such as 'a_c1.2_b-10'
+(auto-enhance, contrast 1.2, brightness -10). The key goes in the tile
+URL and in the tile cache key. The empty key means no enhancement.
+"""
+
+import operator
+
+from PIL import Image
+
+from geocamTiePoint import sourceRaster
+
+# largest side of the image the auto-enhance histogram is computed from
+HISTOGRAM_IMAGE_SIZE = 512
+
+
+class Enhancement(object):
+    def __init__(self, autoenhance=False, contrast=1.0, brightness=0.0):
+        self.autoenhance = bool(autoenhance)
+        # older records store 0 for 'no contrast change'
+        self.contrast = float(contrast) if contrast else 1.0
+        self.brightness = float(brightness or 0)
+
+    @classmethod
+    def fromImageData(cls, imageData):
+        return cls(imageData.autoenhance, imageData.contrast, imageData.brightness)
+
+    @classmethod
+    def fromKey(cls, key):
+        """
+        Parses an enhancement key. Raises ValueError if it is malformed.
+        """
+        result = cls()
+        for part in key.split('_'):
+            if not part:
+                continue
+            elif part == 'a':
+                result.autoenhance = True
+            elif part[0] == 'c':
+                result.contrast = float(part[1:])
+            elif part[0] == 'b':
+                result.brightness = float(part[1:])
+            else:
+                raise ValueError('bad enhancement key %s' % key)
+        return result
+
+    def getKey(self):
+        parts = []
+        if self.autoenhance:
+            parts.append('a')
+        if self.contrast != 1:
+            parts.append('c%g' % self.contrast)
+        if self.brightness != 0:
+            parts.append('b%g' % self.brightness)
+        return '_'.join(parts)
+
+    def isIdentity(self):
+        return self.getKey() == ''
+
+    def getLut(self, autoenhanceLut=None):
+        """
+        Returns the Image.point() table for RGBA images. Color channels
+        go through auto-enhance (if set, using @autoenhanceLut), then
+        contrast and brightness; alpha is unchanged.
+        """
+        colorLut = []
+        for value in xrange(256):
+            if self.autoenhance:
+                value = autoenhanceLut[value]
+            value = self.contrast * value + self.brightness
+            colorLut.append(min(max(int(round(value)), 0), 255))
+        return colorLut * 3 + range(256)
+
+
+def getAutoenhanceLut(image):
+    """
+    Returns the histogram equalization table for @image (the lookup
+    table from the old whole-image auto-enhance), computed from a
+    reduced copy of the image. Transparent pixels are not counted.
+    @image may also be a sourceRaster.TiledRaster or one of its levels.
+    """
+    if max(image.size) > HISTOGRAM_IMAGE_SIZE:
+        scale = float(HISTOGRAM_IMAGE_SIZE) / max(image.size)
+        image = image.resize((max(int(image.size[0] * scale), 1),
+                              max(int(image.size[1] * scale), 1)),
+                             Image.BILINEAR)
+    elif isinstance(image, sourceRaster.RasterLevel):
+        # small tiled rasters are used as is, read them whole
+        image = image.getImage()
+    if image.mode == 'RGBA':
+        h = image.convert('L').histogram(image.split()[3].point(lambda a: 255 if a else 0))
+    else:
+        h = image.convert('L').histogram()
+    # step size
+    step = reduce(operator.add, h) / 255
+    if not step:
+        return range(256)
+    # create equalization lookup table
+    lut = []
+    n = 0
+    for i in xrange(256):
+        lut.append(min(n / step, 255))
+        n = n + h[i]
+    return lut
+
+
+def enhanceTile(image, lut):
+    if image.mode != 'RGBA':
+        image = image.convert('RGBA')
+    return image.point(lut)
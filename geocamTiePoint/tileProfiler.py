@@ -0,0 +1,281 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Per-stage timing histograms for tile rendering, keyed by (generator,
+zoom, stage). Recording is a no-op until the profiler is enabled.
+
+Each process keeps its own histograms and periodically writes them
+as a JSON snapshot to <profileDir>/<host>-<pid>.json. Readers merge
+all the snapshots, so the numbers cover every worker process. The
+control file <profileDir>/control.json turns profiling on and off
+and resets the histograms at runtime, without a restart; processes
+pick up changes within CONTROL_CHECK_SECONDS.
+"""
+
+import os
+import json
+import math
+import time
+import socket
+import logging
+import tempfile
+import threading
+
+# histogram buckets are quarter-octaves starting at MIN_SECONDS, so
+# NUM_BUCKETS = 80 covers 10 us to 10 s
+MIN_SECONDS = 1e-5
+BUCKETS_PER_OCTAVE = 4
+NUM_BUCKETS = 80
+
+CONTROL_CHECK_SECONDS = 5
+FLUSH_SECONDS = 10
+CONTROL_FILE = 'control.json'
+
+PERCENTILES = (50, 90, 99)
+
+
+def getBucket(seconds):
+    if seconds <= MIN_SECONDS:
+        return 0
+    bucket = int(BUCKETS_PER_OCTAVE * math.log(seconds / MIN_SECONDS, 2))
+    return min(bucket, NUM_BUCKETS - 1)
+
+
+def getBucketSeconds(bucket):
+    # geometric middle of the bucket
+    return MIN_SECONDS * 2 ** ((bucket + 0.5) / BUCKETS_PER_OCTAVE)
+
+
+def getStatKey(generator, zoom, stage):
+    return '%s:%s:%s' % (generator, zoom, stage)
+
+
+def parseStatKey(statKey):
+    generator, zoom, stage = statKey.split(':')
+    return generator, int(zoom), stage
+
+
+def writeJsonAtomic(path, obj):
+    dirName = os.path.dirname(path)
+    if not os.path.exists(dirName):
+        os.makedirs(dirName)
+    fd, tmpPath = tempfile.mkstemp(dir=dirName, prefix='.tmp')
+    with os.fdopen(fd, 'w') as out:
+        json.dump(obj, out)
+    os.rename(tmpPath, path)
+
+
+def readJson(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+class Timer(object):
+    def __init__(self, profiler, generator, zoom, stage):
+        self.profiler = profiler
+        self.generator = generator
+        self.zoom = zoom
+        self.stage = stage
+        self.startTime = None
+
+    def __enter__(self):
+        self.startTime = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.generator, self.zoom, self.stage,
+                             time.time() - self.startTime)
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+class TileProfiler(object):
+    def __init__(self):
+        self.profileDir = None
+        self.defaultEnabled = False
+        self.enabled = False
+        self.resetTime = 0
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.lastControlCheck = 0
+        self.lastFlush = time.time()
+
+    def configure(self, profileDir, defaultEnabled=False):
+        """
+        Sets the directory shared by all worker processes. Profiling is
+        enabled if the control file says so, or if defaultEnabled is set
+        and there is no control file yet.
+        """
+        self.profileDir = profileDir
+        self.defaultEnabled = defaultEnabled
+        self.lastControlCheck = 0
+        self.checkControl()
+
+    def getSnapshotPath(self):
+        return os.path.join(self.profileDir,
+                            '%s-%d.json' % (socket.gethostname(), os.getpid()))
+
+    def checkControl(self):
+        now = time.time()
+        if self.profileDir is None or now - self.lastControlCheck < CONTROL_CHECK_SECONDS:
+            return
+        self.lastControlCheck = now
+        control = readJson(os.path.join(self.profileDir, CONTROL_FILE)) or {}
+        self.enabled = control.get('enabled', self.defaultEnabled)
+        resetTime = control.get('resetTime', 0)
+        if resetTime > self.resetTime:
+            with self.lock:
+                self.stats = {}
+                self.resetTime = resetTime
+
+    def isEnabled(self):
+        self.checkControl()
+        return self.enabled
+
+    def timer(self, generator, zoom, stage):
+        """
+        Returns a context manager that records the time spent in its
+        block, or does nothing if profiling is off.
+        """
+        if not self.isEnabled():
+            return NULL_TIMER
+        return Timer(self, generator, zoom, stage)
+
+    def record(self, generator, zoom, stage, seconds=None):
+        """
+        Records one event for the stage, with its duration if it has one
+        (cache hits and misses are just counted).
+        """
+        if not self.isEnabled():
+            return
+        statKey = getStatKey(generator, zoom, stage)
+        with self.lock:
+            stat = self.stats.get(statKey)
+            if stat is None:
+                stat = {'count': 0, 'totalSeconds': 0.0, 'buckets': [0] * NUM_BUCKETS}
+                self.stats[statKey] = stat
+            stat['count'] += 1
+            if seconds is not None:
+                stat['totalSeconds'] += seconds
+                stat['buckets'][getBucket(seconds)] += 1
+        if time.time() - self.lastFlush > FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if self.profileDir is None:
+            return
+        with self.lock:
+            self.lastFlush = time.time()
+            snapshot = {'resetTime': self.resetTime,
+                        'stats': self.stats}
+            try:
+                writeJsonAtomic(self.getSnapshotPath(), snapshot)
+            except (IOError, OSError):
+                logging.exception('TileProfiler: could not write snapshot')
+
+    def setControl(self, enabled=None, reset=False):
+        """
+        Changes the control file read by all processes.
+        """
+        path = os.path.join(self.profileDir, CONTROL_FILE)
+        control = readJson(path) or {}
+        if enabled is not None:
+            control['enabled'] = enabled
+        if reset:
+            control['resetTime'] = time.time()
+            for name in os.listdir(self.profileDir):
+                if name != CONTROL_FILE and name.endswith('.json'):
+                    os.unlink(os.path.join(self.profileDir, name))
+        writeJsonAtomic(path, control)
+        self.lastControlCheck = 0
+        self.checkControl()
+
+    def getMergedStats(self):
+        """
+        Merges the snapshots of all processes (and this process's
+        unflushed stats) into a dict statKey -> stat.
+        """
+        merged = {}
+
+        def merge(stats):
+            for statKey, stat in stats.iteritems():
+                total = merged.setdefault(statKey, {'count': 0,
+                                                    'totalSeconds': 0.0,
+                                                    'buckets': [0] * NUM_BUCKETS})
+                total['count'] += stat['count']
+                total['totalSeconds'] += stat['totalSeconds']
+                total['buckets'] = [a + b for a, b in zip(total['buckets'], stat['buckets'])]
+
+        ownPath = None
+        if self.profileDir is not None and os.path.isdir(self.profileDir):
+            ownPath = self.getSnapshotPath()
+            for name in os.listdir(self.profileDir):
+                path = os.path.join(self.profileDir, name)
+                if name == CONTROL_FILE or not name.endswith('.json') or path == ownPath:
+                    continue
+                snapshot = readJson(path)
+                if snapshot and snapshot.get('resetTime', 0) >= self.resetTime:
+                    merge(snapshot['stats'])
+        with self.lock:
+            merge(self.stats)
+        return merged
+
+    def getSummary(self):
+        """
+        Returns a list of dicts with the count, mean and percentiles (in
+        milliseconds) of each (generator, zoom, stage), sorted by key.
+        """
+        result = []
+        for statKey, stat in sorted(self.getMergedStats().iteritems(),
+                                    key=lambda item: parseStatKey(item[0])):
+            generator, zoom, stage = parseStatKey(statKey)
+            entry = {'generator': generator,
+                     'zoom': zoom,
+                     'stage': stage,
+                     'count': stat['count']}
+            numTimed = sum(stat['buckets'])
+            if numTimed:
+                entry['meanMs'] = 1000 * stat['totalSeconds'] / numTimed
+                for pct in PERCENTILES:
+                    entry['p%dMs' % pct] = 1000 * getPercentile(stat['buckets'], pct)
+            result.append(entry)
+        return result
+
+
+def getPercentile(buckets, pct):
+    threshold = sum(buckets) * pct / 100.0
+    runningTotal = 0
+    for bucket, count in enumerate(buckets):
+        runningTotal += count
+        if runningTotal >= threshold:
+            return getBucketSeconds(bucket)
+    return getBucketSeconds(len(buckets) - 1)
+
+
+# process-wide profiler; the app configures it from settings on startup
+profiler = TileProfiler()
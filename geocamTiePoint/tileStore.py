@@ -0,0 +1,228 @@
+#__BEGIN_LICENSE__
+# Copyright (c) 2017, United States Government, as represented by the
+# Administrator of the National Aeronautics and Space Administration.
+# All rights reserved.
+#
+# The GeoRef platform is licensed under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0.
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the License for the
+# specific language governing permissions and limitations under the License.
+#__END_LICENSE__
+
+"""
+Persistent second-tier tile cache. Tiles are stored as plain files
+under <rootDir>/<quadTreeId>/<zoom>/<x>/<y>[.quality][.encoding].<ext>,
+so the tree for one QuadTree matches QuadTree.getBasePath() and can be
+served directly from disk. Each tile has a <tile file>.sha1 sidecar with
+the content hash of its bits, which getTile uses as the tile's ETag.
+"""
+
+import os
+import time
+import errno
+import logging
+import tempfile
+import threading
+
+from geocamTiePoint import quadTree
+from geocamTiePoint.renderQueue import RenderQueue
+
+# don't bother updating a tile's access time more often than this
+TOUCH_INTERVAL_SECONDS = 60
+
+# once over the cap, evict down to this fraction of it, so that we
+# don't have to rescan the tree on every write
+EVICT_TO_FRACTION = 0.9
+
+# content types of the default encodings of the aligned (png) and
+# unaligned (jpeg) tile generators
+DEFAULT_CONTENT_TYPES = ('image/png', 'image/jpeg')
+
+# extension of the content hash sidecar of each tile file
+HASH_EXTENSION = '.sha1'
+
+
+def writeFileAtomic(path, bits):
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(bits)
+        os.chmod(tmpPath, 0644)
+        os.rename(tmpPath, path)
+    except:
+        os.unlink(tmpPath)
+        raise
+
+
+class DiskTileStore(object):
+    """
+    Size-capped, LRU-evicted tile store on disk. Writes are atomic (temp
+    file plus rename) so concurrent readers never see a partial tile.
+    The mtime of each tile file doubles as its last access time, since
+    many filesystems are mounted noatime.
+
+    The total size is only known after a scan of the tree, so each
+    process rescans (and evicts if needed) after it has written
+    scanFraction * maxBytes since its last scan. The scan walks every
+    tile, so it runs on a background thread, not in the request that
+    happened to cross the threshold.
+    """
+
+    def __init__(self, rootDir, maxBytes, scanFraction=0.05):
+        self.rootDir = rootDir
+        self.maxBytes = maxBytes
+        self.scanFraction = scanFraction
+        self.bytesSinceScan = None  # None: no scan yet in this process
+        self.evictLock = threading.Lock()
+        self.evictQueue = RenderQueue()
+
+    def getPath(self, quadTreeId, zoom, x, y, contentType,
+                quality=quadTree.DEFAULT_QUALITY, encoding=None):
+        name = str(y)
+        if quality != quadTree.DEFAULT_QUALITY:
+            name += '.%s' % quality
+        if encoding is not None:
+            name += '.%s' % encoding
+        name += quadTree.contentTypeToExtension(contentType)
+        return os.path.join(self.rootDir, str(quadTreeId), str(zoom), str(x), name)
+
+    def getPathCandidates(self, quadTreeId, zoom, x, y,
+                          quality=quadTree.DEFAULT_QUALITY, encoding=None):
+        """
+        Returns the (path, contentType) pairs where the tile may be
+        stored. With no encoding, the tile was written in its
+        generator's default encoding, so it may have either default
+        content type.
+        """
+        if encoding is None:
+            contentTypes = DEFAULT_CONTENT_TYPES
+        else:
+            contentTypes = (quadTree.getTileEncoder(encoding)['contentType'],)
+        return [(self.getPath(quadTreeId, zoom, x, y, contentType, quality, encoding),
+                 contentType)
+                for contentType in contentTypes]
+
+    def getTileFile(self, quadTreeId, zoom, x, y,
+                    quality=quadTree.DEFAULT_QUALITY, encoding=None):
+        """
+        Returns (file, contentType) for the stored tile, where file is an
+        open handle the caller is responsible for closing, or None on a
+        miss.
+        """
+        for path, contentType in self.getPathCandidates(quadTreeId, zoom, x, y,
+                                                        quality, encoding):
+            try:
+                tileFile = open(path, 'rb')
+            except IOError:
+                continue
+            self.touch(path)
+            return tileFile, contentType
+        return None
+
+    def getTileHash(self, quadTreeId, zoom, x, y,
+                    quality=quadTree.DEFAULT_QUALITY, encoding=None):
+        """
+        Returns the content hash of the stored tile from its sidecar,
+        or None on a miss. Tiles stored without a sidecar get one.
+        """
+        for path, _contentType in self.getPathCandidates(quadTreeId, zoom, x, y,
+                                                         quality, encoding):
+            try:
+                with open(path + HASH_EXTENSION, 'rb') as hashFile:
+                    return hashFile.read()
+            except IOError:
+                pass
+            try:
+                with open(path, 'rb') as tileFile:
+                    contentHash = quadTree.getContentHash(tileFile.read())
+            except IOError:
+                continue
+            writeFileAtomic(path + HASH_EXTENSION, contentHash)
+            return contentHash
+        return None
+
+    def touch(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > TOUCH_INTERVAL_SECONDS:
+                os.utime(path, None)
+        except OSError:
+            # evicted since we opened it; our handle is still good
+            pass
+
+    def putTile(self, quadTreeId, zoom, x, y, data,
+                quality=quadTree.DEFAULT_QUALITY, encoding=None):
+        bits, contentType = data
+        path = self.getPath(quadTreeId, zoom, x, y, contentType, quality, encoding)
+        tileDir = os.path.dirname(path)
+        try:
+            os.makedirs(tileDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        writeFileAtomic(path + HASH_EXTENSION, quadTree.getContentHash(bits))
+        writeFileAtomic(path, bits)
+
+        if self.bytesSinceScan is not None:
+            self.bytesSinceScan += len(bits)
+        if (self.bytesSinceScan is None
+                or self.bytesSinceScan > self.scanFraction * self.maxBytes):
+            # don't queue another scan until this one's share is written
+            self.bytesSinceScan = 0
+            self.evictQueue.schedule('evict', self.evictIfNeeded)
+
+    def scan(self):
+        """
+        Returns the total size of stored tiles and a list of
+        (mtime, size, path) for each of them. Hash sidecars go with
+        their tiles and aren't counted.
+        """
+        entries = []
+        totalBytes = 0
+        for root, _dirs, files in os.walk(self.rootDir):
+            for f in files:
+                if f.startswith('.tmp') or f.endswith(HASH_EXTENSION):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                totalBytes += st.st_size
+        return totalBytes, entries
+
+    def evictIfNeeded(self):
+        if not self.evictLock.acquire(False):
+            # another thread is already on it
+            return
+        try:
+            self.bytesSinceScan = 0
+            totalBytes, entries = self.scan()
+            if totalBytes <= self.maxBytes:
+                return
+            targetBytes = EVICT_TO_FRACTION * self.maxBytes
+            entries.sort()
+            numEvicted = 0
+            for _mtime, size, path in entries:
+                if totalBytes <= targetBytes:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                try:
+                    os.unlink(path + HASH_EXTENSION)
+                except OSError:
+                    pass
+                totalBytes -= size
+                numEvicted += 1
+            logging.info('DiskTileStore: evicted %d tiles, %d bytes remain',
+                         numEvicted, totalBytes)
+        finally:
+            self.evictLock.release()
+
@@ -125,11 +125,45 @@ def solveQuad(a, p):
     else:
         # avoid divide by zero
         return p
-    
+
+
+def solveQuadArray(a, p):
+    """
+    Vectorized solveQuad() for an array of p values. Entries with no
+    real root come back as nan.
+    """
+    if a * a > 1e-20:
+        discriminant = 4 * a * p + 1
+        h = numpy.sqrt(numpy.where(discriminant < 0, numpy.nan, discriminant))
+        root1 = (-1 + h) / (2 * a)
+        root2 = (-1 - h) / (2 * a)
+        return numpy.where(numpy.abs(p - root1) <= numpy.abs(p - root2), root1, root2)
+    else:
+        # avoid divide by zero
+        return p
+
+
+def homogenize(pts):
+    '''Appends a column of ones to an Nx2 array of points.'''
+    return numpy.hstack([pts, numpy.ones((pts.shape[0], 1))])
+
 
 class Transform(object):
     '''Transform base class with fit function'''
-    
+
+    # True if reverseArray() is vectorized, rather than a loop over reverse()
+    hasFastReverseArray = False
+
+    def reverseArray(self, pts):
+        '''Applies the reverse transform to each row of the Nx2 array pts.
+           Points with no inverse come back as nan. Derived classes
+           override this with a vectorized version where they can.'''
+        result = numpy.empty(pts.shape)
+        for i, pt in enumerate(pts):
+            u = self.reverse(pt)
+            result[i, :] = numpy.nan if u is None else u
+        return result
+
     @classmethod
     def fit(cls, toPts, fromPts):
         '''Solve for the best transform parameters given input/output point pairs.'''
@@ -274,6 +308,13 @@ class LinearTransform(Transform):
         u = self.inverse.dot(v) # Multiply the matrix by the vector
         return u[:2].tolist()   # Return first two elements
 
+    hasFastReverseArray = True
+
+    def reverseArray(self, pts):
+        if self.inverse is None:
+            self.inverse = numpy.linalg.inv(self.matrix)
+        return homogenize(pts).dot(self.inverse.T)[:, :2]
+
     def getJsonDict(self):
         return {'type': 'projective',
                 'matrix': self.matrix.tolist()}
@@ -377,6 +418,14 @@ class ProjectiveTransform(Transform):
             self.inverse = getProjectiveInverse(self.matrix)
         return self._apply(self.inverse, pt)
 
+    hasFastReverseArray = True
+
+    def reverseArray(self, pts):
+        if self.inverse is None:
+            self.inverse = getProjectiveInverse(self.matrix)
+        u = homogenize(pts).dot(self.inverse.T)
+        return u[:, :2] / u[:, 2:]
+
     @classmethod
     def fromParams(cls, params):
         matrix = numpy.append(params, 1).reshape((3, 3))
@@ -506,6 +555,26 @@ class QuadraticTransform2(Transform):
 
         return [x, y]
 
+    hasFastReverseArray = True
+
+    def reverseArray(self, pts):
+        if self.projInverse is None:
+            self.projInverse = getProjectiveInverse(self.matrix)
+
+        # correct for pre-conditioning
+        r = pts[:, 0] / self.SCALE
+        s = pts[:, 1] / self.SCALE
+
+        a, b, c, d = self.quadraticTerms
+
+        q = s - d * r * r
+        p = r - c * q * q
+        x0 = solveQuadArray(a, p)
+        y0 = solveQuadArray(b, q)
+
+        u0 = homogenize(numpy.column_stack([x0, y0])).dot(self.projInverse.T)
+        return u0[:, :2] / u0[:, 2:]
+
     def getJsonDict(self):
         return {'type': 'quadratic',
                 'matrix': self.matrix.tolist(),
@@ -59,6 +59,15 @@ urlpatterns = [ ## New Workflow ##
             
                 url(r'^overlay/(?P<key>\d+)/generateExport/(?P<type>\w+)$', views.overlayGenerateExport,
                     {}, 'geocamTiePoint_overlayGenerateExport'),
+
+                url(r'^overlay/(?P<key>\d+)/estimateExport/(?P<type>\w+)$', views.overlayEstimateExport,
+                    {}, 'geocamTiePoint_overlayEstimateExport'),
+
+                url(r'^exportJob/(?P<jobId>\d+)\.json$', views.exportJobStatus,
+                    {}, 'geocamTiePoint_exportJobStatus'),
+
+                url(r'^exportJob/(?P<jobId>\d+)/cancel$', views.exportJobCancel,
+                    {}, 'geocamTiePoint_exportJobCancel'),
                                    
                 ## for integrating with Catalog ## 
                 url(r'^catalog/(?P<mission>\w+)/(?P<roll>\w+)/(?P<frame>\d+)/(?P<sizeType>\w+)/$', views.createOverlayAPI, 
@@ -112,5 +121,8 @@ urlpatterns = [ ## New Workflow ##
                     {}, 'geocamTiePoint_overlayListJson'),
             
                 url(r'^gc/(?:(?P<dryRun>\d+)/)?$', views.garbageCollect,
-                    {}, 'geocamTiePoint_garbageCollect')
+                    {}, 'geocamTiePoint_garbageCollect'),
+
+                url(r'^tileProfile\.json$', views.tileProfileJson,
+                    {}, 'geocamTiePoint_tileProfileJson')
     ]
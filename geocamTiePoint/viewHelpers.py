@@ -164,8 +164,10 @@ def saveImageToDatabase(PILimage, imageData, flags):
         imageData.unenhancedImage.delete()
         imageData.unenhancedImage.save("dummy.png", ContentFile(convertedBits), save=False)
     if DISPLAY in flags:
+        imageData.deleteSourceRaster()
         imageData.image.delete()
         imageData.image.save("dummy.png", ContentFile(convertedBits), save=False)
+        imageData.checksum = quadTree.getContentHash(convertedBits)
     imageData.contentType = 'image/png'
     imageData.save()
     
@@ -215,6 +217,9 @@ def createImageData(imageFile, sizeType):
     imageData.image.save('dummy.png', ContentFile(imageContent), save=False)
     imageData.unenhancedImage.save('dummy.png', ContentFile(imageContent), save=False)
     imageData.save()
+    if image and settings.GEOCAM_TIE_POINT_TILED_SOURCE_RASTERS:
+        # convert once at ingest, while we have the decoded image
+        imageData.getSourceRaster(image).close()
     return imageData
 
 
@@ -301,35 +306,6 @@ def createOverlayFromID(mission, roll, frame, sizeType, author):
 """
 Image enhancement 
 """
-def autoenhance(im): 
-    """
-    Takes in PIL image and does histogram matching.
-    """
-    h = im.convert("L").histogram()
-    lut = []
-    for b in range(0, len(h), 256):
-        # step size
-        step = reduce(operator.add, h[b:b+256]) / 255
-        # create equalization lookup table
-        n = 0
-        for i in range(256):
-            lut.append(n / step)
-            n = n + h[i+b]
-    # map image through lookup table
-    layers = 4 # RGBA
-    return im.point(lut*layers)
-
-
-def applyEnhancement(imageData):
-    """
-    Apply enhancements based on enhancement values in the imageData object.
-    """
-    originalImage = getImage(imageData, UNENHANCED)
-    if imageData.autoenhance == True:
-        enhancedIm = autoenhance(originalImage)
-    saveImageToDatabase(enhancedIm, imageData, [ENHANCED, DISPLAY])
-
-
 def saveEnhancementValToDB(imageData, enhanceType, value):
     """
     Given type of the enhancement, stores the value in appropriate 
@@ -337,6 +313,16 @@ def saveEnhancementValToDB(imageData, enhanceType, value):
     """
     if enhanceType == 'autoenhance':
         imageData.autoenhance = True
-        imageData.contrast = 0
+        imageData.contrast = 1
         imageData.brightness = 0
+    elif enhanceType == 'contrast':
+        imageData.contrast = value
+    elif enhanceType == 'brightness':
+        imageData.brightness = value
+    elif enhanceType == 'reset':
+        imageData.autoenhance = False
+        imageData.contrast = 1
+        imageData.brightness = 0
+    else:
+        raise ValueError('unknown enhancement type %s' % enhanceType)
     imageData.save()
@@ -18,10 +18,13 @@ from fileinput import filename
 
 from django.shortcuts import render_to_response
 from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotFound, JsonResponse
-from django.http import HttpResponseNotAllowed, Http404
+from django.http import FileResponse
+from django.http import HttpResponseNotAllowed, HttpResponseBadRequest, HttpResponseNotModified, Http404
 from django.template import RequestContext
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag
 from django.core.urlresolvers import reverse
 from django.core.files import File
 from django.core.cache import cache
@@ -31,10 +34,15 @@ from django.contrib import messages
 
 from django.dispatch import receiver
 from django.db.models.signals import pre_save, post_save, post_delete
-from django.db import transaction
+from django.db.models import Q
+from django.db import transaction, close_old_connections
 
 from geocamTiePoint.viewHelpers import *
-from geocamTiePoint import forms
+from geocamTiePoint.models import ExportJob
+from geocamTiePoint import forms, tileEnhancement, exportQueue
+from geocamTiePoint.renderQueue import RenderQueue
+from geocamTiePoint.singleFlight import SingleFlight
+from geocamTiePoint.tileProfiler import profiler
 from geocamUtil.icons import rotate
 from geocamUtil import imageInfo
 
@@ -43,6 +51,32 @@ if settings.USING_APP_ENGINE:
     from google.appengine.api import backends
     from google.appengine.api import taskqueue
 
+PREVIEW_TILE_QUALITY = 'draft'
+
+# export type -> (QuadTree file field, content type)
+EXPORT_FIELDS = {
+    'html': ('htmlExport', 'application/x-tgz'),
+    'kml': ('kmlExport', 'application/x-tgz'),
+    'geotiff': ('geotiffExport', 'application/x-tgz'),
+    'mbtiles': ('mbtilesExport', 'application/x-sqlite3'),
+}
+
+# background renderer for the final version of progressively served tiles
+tileRenderQueue = RenderQueue(settings.GEOCAM_TIE_POINT_NUM_RENDER_THREADS)
+
+# background renderer that warms the cache for newly aligned quadtrees.
+# prewarmQuadTreeIds maps overlay key -> id of the newest aligned
+# QuadTree; a pre-warm job stops as soon as its QuadTree is superseded.
+prewarmQueue = RenderQueue(settings.GEOCAM_TIE_POINT_NUM_PREWARM_THREADS)
+prewarmQuadTreeIds = {}
+
+# coalesces concurrent renders of the same tile
+tileSingleFlight = SingleFlight(settings.GEOCAM_TIE_POINT_CROSS_PROCESS_TILE_LOCKS,
+                                settings.GEOCAM_TIE_POINT_TILE_LOCK_TIMEOUT)
+
+# persistent second-tier tile cache behind the django cache
+diskTileStore = QuadTree.getDiskTileStore()
+
 @login_required
 def backbone(request):
     initial_overlays = Overlay.objects.order_by('pk')
@@ -105,6 +139,11 @@ def createEnhancedImageTiles(request):
     Receives request from the client to enhance the images. The
     type of enhancement and value are specified in the 'data' json
     package from client.
+
+    Enhancement is applied to tiles as they are served (see
+    tileEnhancement), so we only store the new values and return the
+    tile url with the matching enhancement key; the unenhanced
+    QuadTree is shared by every enhancement setting.
     """
     if request.is_ajax() and request.method == 'POST':
         data = request.POST
@@ -115,28 +154,29 @@ def createEnhancedImageTiles(request):
         overlayId = data["overlayId"]
         # get the overlay
         overlay = Overlay.objects.get(key=overlayId)
-        # save the previous unaligned quadtree
-        previousQuadTree = None
-        if overlay.imageData.raw != True: 
+        rawImageData = overlay.getRawImageData()
+        if not overlay.imageData.raw and rawImageData is not None:
+            # go back from an enhanced copy of the image, made before
+            # enhancement was applied at tile time, to the original
             previousQuadTree = overlay.unalignedQuadTree
-        else:  
-            # make a copy of the raw image data
-            rawImageData = overlay.imageData
-            newImageData = rawImageData.duplicate()
-            overlay.imageData = newImageData
-            overlay.save()
-        imageData = overlay.imageData
-        # save the new enhancement value in database
-        saveEnhancementValToDB(imageData, enhanceType, value)   
-        # enhance the image
-        applyEnhancement(imageData)     
-        overlay.imageData.save()
+            overlay.imageData = rawImageData
+            overlay.generateUnalignedQuadTree()
+            if (previousQuadTree is not None
+                    and previousQuadTree.id != overlay.unalignedQuadTree_id
+                    and not (Overlay.objects
+                             .filter(Q(unalignedQuadTree=previousQuadTree)
+                                     | Q(alignedQuadTree=previousQuadTree))
+                             .exists())):
+                # the aligned QuadTree may still be this one
+                previousQuadTree.delete()  # delete the old tiles
+        try:
+            saveEnhancementValToDB(overlay.imageData, enhanceType, value)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
         overlay.save()
-        # generate a new quadtree for display
-        overlay.generateUnalignedQuadTree()  # generate tiles
-        if previousQuadTree != None:
-            previousQuadTree.delete()  # delete the old tiles
-        data = {'status': 'success', 'id': overlay.key}
+        data = {'status': 'success',
+                'id': overlay.key,
+                'unalignedTilesUrl': overlay.getUnalignedTilesUrl()}
         return HttpResponse(json.dumps(data))
                
 
@@ -281,6 +321,9 @@ def overlayIdJson(request, key):
                 # could not generate aligned quad tree from opimized params
                 return HttpResponse(dumps(overlay.jsonDict), content_type='application/json')        
         overlay.save()
+        if transformDict:
+            # the worker must see the new QuadTree row
+            transaction.on_commit(lambda: schedulePrewarm(overlay))
         return HttpResponse(dumps(overlay.jsonDict), content_type='application/json')
     elif request.method == 'DELETE':
         get_object_or_404(Overlay, pk=key).delete()
@@ -299,23 +342,179 @@ def overlayListJson(request):
 def overlayIdImageFileName(request, key, fileName):
     if request.method == 'GET':
         overlay = get_object_or_404(Overlay, key=key)
-        fobject = overlay.imageData.image.file
-        response = HttpResponse(fobject.read(), content_type=overlay.imageData.contentType)
+        imageData = overlay.imageData
+        etag = None
+        if imageData.checksum:
+            etag = quote_etag(imageData.checksum)
+            notModified = getNotModifiedResponse(request, etag)
+            if notModified is not None:
+                return notModified
+        fobject = imageData.image.file
+        response = HttpResponse(fobject.read(), content_type=imageData.contentType)
+        if etag:
+            response['ETag'] = etag
         return response
     else:
         return HttpResponseNotAllowed(['GET'])
 
 
-def getTileData(quadTreeId, zoom, x, y):
+def getTileData(quadTreeId, zoom, x, y, quality=quadTree.DEFAULT_QUALITY,
+                encoding=None):
     gen = QuadTree.getGeneratorWithCache(quadTreeId)
     try:
-        return gen.getTileData(zoom, x, y)
+        return gen.getTileData(zoom, x, y, quality, encoding)
     except quadTree.ZoomTooBig:
         return transparentPngData()
     except quadTree.OutOfBounds:
         return transparentPngData()
 
 
+def storeTile(quadTreeId, zoom, x, y, quality, encoding, data):
+    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y, quality, encoding)
+    quadTree.setCachedTile(key, data)
+    if diskTileStore:
+        diskTileStore.putTile(quadTreeId, zoom, x, y, data, quality, encoding)
+
+
+def renderTile(quadTreeId, zoom, x, y, quality, encoding=None):
+    """
+    Renders the tile along with the rest of its metatile, stores them
+    all in the tile caches, and returns the data for the tile.
+    """
+    gen = QuadTree.getGeneratorWithCache(quadTreeId)
+    try:
+        tiles = gen.getMetatileData(zoom, x, y, quality, encoding,
+                                    settings.GEOCAM_TIE_POINT_METATILE_SIZE)
+    except (quadTree.ZoomTooBig, quadTree.OutOfBounds):
+        tiles = {(x, y): transparentPngData()}
+    for (tileX, tileY), data in tiles.iteritems():
+        storeTile(quadTreeId, zoom, tileX, tileY, quality, encoding, data)
+    return tiles[(x, y)]
+
+
+def getUnenhancedTileData(quadTreeId, zoom, x, y, quality, encoding=None):
+    """
+    Returns the tile from the memory or disk tile caches, rendering it
+    on a miss.
+    """
+    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y, quality, encoding)
+    data = quadTree.getCachedTile(key)
+    if data is None and diskTileStore:
+        stored = diskTileStore.getTileFile(quadTreeId, zoom, x, y, quality, encoding)
+        if stored is not None:
+            tileFile, contentType = stored
+            with tileFile:
+                data = (tileFile.read(), contentType)
+    if data is None:
+        data = renderTileOnce(quadTreeId, zoom, x, y, quality, encoding)
+    return data
+
+
+def getAutoenhanceLut(quadTreeId):
+    key = 'geocamTiePoint.autoenhanceLut.%s' % quadTreeId
+    lut = cache.get(key)
+    if lut is None:
+        gen = QuadTree.getGeneratorWithCache(quadTreeId)
+        lut = tileEnhancement.getAutoenhanceLut(gen.getHistogramImage())
+        cache.set(key, lut)
+    return lut
+
+
+def getEnhancedTileData(quadTreeId, zoom, x, y, quality, encoding, enhancement):
+    """
+    Returns the tile with @enhancement applied. Enhanced tiles are made
+    from the unenhanced ones on demand and only kept in the memory
+    cache, since making them again is cheap.
+    """
+    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y, quality, encoding,
+                                   enhancement.getKey())
+    data = quadTree.getCachedTile(key)
+    if data is not None:
+        return data
+    bits, contentType = getUnenhancedTileData(quadTreeId, zoom, x, y, quality, encoding)
+    with profiler.timer('getTile', zoom, 'enhance'):
+        autoenhanceLut = getAutoenhanceLut(quadTreeId) if enhancement.autoenhance else None
+        tileImage = tileEnhancement.enhanceTile(PIL.Image.open(StringIO(bits)),
+                                                enhancement.getLut(autoenhanceLut))
+        # without an explicit encoding, keep the format of the source tile
+        data = quadTree.encodeTile(tileImage, encoding or contentType.split('/')[1])
+    quadTree.setCachedTile(key, data)
+    return data
+
+
+def renderTileOnce(quadTreeId, zoom, x, y, quality, encoding=None):
+    """
+    Like renderTile(), but concurrent calls for the same tile, in this
+    process or (with cache locks) in others, share a single render.
+    """
+    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y, quality, encoding)
+    return tileSingleFlight.run(key,
+                                lambda: renderTile(quadTreeId, zoom, x, y, quality, encoding),
+                                lambda: quadTree.getCachedTile(key))
+
+
+def renderTileToCache(quadTreeId, zoom, x, y, quality, encoding=None):
+    """
+    Runs on a tileRenderQueue worker thread.
+    """
+    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y, quality, encoding)
+    try:
+        if quadTree.getCachedTile(key) is None:
+            renderTileOnce(quadTreeId, zoom, x, y, quality, encoding)
+    finally:
+        # worker threads don't get the request_finished cleanup
+        close_old_connections()
+
+
+def schedulePrewarm(overlay):
+    """
+    Queues a pre-warm of overlay's aligned QuadTree, cancelling any
+    pre-warm still running for an older alignment of the overlay.
+    """
+    if not settings.GEOCAM_TIE_POINT_PREWARM_MAX_TILES or overlay.alignedQuadTree is None:
+        return
+    quadTreeId = overlay.alignedQuadTree.id
+    prewarmQuadTreeIds[overlay.key] = quadTreeId
+    prewarmQueue.schedule(('prewarm', quadTreeId),
+                          prewarmTiles, overlay.key, quadTreeId)
+
+
+def prewarmTiles(overlayKey, quadTreeId):
+    """
+    Runs on a prewarmQueue worker thread. Renders the top zoom levels of
+    the QuadTree into the tile caches, in the qualities and encodings
+    that getTile serves by default.
+    """
+    encodings = [None] + [e for e in settings.GEOCAM_TIE_POINT_PREFERRED_TILE_ENCODINGS
+                          if e in quadTree.TILE_ENCODERS]
+    quality = settings.GEOCAM_TIE_POINT_TILE_QUALITY
+    numRendered = 0
+    try:
+        gen = QuadTree.getGeneratorWithCache(quadTreeId)
+        for zoom, x, y in gen.getOverviewTiles(settings.GEOCAM_TIE_POINT_PREWARM_MAX_TILES):
+            if prewarmQuadTreeIds.get(overlayKey) != quadTreeId:
+                logging.info('prewarmTiles: QuadTree %s superseded after %d tiles',
+                             quadTreeId, numRendered)
+                return
+            keys = [quadTree.getTileCacheKey(quadTreeId, zoom, x, y, quality, encoding)
+                    for encoding in encodings]
+            if all([quadTree.getCachedTile(key) is not None for key in keys]):
+                continue
+            # warp once, encode once per encoding
+            tileImage = gen.generateTile(zoom, x, y, quality)
+            for encoding in encodings:
+                storeTile(quadTreeId, zoom, x, y, quality, encoding,
+                          quadTree.encodeTile(tileImage, encoding or gen.defaultEncoding))
+            numRendered += 1
+        logging.info('prewarmTiles: QuadTree %s done, rendered %d tiles',
+                     quadTreeId, numRendered)
+    finally:
+        if prewarmQuadTreeIds.get(overlayKey) == quadTreeId:
+            del prewarmQuadTreeIds[overlayKey]
+        # worker threads don't get the request_finished cleanup
+        close_old_connections()
+
+
 def neverExpires(response):
     """
     Manually sets the HTTP 'Expires' header one year in the
@@ -331,24 +530,150 @@ def neverExpires(response):
     return response
 
 
+def expiresSoon(response, maxAge):
+    """
+    Marks a response as cacheable for only maxAge seconds. Used for
+    preview tiles that will be replaced by a final render.
+    """
+    response['Expires'] = rfc822.formatdate(time.time() + maxAge)
+    response['Cache-Control'] = 'max-age=%d' % maxAge
+    return response
+
+
 def getTile(request, quadTreeId, zoom, x, y):
     quadTreeId = int(quadTreeId)
     zoom = int(zoom)
     x = int(x)
     y = int(os.path.splitext(y)[0])
-    
-    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y)
-    data = cache.get(key)
-    if data is None:
+    quality = request.GET.get('quality', settings.GEOCAM_TIE_POINT_TILE_QUALITY)
+    if quality not in quadTree.QUALITY_PROFILES:
+        return HttpResponseBadRequest('unknown quality profile %s' % quality)
+    encoding = request.GET.get('encoding')
+    if encoding is None:
+        # both simple and warped tiles may be served in an encoding
+        # with alpha, so negotiate as if alpha were needed
+        encoding = (quadTree.negotiateTileEncoding
+                    (request.META.get('HTTP_ACCEPT'),
+                     settings.GEOCAM_TIE_POINT_PREFERRED_TILE_ENCODINGS,
+                     needsAlpha=True))
+        negotiated = True
+    elif encoding in quadTree.TILE_ENCODERS:
+        negotiated = False
+    else:
+        return HttpResponseBadRequest('unknown tile encoding %s' % encoding)
+    try:
+        enhancement = tileEnhancement.Enhancement.fromKey(request.GET.get('enhance', ''))
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y, quality, encoding)
+    if request.META.get('HTTP_IF_NONE_MATCH'):
+        contentHash = getStoredTileHash(quadTreeId, zoom, x, y, quality, encoding, enhancement)
+        if contentHash is not None:
+            response = getNotModifiedResponse(request, quote_etag(contentHash))
+            if response is not None:
+                logging.info('getTile not modified %s', key)
+                profiler.record('getTile', zoom, 'notModified')
+                return tileResponseHeaders(neverExpires(response), negotiated)
+
+    stored = None
+    if not enhancement.isIdentity():
+        data = getEnhancedTileData(quadTreeId, zoom, x, y, quality, encoding, enhancement)
+    else:
+        data = quadTree.getCachedTile(key)
+    if data is None and diskTileStore:
+        stored = diskTileStore.getTileFile(quadTreeId, zoom, x, y, quality, encoding)
+    if stored is not None:
+        logging.info('getTile disk hit %s', key)
+        profiler.record('getTile', zoom, 'diskHit')
+        # FileResponse lets the wsgi server use sendfile()
+        tileFile, contentType = stored
+        response = neverExpires(FileResponse(tileFile, content_type=contentType))
+        contentHash = diskTileStore.getTileHash(quadTreeId, zoom, x, y, quality, encoding)
+        if contentHash is not None:
+            response['ETag'] = quote_etag(contentHash)
+    elif data is None:
         logging.info('\ngetTile MISS %s\n', key)
-        data = getTileData(quadTreeId, zoom, x, y)
-        cache.set(key, data)
+        profiler.record('getTile', zoom, 'cacheMiss')
+        if (settings.GEOCAM_TIE_POINT_PROGRESSIVE_TILES
+                and quality != PREVIEW_TILE_QUALITY):
+            response = getPreviewTile(quadTreeId, zoom, x, y, quality, encoding)
+        else:
+            data = renderTileOnce(quadTreeId, zoom, x, y, quality, encoding)
     else:
         logging.info('getTile hit %s', key)
+        profiler.record('getTile', zoom, 'cacheHit')
+
+    if data is not None:
+        response = neverExpires(getTileResponse(data))
+    return tileResponseHeaders(response, negotiated)
+
+
+def tileResponseHeaders(response, negotiated):
+    if negotiated:
+        patch_vary_headers(response, ['Accept'])
+    return response
 
+
+def getTileResponse(data):
+    """
+    Returns a response with the tile @data and its content hash as ETag.
+    """
     bits, contentType = data
     response = HttpResponse(bits, content_type=contentType)
-    return neverExpires(response)
+    response['ETag'] = quote_etag(quadTree.getContentHash(bits))
+    return response
+
+
+def getStoredTileHash(quadTreeId, zoom, x, y, quality, encoding, enhancement):
+    """
+    Returns the content hash of the tile from the memory or disk tile
+    caches, or None if neither has it, without reading or rendering
+    the tile.
+    """
+    key = quadTree.getTileCacheKey(quadTreeId, zoom, x, y, quality, encoding,
+                                   enhancement.getKey())
+    contentHash = quadTree.getCachedTileHash(key)
+    if contentHash is None and diskTileStore and enhancement.isIdentity():
+        contentHash = diskTileStore.getTileHash(quadTreeId, zoom, x, y, quality, encoding)
+    return contentHash
+
+
+def getNotModifiedResponse(request, etag):
+    """
+    Returns a 304 response if the request's If-None-Match header
+    matches @etag, otherwise None.
+    """
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    # If-None-Match uses the weak comparison
+    etags = [e[2:] if e.startswith('W/') else e
+             for e in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))]
+    if etag not in etags and '*' not in etags:
+        return None
+    response = HttpResponseNotModified()
+    response['ETag'] = etag
+    return response
+
+
+def getPreviewTile(quadTreeId, zoom, x, y, quality, encoding=None):
+    """
+    Progressive mode: answer a cache miss with a quick draft tile and
+    queue the final render in the background.
+    """
+    tileRenderQueue.schedule(quadTree.getTileCacheKey(quadTreeId, zoom, x, y,
+                                                      quality, encoding),
+                             renderTileToCache, quadTreeId, zoom, x, y, quality, encoding)
+
+    previewKey = quadTree.getTileCacheKey(quadTreeId, zoom, x, y,
+                                          PREVIEW_TILE_QUALITY, encoding)
+    data = quadTree.getCachedTile(previewKey)
+    if data is None:
+        data = getTileData(quadTreeId, zoom, x, y, PREVIEW_TILE_QUALITY, encoding)
+        quadTree.setCachedTile(previewKey, data,
+                               settings.GEOCAM_TIE_POINT_PREVIEW_TILE_MAX_AGE)
+
+    return expiresSoon(getTileResponse(data), settings.GEOCAM_TIE_POINT_PREVIEW_TILE_MAX_AGE)
 
 
 def getPublicTile(request, quadTreeId, zoom, x, y):
@@ -380,6 +705,39 @@ def dummyView(*args, **kwargs):
     return HttpResponseNotFound()
 
 
+def getExportTooBigReason(estimate):
+    """
+    Returns why the estimated export exceeds the configured limits, or
+    None if it doesn't (or there are no limits).
+    """
+    maxSeconds = settings.GEOCAM_TIE_POINT_EXPORT_MAX_ESTIMATED_SECONDS
+    maxBytes = settings.GEOCAM_TIE_POINT_EXPORT_MAX_ESTIMATED_BYTES
+    if maxSeconds and estimate['seconds'] > maxSeconds:
+        return ('export would take about %d seconds, the limit is %d'
+                % (estimate['seconds'], maxSeconds))
+    if maxBytes and estimate['bytes'] > maxBytes:
+        return ('export would be about %d bytes, the limit is %d'
+                % (estimate['bytes'], maxBytes))
+    return None
+
+
+def overlayEstimateExport(request, key, type):
+    """
+    Returns a JSON estimate of the tile counts per zoom, size and render
+    time of exporting the overlay as @type (see exportEstimator).
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    overlay = get_object_or_404(Overlay, key=key)
+    if not overlay.alignedQuadTree:
+        raise Http404('overlay has no aligned quadtree yet')
+    try:
+        estimate = overlay.estimateExport(type)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+    return HttpResponse(dumps(estimate), content_type='application/json')
+
+
 @csrf_exempt
 def overlayGenerateExport(request, key, type):
     if request.method == 'GET':
@@ -399,43 +757,71 @@ def overlayGenerateExport(request, key, type):
                 return HttpResponse('{"result": "ok"}',
                                     content_type='application/json')
         overlay = get_object_or_404(Overlay, key=key)
-        if type == 'html':
-            overlay.generateHtmlExport()
-        elif type == 'kml':
-            overlay.generateKmlExport()
-        elif type == 'geotiff':
-            overlay.generateGeotiffExport()
-        else: 
+        if type not in EXPORT_FIELDS:
             return HttpResponse('{"result": "error! Export type invalid."}',
                             content_type='application/json')
- 
-        return HttpResponse('{"result": "ok"}',
+        if not overlay.alignedQuadTree:
+            return HttpResponse('{"result": "error! Overlay is not aligned yet."}',
+                                content_type='application/json')
+        try:
+            priority = int(request.POST.get('priority', 0))
+        except ValueError:
+            return HttpResponseBadRequest('priority must be an integer')
+        estimate = overlay.estimateExport(type)
+        tooBig = getExportTooBigReason(estimate)
+        if tooBig:
+            return HttpResponse(dumps({'result': 'error! %s' % tooBig}),
+                                content_type='application/json')
+
+        # the export is rendered by exportWorker processes
+        numShards = exportQueue.getNumShards(type, estimate['seconds'])
+        job = exportQueue.enqueueExport(overlay, type, priority, estimate['seconds'], numShards)
+        return HttpResponse(dumps({'result': 'ok', 'job': job.getJsonDict()}),
                             content_type='application/json')
     else:
         return HttpResponseNotAllowed(['GET', 'POST'])
 
 
+def exportJobStatus(request, jobId):
+    """
+    Returns the status, progress and ETA of an export job as JSON.
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    job = get_object_or_404(ExportJob, id=jobId)
+    return HttpResponse(dumps(job.getJsonDict()), content_type='application/json')
+
+
+@csrf_exempt
+def exportJobCancel(request, jobId):
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    job = get_object_or_404(ExportJob, id=jobId)
+    exportQueue.cancelJob(job)
+    job = ExportJob.objects.get(id=job.id)
+    return HttpResponse(dumps(job.getJsonDict()), content_type='application/json')
+
+
 def overlayExport(request, key, type, fname):
     """
     Displays the generated exports.
     """
     if request.method == 'GET':
         overlay = get_object_or_404(Overlay, key=key)
-        if type == 'html': 
-            if not (overlay.alignedQuadTree and overlay.alignedQuadTree.htmlExport):
-                raise Http404('no export archive generated for requested overlay yet')
-            return HttpResponse(overlay.alignedQuadTree.htmlExport.file.read(),
-                                content_type='application/x-tgz')
-        elif type == 'kml':
-            if not (overlay.alignedQuadTree and overlay.alignedQuadTree.kmlExport):
-                raise Http404('no export archive generated for requested overlay yet')
-            return HttpResponse(overlay.alignedQuadTree.kmlExport.file.read(),
-                                content_type='application/x-tgz')
-        elif type == 'geotiff':
-            if not (overlay.alignedQuadTree and overlay.alignedQuadTree.geotiffExport):
-                raise Http404('no export archive generated for requested overlay yet')
-            return HttpResponse(overlay.alignedQuadTree.geotiffExport.file.read(),
-                                content_type='application/x-tgz')
+        if type not in EXPORT_FIELDS:
+            raise Http404('unknown export type %s' % type)
+        fieldName, contentType = EXPORT_FIELDS[type]
+        exportFile = overlay.alignedQuadTree and getattr(overlay.alignedQuadTree, fieldName)
+        if not exportFile:
+            raise Http404('no export archive generated for requested overlay yet')
+        # export names are timestamped, so a new export gets a new name
+        etag = quote_etag(quadTree.getContentHash('%s\n%s' % (exportFile.name, exportFile.size)))
+        notModified = getNotModifiedResponse(request, etag)
+        if notModified is not None:
+            return notModified
+        response = HttpResponse(exportFile.file.read(), content_type=contentType)
+        response['ETag'] = etag
+        return response
     else:
         return HttpResponseNotAllowed(['GET'])
 
@@ -443,11 +829,12 @@ def overlayExport(request, key, type, fname):
 @csrf_exempt
 def getExportFilesList(request):
     """
-    Downloads a csv file containing list of all available export products (kml, geotiff, html).
+    Downloads a csv file containing list of all available export products (kml, geotiff, html, mbtiles).
     """
     response = HttpResponse(content_type='text/plain')
     response['Content-Disposition'] = 'attachment; filename="GeoRefExportProductsList.txt"'
-    exports = QuadTree.objects.values_list('htmlExportName', 'geotiffExportName', 'kmlExportName', 'metadataExportName')
+    exports = QuadTree.objects.values_list('htmlExportName', 'geotiffExportName', 'kmlExportName', 'metadataExportName',
+                                           'mbtilesExportName')
     writer = csv.writer(response)
     for set in exports:
         if set is not (None, None, None):
@@ -459,7 +846,11 @@ def getExportFilesList(request):
 
 @csrf_exempt
 def getExportFile(request, name):
-    if "kml" in name:
+    if name.endswith(".mbtiles"):
+        quadTree = QuadTree.objects.filter(mbtilesExportName = name)[0]
+        return HttpResponse(quadTree.mbtilesExport.file.read(),
+                            content_type='application/x-sqlite3')
+    elif "kml" in name:
         quadTree = QuadTree.objects.filter(kmlExportName = name)[0]
         return HttpResponse(quadTree.kmlExport.file.read(),
                             content_type='application/x-tgz')
@@ -476,6 +867,18 @@ def getExportFile(request, name):
 
 
 @csrf_exempt
+def tileProfileJson(request):
+    """
+    Per-stage tile rendering timings merged across worker processes. See
+    tileProfiler and the tileProfile management command.
+    """
+    if request.method == 'GET':
+        return JsonResponse({'enabled': profiler.isEnabled(),
+                             'stats': profiler.getSummary()})
+    else:
+        return HttpResponseNotAllowed(['GET'])
+
+
 def garbageCollect(request, dryRun='1'):
     if request.method == 'GET':
         return render_to_response('geocamTiePoint/gc.html',